@@ -0,0 +1,37 @@
+"""
+Production server config: gunicorn with gevent workers
+
+Run from the backend directory:
+    gunicorn -c gunicorn.conf.py
+
+Each gevent worker serves many requests concurrently - while a request waits
+on ffmpeg, Whisper or Ollama (all subprocesses) other requests keep running,
+so polling clients and long generations don't tie up OS threads. Blocking
+SQLite and log-file I/O runs on real OS threads (see offload.py), so it
+doesn't stall the other requests. Settings come from the "server" section
+of config_runtime.json (or config.json).
+"""
+import os
+import sys
+
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+rabin_dir = os.path.dirname(backend_dir)
+sys.path.insert(0, rabin_dir)
+
+from settings import load_settings
+
+settings = load_settings('server')
+
+wsgi_app = 'server:app'
+chdir = backend_dir
+
+bind = settings.get('bind', '0.0.0.0:5001')
+workers = settings.get('workers', 1)
+worker_class = 'gevent'
+# Concurrent requests per worker (mostly idle connections waiting on models)
+worker_connections = settings.get('worker_connections', 500)
+timeout = settings.get('timeout', 120)
+graceful_timeout = 30
+
+accesslog = '-'
+errorlog = '-'
@@ -1,17 +1,49 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Request, Response, jsonify, request, send_file
 from flask_cors import CORS
 import subprocess
 import os
-import threading
+import tempfile
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
 from werkzeug.utils import secure_filename
+import hashlib
 import json
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+# Shared modules (conversation_log etc.) live in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cancellation import EXIT_CANCELLED, pipeline_env
+from comparison import compare_settings, compare_timeout
+from conversation_log import ConversationLog, LogWriteError, get_log_writer, handoff_env, take_log_record, take_log_records
+from conversation_search import ConversationIndex
+from job_scheduler import scheduler_from_settings
+from memory_manager import get_memory_manager
+from model_stats import get_model_stats
+import profiling
+from profiling import record_span, span
+from record_settings import RECORD_LISTEN_SECONDS, RECORD_MODEL, RECORD_NUM_PREDICT
+from resource_governor import get_governor
+from settings import load_settings
+from shared_state import ConfigConflict, get_shared_state
+from single_flight import Detached, SingleFlight
 
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
+CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True, expose_headers=['X-Profile-Id', 'X-Job-Id'])
 
 # Paths
 rabin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 LOG_FILE = os.path.join(rabin_dir, "conversation.txt")
+conversation_log = ConversationLog(LOG_FILE)
+conversation_index = ConversationIndex(conversation_log)
+# The server owns the log writer: pipelines hand their entries back on stdout
+# and they are appended in batches, then indexed right away
+get_log_writer(LOG_FILE).on_batch = conversation_index.refresh
+# Logs pipelines may hand entries back for (listen2_single.py keeps its own)
+HANDOFF_LOGS = (LOG_FILE, os.path.join(rabin_dir, 'listen2', 'listen2_conversation_log.txt'))
 CONFIG_DEFAULT_FILE = os.path.join(rabin_dir, "config.json")  # Immutable defaults
 CONFIG_RUNTIME_FILE = os.path.join(rabin_dir, "config_runtime.json")  # Active config
 
@@ -29,6 +61,288 @@ def ensure_runtime_config():
 # Initialize runtime config on startup
 ensure_runtime_config()
 
+# Config versions, job status and caches shared by all worker processes
+shared_state = get_shared_state()
+
+# Learned per-model latency - sets each run's deadline instead of a fixed timeout
+model_stats = get_model_stats()
+
+SERVER_SETTINGS = load_settings('server')
+
+# Each pipeline run is a separate python process holding Whisper/Ollama client
+# memory, so only max_concurrent_jobs run at once - the rest wait here cheaply,
+# in per-type lanes so quick text questions don't queue behind long runs
+pipeline_scheduler = scheduler_from_settings(SERVER_SETTINGS.get('max_concurrent_jobs', 2))
+
+# Upload limits - oversized bodies are rejected from Content-Length before reading
+UPLOAD_MAX_BYTES = SERVER_SETTINGS.get('upload_max_bytes', 10 * 1024 * 1024)
+UPLOAD_MAX_SECONDS = SERVER_SETTINGS.get('upload_max_seconds', 60)
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES
+
+# Container signatures accepted from the browser recorder
+AUDIO_SIGNATURES = [
+    (0, b'\x1a\x45\xdf\xa3'),  # WebM / Matroska (Chrome, Firefox)
+    (0, b'OggS'),              # Ogg / Opus
+    (4, b'ftyp'),              # MP4 / M4A (Safari)
+    (8, b'WAVE'),              # WAV (RIFF....WAVE)
+    (0, b'ID3'),               # MP3
+    (0, b'fLaC'),              # FLAC
+]
+SIGNATURE_BYTES = 12
+
+class AudioUploadStream:
+    """
+    Spool file for an uploaded audio part.
+
+    Werkzeug writes the multipart body into it chunk by chunk as it arrives,
+    so memory stays constant regardless of clip length. The container
+    signature is checked on the first bytes and the byte limit on every
+    write, so bad or oversized media is rejected before it is fully read.
+    """
+
+    def __init__(self, max_bytes):
+        self._file = tempfile.NamedTemporaryFile(prefix='temp_upload_', dir=rabin_dir)
+        self._max_bytes = max_bytes
+        self._written = 0
+        self._head = b''
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._written += len(data)
+        if self._written > self._max_bytes:
+            raise RequestEntityTooLarge(f'Audio upload exceeds {self._max_bytes} bytes')
+        if len(self._head) < SIGNATURE_BYTES:
+            self._head += data[:SIGNATURE_BYTES - len(self._head)]
+            if len(self._head) >= SIGNATURE_BYTES and not self.is_audio(self._head):
+                raise UnsupportedMediaType('Uploaded file is not a supported audio format')
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    @staticmethod
+    def is_audio(head):
+        return any(head[offset:offset + len(magic)] == magic for offset, magic in AUDIO_SIGNATURES)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    """Request that spools uploaded files through AudioUploadStream"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return AudioUploadStream(UPLOAD_MAX_BYTES)
+
+app.request_class = UploadRequest
+
+def request_client():
+    """Identity used for per-client fairness: X-Client-Id header, else the remote address"""
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+# Cancellation: how often a running pipeline is checked, and how long it gets
+# to close its Ollama stream and exit on its own before it is killed
+CANCEL_POLL_SECONDS = 0.25
+CANCEL_GRACE_SECONDS = 3
+# A worker joining a run elsewhere also waits out the run's time in the scheduler queue
+JOIN_QUEUE_SECONDS = 60
+CANCELLED_STATUS = 499
+CANCELLED_BODY = {'success': False, 'error': 'הבקשה בוטלה', 'cancelled': True}
+
+class PipelineCancelled(Exception):
+    """The pipeline run was cancelled (cancel endpoint or client disconnect)"""
+
+# Job id and coalescing key of the request being handled (greenlet-local under gevent)
+_current_job = threading.local()
+
+def client_disconnected(environ):
+    """Whether the client closed the connection this request arrived on"""
+    sock = environ.get('gunicorn.socket') or environ.get('gunicorn.sock') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    timeout = sock.gettimeout()
+    try:
+        sock.settimeout(0)
+        # A closed connection reads as EOF; pending bytes (or none yet) mean it's still open
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (BlockingIOError, socket.timeout):
+        return False
+    except OSError:
+        return True
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+
+def pipeline_stop_reason(job_id, deadline, environ):
+    """Why a running pipeline should stop ('deadline', 'cancelled', 'disconnected'), or None"""
+    if time.time() >= deadline:
+        return 'deadline'
+    if job_id and shared_state.job_cancelled(job_id):
+        return 'cancelled'
+    # Other callers attached to this run (in any worker) still want the answer
+    if client_disconnected(environ) and not (job_id and shared_state.attached_callers(job_id, exclude=job_id)):
+        if job_id:
+            shared_state.cancel_job(job_id, CANCELLED_STATUS, CANCELLED_BODY)
+        return 'disconnected'
+    return None
+
+def pipeline_timeout(overhead_seconds=0):
+    """Seconds to allow a pipeline run on the configured model, from its learned latency"""
+    _, config = shared_state.get_config()
+    num_predict = (config.get('options') or {}).get('num_predict')
+    return model_stats.timeout(config.get('model'), num_predict, overhead_seconds)
+
+def record_timeout():
+    """Seconds to allow listen2_single.py: listening, transcription and its own model's answer"""
+    return model_stats.timeout(RECORD_MODEL, RECORD_NUM_PREDICT,
+                               RECORD_LISTEN_SECONDS + model_stats.audio_overhead_seconds())
+
+def pipeline_python():
+    """The venv python if it exists, otherwise python3"""
+    venv_python = os.path.join(rabin_dir, '.venv', 'bin', 'python')
+    return venv_python if os.path.exists(venv_python) else 'python3'
+
+def run_pipeline(args, timeout, lane, client=None):
+    """Run a pipeline script from the rabin directory with the venv python,
+    once the scheduler grants `lane` a slot.
+
+    Raises subprocess.TimeoutExpired after `timeout` seconds, and
+    PipelineCancelled if the job is cancelled or the client disconnects. The
+    pipeline gets its job id and deadline and stops its Whisper/Ollama work
+    itself; it is killed only if it hasn't exited CANCEL_GRACE_SECONDS later."""
+    # Expensive models count for more against the lane's share
+    _, config = shared_state.get_config()
+    cost = pipeline_scheduler.cost(config.get('model'))
+    
+    job_id = getattr(_current_job, 'id', None)
+    environ = request.environ
+    
+    with pipeline_scheduler.slot(lane, client, cost) as waited:
+        record_span('queue', waited)
+        if waited >= 1:
+            print(f"[SCHED] {lane} job for {client} waited {waited:.1f}s for a slot", flush=True)
+        # Cancelled (or abandoned) while it was queued - don't start it at all
+        deadline = time.time() + timeout
+        if pipeline_stop_reason(job_id, deadline, environ):
+            raise PipelineCancelled(job_id)
+        
+        with span('pipeline'):
+            proc = subprocess.Popen(
+                [pipeline_python()] + args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                cwd=rabin_dir,
+                # Profiled requests pass their profile directory on to the pipeline
+                env=pipeline_env(job_id, deadline, handoff_env(profiling.pipeline_env()))
+            )
+            reason = None
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(timeout=CANCEL_POLL_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if reason is None:
+                    reason = pipeline_stop_reason(job_id, deadline, environ)
+                    if reason:
+                        print(f"[CANCEL] Stopping {args[0]} (job {job_id}): {reason}", flush=True)
+                        kill_at = time.time() + CANCEL_GRACE_SECONDS
+                elif time.time() >= kill_at:
+                    proc.kill()
+                    stdout, stderr = proc.communicate()
+                    break
+    
+    if proc.returncode != 0 and (reason or proc.returncode == EXIT_CANCELLED):
+        # The pipeline hits the shared deadline first and exits on its own
+        if (reason or 'deadline') == 'deadline' and time.time() >= deadline:
+            raise subprocess.TimeoutExpired(proc.args, timeout, output=stdout, stderr=stderr)
+        raise PipelineCancelled(job_id)
+    # Queue the log entries it handed back - the writer thread appends them
+    return subprocess.CompletedProcess(proc.args, proc.returncode, take_log_records(stdout, HANDOFF_LOGS), stderr)
+
+# Identical requests arriving while one is running attach to it instead of
+# starting another generation (double-clicks, retries, same question)
+pipeline_calls = SingleFlight()
+
+def config_fingerprint():
+    """Current config version - requests only coalesce under the same model/options/context"""
+    return shared_state.config_version()
+
+def request_job_id():
+    """Job id for a new job: the client's X-Request-Id (so it can cancel the job
+    before the response arrives) if usable, else a fresh one"""
+    request_id = request.headers.get('X-Request-Id', '')
+    if (re.fullmatch(r'[0-9A-Za-z-]{8,64}', request_id) and shared_state.get_job(request_id) is None
+            and shared_state.caller_job(request_id) is None):
+        return request_id
+    return uuid.uuid4().hex
+
+def job_key_for(key):
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest() if key is not None else None
+
+def run_job(kind, key, func, timeout, caller_id=None):
+    """
+    Run func() -> (body, status) as a job recorded in the shared state.
+
+    If another worker process is already running the same key, wait for its
+    result instead (key None: never shared) - up to the run's `timeout` plus
+    its time in the scheduler queue. A caller that leads the job uses
+    its caller id as the job id. Returns ((body, status), joined_other_worker);
+    raises Detached if the caller was detached while waiting.
+    """
+    job_id, leader = shared_state.start_job(caller_id or request_job_id(), kind, job_key_for(key))
+    if not leader:
+        print(f"[JOB] Waiting for job {job_id} running in another worker", flush=True)
+        # Leave once detached - unless callers in this worker still wait on us
+        leave = (lambda: shared_state.caller_detached(caller_id) and not pipeline_calls.waiters(key)) if caller_id else None
+        body, status = shared_state.wait_job(job_id, timeout + JOIN_QUEUE_SECONDS + CANCEL_GRACE_SECONDS, leave)
+        if body is None:
+            if leave and leave():
+                raise Detached(key)
+            return ({'success': False, 'error': 'Processing timeout', 'job_id': job_id}, 500), True
+        return ({**body, 'job_id': job_id}, status), True
+    
+    # run_pipeline picks this up to pass the job on and to watch for cancellation
+    _current_job.id = job_id
+    try:
+        body, status = func()
+    except PipelineCancelled:
+        body, status = CANCELLED_BODY, CANCELLED_STATUS
+    except Exception as e:
+        shared_state.finish_job(job_id, 500, {'success': False, 'error': str(e)})
+        raise
+    finally:
+        _current_job.id = None
+    body = {**body, 'job_id': job_id}
+    shared_state.finish_job(job_id, status, body)
+    return (body, status), False
+
+def run_shared(kind, key, func, timeout):
+    """
+    Coalesce identical requests in this worker (SingleFlight) and across workers (run_job).
+
+    Every request is registered as a caller of the run under its X-Request-Id,
+    so cancelling it while others are attached only detaches it: it gets the
+    cancelled response and the run goes on for the rest.
+    """
+    caller_id = request_job_id()
+    shared_state.attach_caller(caller_id, job_key_for(key))
+    try:
+        try:
+            ((body, status), joined), coalesced = pipeline_calls.do(
+                key, lambda: run_job(kind, key, func, timeout, caller_id=caller_id),
+                leave=lambda: shared_state.caller_detached(caller_id))
+        except Detached:
+            return {**CANCELLED_BODY, 'detached': True, 'job_id': caller_id}, CANCELLED_STATUS
+        # The caller running the job only sees that it was detached once the run ends
+        if shared_state.caller_detached(caller_id):
+            return {**CANCELLED_BODY, 'detached': True, 'job_id': body.get('job_id')}, CANCELLED_STATUS
+    finally:
+        shared_state.release_caller(caller_id)
+    if coalesced or joined:
+        body = {**body, 'coalesced': True}
+    return body, status
+
 # Model descriptions in Hebrew with capabilities
 MODEL_DESCRIPTIONS = {
     "gemma2:9b": "מודל של גוגל (Google), מהיר ויעיל במיוחד.\n\nתמיכה: עברית מצוינת, אנגלית, שפות נוספות. יכולות: הסבר מושגים, שיחה טבעית, סיכום טקסטים, תרגום.\n\nמומלץ לשימוש יומיומי - איזון מושלם בין מהירות לאיכות.",
@@ -46,60 +360,193 @@ OPTIONS_DESCRIPTIONS = {
     "num_predict": "מספר מילים מקסימלי (Tokens) - מגביל כמה מילים המודל יכול לייצר.\n\nמה זה עושה: עוצר את המודל אחרי X מילים (טוקנים).\n\nערך נמוך (200-500): תשובות קצרות וממוקדות. מתאים להגדרות מהירות.\n\nערך בינוני (600-1000): תשובות מפורטות עם הסברים. האיזון המומלץ.\n\nערך גבוה (1200-2000): תשובות ארוכות ומקיפות מאוד. עלול להיות מילולי."
 }
 
+# Opt-in profiling (X-Profile: 1 header or "profiling.enabled") of the pipeline endpoints
+PROFILED_ENDPOINTS = {'record', 'record_audio', 'text_input'}
+
+@app.before_request
+def start_profile():
+    if request.endpoint in PROFILED_ENDPOINTS and profiling.requested(request.headers.get('X-Profile')):
+        profiling.start('server')
+
+@app.after_request
+def attach_profile(response):
+    profile = profiling.stop()
+    if profile is not None:
+        response.headers['X-Profile-Id'] = profile.id
+        print(f"[PROFILE] {request.endpoint} → {profile.id}", flush=True)
+    return response
+
+@app.teardown_request
+def stop_profile(exc):
+    # after_request is skipped when a view raises - don't leave the profiler running
+    profiling.stop()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """Reject oversized uploads with JSON like every other endpoint"""
+    return jsonify({
+        'success': False,
+        'error': f'הקובץ גדול מדי (מקסימום {UPLOAD_MAX_BYTES // (1024 * 1024)}MB)'
+    }), 413
+
+def record_request(timeout, client=None):
+    """Run listen2_single.py (records from the server's microphone). Returns (body, status)"""
+    try:
+        # Run listen2_single.py from the rabin directory with virtual environment
+        result = run_pipeline(['listen2_single.py'], timeout=timeout, lane='record', client=client)
+    except subprocess.TimeoutExpired:
+        return {
+            'success': False,
+            'error': f'התגובה לקחה יותר מדי זמן ({timeout:.0f} שניות). נסה שוב או החלף מודל מהיר יותר בהגדרות.'
+        }, 500
+    
+    # Log the output for debugging
+    print(f"Script stdout: {result.stdout}")
+    print(f"Script stderr: {result.stderr}")
+    print(f"Return code: {result.returncode}")
+    
+    if result.returncode == 0:
+        return {
+            'success': True,
+            'message': 'Recording completed',
+            'debug': {
+                'stdout': result.stdout,
+                'stderr': result.stderr
+            }
+        }, 200
+    else:
+        return {
+            'success': False,
+            'error': result.stderr or result.stdout or 'Recording failed'
+        }, 500
+
 @app.route('/api/record', methods=['POST'])
 def record():
     """Trigger the listen2_single.py script"""
     try:
-        # Run listen2_single.py from the rabin directory with virtual environment
-        rabin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        venv_python = os.path.join(rabin_dir, '.venv', 'bin', 'python')
-        
-        # Use venv python if it exists, otherwise use python3
-        python_cmd = venv_python if os.path.exists(venv_python) else 'python3'
+        # A job (never shared - every recording is new) so it can be cancelled
+        timeout = record_timeout()
+        (body, status), _ = run_job('record', None, lambda: record_request(timeout, request_client()), timeout)
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def convert_recording(upload_path, wav_path):
+    """Convert an uploaded recording to 16kHz mono WAV. Returns None, or (body, status) on failure"""
+    # Decode at most the allowed duration
+    try:
+        with span('decode'):
+            conversion = subprocess.run(
+                ['ffmpeg', '-i', upload_path, '-t', str(UPLOAD_MAX_SECONDS + 1),
+                 '-ar', '16000', '-ac', '1', '-y', wav_path],
+                capture_output=True,
+                text=True,
+                timeout=10
+            )
         
-        result = subprocess.run(
-            [python_cmd, 'listen2_single.py'],
-            capture_output=True,
-            text=True,
-            timeout=60,
-            cwd=rabin_dir
-        )
+        if conversion.returncode != 0:
+            raise Exception(f"Audio conversion failed: {conversion.stderr}")
+    except FileNotFoundError:
+        return {
+            'success': False,
+            'error': 'ffmpeg not installed. Please run: brew install ffmpeg'
+        }, 500
+    except Exception as e:
+        return {
+            'success': False,
+            'error': f'Audio conversion error: {str(e)}'
+        }, 500
+    
+    # 16kHz mono 16-bit PCM = 32000 bytes per second (minus the 44 byte header)
+    duration = (os.path.getsize(wav_path) - 44) / 32000
+    if duration > UPLOAD_MAX_SECONDS:
+        return {
+            'success': False,
+            'error': f'ההקלטה ארוכה מדי (מקסימום {UPLOAD_MAX_SECONDS} שניות)'
+        }, 413
+    return None
+
+def process_recording(upload_path, timeout, client=None):
+    """Convert an uploaded recording and run process_audio.py on it. Returns (body, status)"""
+    # Unique name so concurrent uploads don't overwrite each other
+    temp_wav_path = os.path.join(rabin_dir, f'temp_upload_{uuid.uuid4().hex}.wav')
+    
+    try:
+        failure = convert_recording(upload_path, temp_wav_path)
+        if failure:
+            return failure
         
-        # Log the output for debugging
-        print(f"Script stdout: {result.stdout}")
-        print(f"Script stderr: {result.stderr}")
-        print(f"Return code: {result.returncode}")
+        # Process the converted audio
+        print(f"[DEBUG] Starting process_audio.py with file: {temp_wav_path}", flush=True)
         
-        if result.returncode == 0:
-            return jsonify({
-                'success': True,
-                'message': 'Recording completed',
-                'debug': {
-                    'stdout': result.stdout,
-                    'stderr': result.stderr
-                }
-            })
-        else:
-            return jsonify({
+        try:
+            result = run_pipeline(['process_audio.py', temp_wav_path], timeout=timeout, lane='audio', client=client)
+        except subprocess.TimeoutExpired:
+            return {
                 'success': False,
-                'error': result.stderr or result.stdout or 'Recording failed'
-            }), 500
+                'error': 'Processing timeout'
+            }, 500
+        
+        # Log output for debugging
+        print(f"[DEBUG] Script stdout: {result.stdout}", flush=True)
+        print(f"[DEBUG] Script stderr: {result.stderr}", flush=True)
+        print(f"[DEBUG] Return code: {result.returncode}", flush=True)
+    finally:
+        # Clean up temp files (the spooled upload is removed when the request closes)
+        if os.path.exists(temp_wav_path):
+            try:
+                os.remove(temp_wav_path)
+            except:
+                pass
+    
+    if result.returncode == 0:
+        return {
+            'success': True,
+            'message': 'Recording processed successfully'
+        }, 200
+    else:
+        return {
+            'success': False,
+            'error': result.stderr or result.stdout or 'Processing failed'
+        }, 500
+
+def process_text_request(text, timeout, client=None):
+    """Run process_text.py on one question. Returns (body, status)"""
+    try:
+        result = run_pipeline(['process_text.py', text], timeout=timeout, lane='text', client=client)
     except subprocess.TimeoutExpired:
-        return jsonify({
+        return {
             'success': False,
-            'error': 'התגובה לקחה יותר מדי זמן (40 שניות). נסה שוב או החלף מודל מהיר יותר בהגדרות.'
-        }), 500
-    except Exception as e:
-        return jsonify({
+            'error': f'התגובה לקחה יותר מדי זמן ({timeout:.0f} שניות). נסה שוב או החלף מודל מהיר יותר בהגדרות.'
+        }, 500
+    
+    # Log output for debugging
+    print(f"Script stdout: {result.stdout}")
+    print(f"Script stderr: {result.stderr}")
+    print(f"Return code: {result.returncode}")
+    
+    if result.returncode == 0:
+        return {
+            'success': True,
+            'message': 'Text processed successfully'
+        }, 200
+    else:
+        return {
             'success': False,
-            'error': str(e)
-        }), 500
+            'error': result.stderr or result.stdout or 'Processing failed'
+        }, 500
 
 @app.route('/api/record-audio', methods=['POST'])
 def record_audio():
     """Process uploaded audio file from browser recording"""
     try:
-        if 'audio' not in request.files:
+        # The body is spooled (and validated) on first access to request.files
+        with span('upload'):
+            has_audio = 'audio' in request.files
+        if not has_audio:
             return jsonify({
                 'success': False,
                 'error': 'No audio file provided'
@@ -113,78 +560,31 @@ def record_audio():
                 'error': 'Empty filename'
             }), 400
         
-        # Save the uploaded audio temporarily
-        rabin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        temp_webm_path = os.path.join(rabin_dir, 'temp_upload.webm')
-        temp_wav_path = os.path.join(rabin_dir, 'temp_upload.wav')
-        
-        audio_file.save(temp_webm_path)
-        
-        # Convert WebM to WAV using ffmpeg
-        try:
-            conversion = subprocess.run(
-                ['ffmpeg', '-i', temp_webm_path, '-ar', '16000', '-ac', '1', '-y', temp_wav_path],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            
-            if conversion.returncode != 0:
-                raise Exception(f"Audio conversion failed: {conversion.stderr}")
-        except FileNotFoundError:
+        # The upload was already spooled to disk (and validated) while the body was parsed
+        audio_file.stream.flush()
+        if len(getattr(audio_file.stream, '_head', b'')) < SIGNATURE_BYTES:
             return jsonify({
                 'success': False,
-                'error': 'ffmpeg not installed. Please run: brew install ffmpeg'
-            }), 500
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': f'Audio conversion error: {str(e)}'
-            }), 500
-        
-        # Process the converted audio
-        venv_python = os.path.join(rabin_dir, '.venv', 'bin', 'python')
-        python_cmd = venv_python if os.path.exists(venv_python) else 'python3'
-        
-        print(f"[DEBUG] Starting process_audio.py with file: {temp_wav_path}", flush=True)
-        
-        result = subprocess.run(
-            [python_cmd, 'process_audio.py', temp_wav_path],
-            capture_output=True,
-            text=True,
-            timeout=40,  # 40 second timeout
-            cwd=rabin_dir
-        )
-        
-        # Log output for debugging
-        print(f"[DEBUG] Script stdout: {result.stdout}", flush=True)
-        print(f"[DEBUG] Script stderr: {result.stderr}", flush=True)
-        print(f"[DEBUG] Return code: {result.returncode}", flush=True)
-        
-        # Clean up temp files
-        for temp_file in [temp_webm_path, temp_wav_path]:
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
+                'error': 'Audio file is empty or truncated'
+            }), 400
         
-        if result.returncode == 0:
-            return jsonify({
-                'success': True,
-                'message': 'Recording processed successfully'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.stderr or result.stdout or 'Processing failed'
-            }), 500
+        key = ('audio', audio_file.stream.sha256.hexdigest(), config_fingerprint())
+        # Transcription comes on top of generation
+        timeout = pipeline_timeout(model_stats.audio_overhead_seconds())
+        body, status = run_shared('audio', key, lambda: process_recording(audio_file.stream.name, timeout, request_client()),
+                                  timeout)
+        if body.get('coalesced'):
+            print(f"[DEBUG] Attached to identical in-flight recording", flush=True)
+        return jsonify(body), status
             
-    except subprocess.TimeoutExpired:
+    except RequestEntityTooLarge as e:
+        return upload_too_large(e)
+    except HTTPException as e:
+        # Non-audio upload rejected while streaming
         return jsonify({
             'success': False,
-            'error': 'Processing timeout'
-        }), 500
+            'error': e.description
+        }), e.code
     except Exception as e:
         return jsonify({
             'success': False,
@@ -211,100 +611,374 @@ def text_input():
                 'error': 'Empty text'
             }), 400
         
-        # Run the text processing script
-        rabin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        venv_python = os.path.join(rabin_dir, '.venv', 'bin', 'python')
-        python_cmd = venv_python if os.path.exists(venv_python) else 'python3'
+        # Same question (ignoring case/whitespace) under the same config shares one run
+        key = ('text', ' '.join(text.split()).casefold(), config_fingerprint())
+        timeout = pipeline_timeout()
+        body, status = run_shared('text', key, lambda: process_text_request(text, timeout, request_client()), timeout)
+        if body.get('coalesced'):
+            print(f"Attached to identical in-flight question", flush=True)
+        return jsonify(body), status
+            
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def parse_compare_models(value):
+    """Models to compare, from a JSON list or a comma-separated form field, without duplicates"""
+    if isinstance(value, str):
+        value = value.split(',')
+    models = []
+    for model in value if isinstance(value, list) else []:
+        if isinstance(model, str) and model.strip() and model.strip() not in models:
+            models.append(model.strip())
+    return models
+
+def stream_comparison(args, models, timeout, client, job_id, cleanup):
+    """
+    Streaming response running process_compare.py and passing on its events
+    (JSON lines) as they come.
+    
+    The job ends with an "end" event and its summary (per-model latency and
+    throughput) in the shared state. If the client goes away mid-stream, the
+    job is cancelled and the pipeline stops its generations. The job is
+    finished and cleanup() called when the response is closed - also when the
+    stream never started.
+    """
+    environ = request.environ
+    # Holds one slot but runs every model - it costs as much as all of them
+    cost = sum(pipeline_scheduler.cost(model) for model in models)
+    outcome = {}
+    
+    def events():
+        status = 200
+        summary = {'success': True, 'models': {}}
+        started = time.time()
+        proc = None
+        try:
+            yield json.dumps({'event': 'job', 'job_id': job_id, 'timeout': timeout}) + '\n'
+            with pipeline_scheduler.slot('compare', client, cost) as waited:
+                if waited >= 1:
+                    print(f"[SCHED] compare job for {client} waited {waited:.1f}s for a slot", flush=True)
+                deadline = time.time() + timeout
+                if pipeline_stop_reason(job_id, deadline, environ):
+                    raise PipelineCancelled(job_id)
+                
+                with tempfile.TemporaryFile(mode='w+', encoding='utf-8') as stderr:
+                    proc = subprocess.Popen(
+                        [pipeline_python(), 'process_compare.py', ','.join(models)] + args,
+                        stdout=subprocess.PIPE,
+                        stderr=stderr,
+                        text=True,
+                        cwd=rabin_dir,
+                        env=pipeline_env(job_id, deadline, handoff_env())
+                    )
+                    # Backstop only - the pipeline stops itself at the deadline
+                    killer = threading.Timer(timeout + CANCEL_GRACE_SECONDS, proc.kill)
+                    killer.daemon = True
+                    killer.start()
+                    try:
+                        for line in proc.stdout:
+                            if take_log_record(line, HANDOFF_LOGS):
+                                continue
+                            try:
+                                event = json.loads(line)
+                            except ValueError:
+                                continue
+                            if event.get('event') in ('done', 'error'):
+                                summary['models'][event['model']] = {
+                                    key: event[key] for key in ('seconds', 'stats', 'error') if key in event
+                                }
+                            yield line
+                        proc.wait()
+                    finally:
+                        killer.cancel()
+                    
+                    if proc.returncode == EXIT_CANCELLED or (proc.returncode != 0 and shared_state.job_cancelled(job_id)):
+                        if time.time() < deadline:
+                            raise PipelineCancelled(job_id)
+                        status, summary = 500, {'success': False, 'error': f'ההשוואה לקחה יותר מדי זמן ({timeout:.0f} שניות)'}
+                    elif proc.returncode != 0:
+                        stderr.seek(0)
+                        status, summary = 500, {'success': False, 'error': stderr.read()[-2000:] or 'Comparison failed'}
+            
+            summary['seconds'] = round(time.time() - started, 2)
+            yield json.dumps({'event': 'end', **summary}, ensure_ascii=False) + '\n'
+        except PipelineCancelled:
+            status, summary = CANCELLED_STATUS, CANCELLED_BODY
+            yield json.dumps({'event': 'end', **CANCELLED_BODY}, ensure_ascii=False) + '\n'
+        except Exception as e:
+            # Headers are already sent - report the failure in the stream
+            status, summary = 500, {'success': False, 'error': str(e)}
+            yield json.dumps({'event': 'end', **summary}, ensure_ascii=False) + '\n'
+        finally:
+            # Client disconnected mid-stream (GeneratorExit) - stop the generations too
+            if proc is not None and proc.poll() is None:
+                shared_state.cancel_job(job_id, CANCELLED_STATUS, CANCELLED_BODY)
+                print(f"[CANCEL] Stopping process_compare.py (job {job_id}): disconnected", flush=True)
+                try:
+                    proc.wait(timeout=CANCEL_GRACE_SECONDS)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            outcome['result'] = (status, summary)
+    
+    def finish():
+        if 'result' in outcome:
+            shared_state.finish_job(job_id, *outcome['result'])
+        else:
+            # Closed before the stream started - nobody is waiting for it
+            shared_state.cancel_job(job_id, CANCELLED_STATUS, CANCELLED_BODY)
+        cleanup()
+    
+    response = Response(
+        events(),
+        mimetype='application/x-ndjson',
+        # Don't let a proxy buffer the stream
+        headers={'X-Job-Id': job_id, 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(finish)
+    return response
+
+@app.route('/api/compare', methods=['POST'])
+def compare():
+    """Ask several models the same question concurrently and stream their answers (JSON lines).
+    JSON {"text", "models": [...]} or a multipart recording ("audio") with a "models" field"""
+    temp_wav_path = None
+    
+    def cleanup():
+        if temp_wav_path and os.path.exists(temp_wav_path):
+            try:
+                os.remove(temp_wav_path)
+            except OSError:
+                pass
+    
+    try:
+        if request.mimetype == 'multipart/form-data':
+            with span('upload'):
+                audio_file = request.files.get('audio')
+            models = parse_compare_models(request.form.get('models', ''))
+            text = request.form.get('text', '').strip()
+        else:
+            audio_file = None
+            data = request.get_json(silent=True) or {}
+            models = parse_compare_models(data.get('models'))
+            text = (data.get('text') or '').strip()
         
-        result = subprocess.run(
-            [python_cmd, 'process_text.py', text],
-            capture_output=True,
-            text=True,
-            timeout=40,  # 40 second timeout
-            cwd=rabin_dir
-        )
+        max_models = compare_settings()['max_models']
+        if len(models) < 2 or len(models) > max_models:
+            return jsonify({
+                'success': False,
+                'error': f'Select 2-{max_models} models to compare'
+            }), 400
         
-        # Log output for debugging
-        print(f"Script stdout: {result.stdout}")
-        print(f"Script stderr: {result.stderr}")
-        print(f"Return code: {result.returncode}")
+        if audio_file is not None:
+            # The upload was already spooled to disk (and validated) while the body was parsed
+            audio_file.stream.flush()
+            if len(getattr(audio_file.stream, '_head', b'')) < SIGNATURE_BYTES:
+                return jsonify({
+                    'success': False,
+                    'error': 'Audio file is empty or truncated'
+                }), 400
+            temp_wav_path = os.path.join(rabin_dir, f'temp_upload_{uuid.uuid4().hex}.wav')
+            failure = convert_recording(audio_file.stream.name, temp_wav_path)
+            if failure:
+                cleanup()
+                body, status = failure
+                return jsonify(body), status
+            # Transcribed once, before any model runs
+            args, overhead = ['audio', temp_wav_path], model_stats.audio_overhead_seconds()
+        else:
+            if not text:
+                return jsonify({
+                    'success': False,
+                    'error': 'No text or audio provided'
+                }), 400
+            args, overhead = ['text', text], 0
         
-        if result.returncode == 0:
-            return jsonify({
-                'success': True,
-                'message': 'Text processed successfully'
-            })
+        _, config = shared_state.get_config()
+        timeout = compare_timeout(models, (config.get('options') or {}).get('num_predict'), overhead)
+        job_id, _ = shared_state.start_job(request_job_id(), 'compare')
+        print(f"[COMPARE] Job {job_id}: {', '.join(models)} (timeout {timeout:.0f}s)", flush=True)
+        return stream_comparison(args, models, timeout, request_client(), job_id, cleanup)
+    
+    except RequestEntityTooLarge as e:
+        cleanup()
+        return upload_too_large(e)
+    except HTTPException as e:
+        cleanup()
+        return jsonify({
+            'success': False,
+            'error': e.description
+        }), e.code
+    except Exception as e:
+        cleanup()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def flush_log():
+    """Wait for the entries this worker has queued - clients read the history right after their answer"""
+    try:
+        get_log_writer(LOG_FILE).flush(timeout=5)
+    except LogWriteError as e:
+        print(f"[LOG] {e}", flush=True)
+
+@app.route('/api/conversation', methods=['GET'])
+def get_conversation():
+    """Get the conversation log (active segment, add ?archives=1 for full history, ?limit=N for the last N)"""
+    try:
+        include_archives = request.args.get('archives', '').lower() in ('1', 'true', 'yes')
+        limit = request.args.get('limit', type=int)
+        flush_log()
+        
+        if limit and not include_archives:
+            # Only reads the end of the file
+            entries = conversation_log.tail_entries(limit)
         else:
+            entries = conversation_log.read_entries(include_archives=include_archives)
+            if limit:
+                entries = entries[-limit:]
+        
+        return jsonify({
+            'success': True,
+            'entries': entries
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/conversation/search', methods=['GET'])
+def search_conversation():
+    """Full-text search over inputs and outputs (?q=...&page=1&per_page=20)"""
+    try:
+        query = request.args.get('q', '').strip()
+        
+        if not query:
             return jsonify({
                 'success': False,
-                'error': result.stderr or result.stdout or 'Processing failed'
-            }), 500
-            
-    except subprocess.TimeoutExpired:
+                'error': 'No query provided'
+            }), 400
+        
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        
+        flush_log()
+        results = conversation_index.search(query, page=page, per_page=per_page)
+        
+        return jsonify({
+            'success': True,
+            **results
+        })
+    except Exception as e:
         return jsonify({
             'success': False,
-            'error': 'התגובה לקחה יותר מדי זמן (40 שניות). נסה שוב או החלף מודל מהיר יותר בהגדרות.'
+            'error': str(e)
         }), 500
+
+@app.route('/api/metrics/resources', methods=['GET'])
+def get_resource_metrics():
+    """CPU thread budget: running and queued transcription/generation phases, wait times"""
+    try:
+        return jsonify({
+            'success': True,
+            'resources': get_governor().snapshot()
+        })
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-@app.route('/api/conversation', methods=['GET'])
-def get_conversation():
-    """Get the conversation log"""
+@app.route('/api/metrics/models', methods=['GET'])
+def get_model_metrics():
+    """Learned time to first token / tokens per second per model, and the timeout each gets"""
     try:
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # Parse the conversation log
-            entries = []
-            blocks = content.split('=' * 50)
-            
-            for block in blocks:
-                if block.strip():
-                    lines = block.strip().split('\n')
-                    entry = {}
-                    current_field = None
-                    
-                    for line in lines:
-                        if ' input:' in line:
-                            entry['input_timestamp'] = line.split(' input:')[0]
-                            current_field = 'input'
-                            entry['input'] = ''
-                        elif ' output:' in line:
-                            entry['output_timestamp'] = line.split(' output:')[0]
-                            current_field = 'output'
-                            entry['output'] = ''
-                        elif line.startswith('זמן תגובה:'):
-                            # Extract response time
-                            entry['response_time'] = line.replace('זמן תגובה:', '').strip()
-                            current_field = None
-                        elif line.startswith('תצורה:'):
-                            # Extract config
-                            entry['config'] = line.replace('תצורה:', '').strip()
-                            current_field = None
-                        elif current_field:
-                            # Preserve newlines by adding \n instead of space
-                            if entry[current_field]:
-                                entry[current_field] += '\n' + line
-                            else:
-                                entry[current_field] = line
-                    
-                    if 'input' in entry and 'output' in entry:
-                        entries.append(entry)
-            
-            return jsonify({
-                'success': True,
-                'entries': entries
-            })
-        else:
+        _, config = shared_state.get_config()
+        return jsonify({
+            'success': True,
+            'latency': model_stats.snapshot((config.get('options') or {}).get('num_predict'))
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/metrics/memory', methods=['GET'])
+def get_memory_metrics():
+    """Resident Whisper/Ollama models and estimated memory use against the budget"""
+    try:
+        return jsonify({
+            'success': True,
+            'memory': get_memory_manager().snapshot()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """Stored request profiles, newest first"""
+    try:
+        return jsonify({
+            'success': True,
+            'profiles': profiling.list_profiles()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Spans and top functions of one profiled request"""
+    try:
+        profile = profiling.load_profile(profile_id, top=request.args.get('top', profiling.TOP_FUNCTIONS, type=int))
+        if profile is None:
             return jsonify({
-                'success': True,
-                'entries': []
-            })
+                'success': False,
+                'error': 'Profile not found'
+            }), 404
+        return jsonify({
+            'success': True,
+            'profile': profile
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/profiles/<profile_id>/<process>.prof', methods=['GET'])
+def download_profile(profile_id, process):
+    """Raw cProfile stats of one process (open with pstats or snakeviz)"""
+    path = profiling.profile_file(profile_id, process)
+    if path is None:
+        return jsonify({
+            'success': False,
+            'error': 'Profile not found'
+        }), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f"{profile_id}-{process}.prof")
+
+@app.route('/api/metrics/scheduler', methods=['GET'])
+def get_scheduler_metrics():
+    """Pipeline slots per lane in this worker: running, queued and queue wait times,
+    and the coalesced runs in flight with the requests waiting on them"""
+    try:
+        return jsonify({
+            'success': True,
+            'scheduler': pipeline_scheduler.snapshot(),
+            'coalescing': pipeline_calls.in_flight()
+        })
     except Exception as e:
         return jsonify({
             'success': False,
@@ -352,25 +1026,19 @@ def get_models():
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
-    """Get current model configuration from runtime config"""
+    """Get current model configuration (and its version) from the shared state"""
     try:
-        ensure_runtime_config()  # Make sure it exists
-        
-        if os.path.exists(CONFIG_RUNTIME_FILE):
-            with open(CONFIG_RUNTIME_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-        else:
-            return jsonify({
-                'success': False,
-                'error': 'Configuration file not found'
-            }), 500
+        version, config = shared_state.get_config()
         
         # Add descriptions
         config['options_descriptions'] = OPTIONS_DESCRIPTIONS
+        # Sent back on save so concurrent edits are detected
+        config['version'] = version
         
         return jsonify({
             'success': True,
-            'config': config
+            'config': config,
+            'version': version
         })
     except Exception as e:
         return jsonify({
@@ -380,7 +1048,7 @@ def get_config():
 
 @app.route('/api/config', methods=['POST'])
 def save_config():
-    """Save model configuration to runtime config"""
+    """Save model configuration as a new version (rejected if edited from an older version)"""
     try:
         data = request.get_json()
         
@@ -390,15 +1058,42 @@ def save_config():
                 'error': 'No data provided'
             }), 400
         
-        # Save to RUNTIME config file only
-        with open(CONFIG_RUNTIME_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        version = shared_state.save_config(data, expected_version=data.get('version'))
+        
+        print(f"[CONFIG] Updated runtime (version {version}): model={data.get('model')}, options={data.get('options')}", flush=True)
         
-        print(f"[CONFIG] Updated runtime: model={data.get('model')}, options={data.get('options')}", flush=True)
+        return jsonify({
+            'success': True,
+            'message': 'Configuration saved',
+            'version': version
+        })
+    except ConfigConflict as e:
+        return jsonify({
+            'success': False,
+            'error': 'ההגדרות שונו במקום אחר מאז שנטענו. טען אותן מחדש ונסה שוב.',
+            'version': e.current_version
+        }), 409
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/config/version', methods=['GET'])
+def get_config_version():
+    """Current config version; with ?since=N&wait=S, waits up to S seconds for a newer one"""
+    try:
+        since = request.args.get('since', type=int)
+        wait = min(max(request.args.get('wait', 0, type=float), 0), 60)
+        if since is not None and wait:
+            version = shared_state.wait_for_config_change(since, wait)
+        else:
+            version = shared_state.config_version()
         
         return jsonify({
             'success': True,
-            'message': 'Configuration saved'
+            'version': version,
+            'changed': since is not None and version != since
         })
     except Exception as e:
         return jsonify({
@@ -408,7 +1103,7 @@ def save_config():
 
 @app.route('/api/config/reset', methods=['POST'])
 def reset_config():
-    """Reset configuration to defaults by copying config.json → config_runtime.json"""
+    """Reset configuration to defaults by saving config.json as a new version"""
     try:
         if not os.path.exists(CONFIG_DEFAULT_FILE):
             return jsonify({
@@ -416,19 +1111,90 @@ def reset_config():
                 'error': 'Default config file (config.json) not found'
             }), 500
         
-        # Copy defaults from config.json to config_runtime.json
-        import shutil
-        shutil.copy2(CONFIG_DEFAULT_FILE, CONFIG_RUNTIME_FILE)
+        shared_state.reset_config()
+        version, reset_config = shared_state.get_config()
+        reset_config['options_descriptions'] = OPTIONS_DESCRIPTIONS
+        reset_config['version'] = version
         
-        # Read and return the reset config
-        with open(CONFIG_RUNTIME_FILE, 'r', encoding='utf-8') as f:
-            reset_config = json.load(f)
-        
-        print(f"[CONFIG] Reset to defaults from config.json", flush=True)
+        print(f"[CONFIG] Reset to defaults from config.json (version {version})", flush=True)
         
         return jsonify({
             'success': True,
-            'config': reset_config
+            'config': reset_config,
+            'version': version
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Recent pipeline jobs from every worker (?limit=N, default 50)"""
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        return jsonify({
+            'success': True,
+            'jobs': shared_state.recent_jobs(limit)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status (and result once finished) of one pipeline job"""
+    try:
+        job = shared_state.get_job(job_id)
+        if job is None:
+            return jsonify({
+                'success': False,
+                'error': 'Job not found'
+            }), 404
+        return jsonify({
+            'success': True,
+            'job': job
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a running job: its pipeline stops Whisper/Ollama and nothing is logged.
+    `job_id` may also be the X-Request-Id of a caller attached to a shared run - if
+    other callers are still attached, only that caller is detached (gets 499)"""
+    try:
+        caller_id = job_id
+        job_id = shared_state.caller_job(caller_id) or caller_id
+        job = shared_state.get_job(job_id)
+        if job is None:
+            return jsonify({
+                'success': False,
+                'error': 'Job not found'
+            }), 404
+        if job['status'] == 'running' and shared_state.attached_callers(job_id, exclude=caller_id):
+            shared_state.detach_caller(caller_id)
+            print(f"[CANCEL] Caller {caller_id} detached from job {job_id} (others still waiting)", flush=True)
+            return jsonify({
+                'success': True,
+                'detached': True,
+                'job': job
+            })
+        if not shared_state.cancel_job(job_id, CANCELLED_STATUS, CANCELLED_BODY):
+            return jsonify({
+                'success': False,
+                'error': f"Job already {job['status']}"
+            }), 409
+        print(f"[CANCEL] Job {job_id} cancelled by the client", flush=True)
+        return jsonify({
+            'success': True,
+            'job': shared_state.get_job(job_id)
         })
     except Exception as e:
         return jsonify({
@@ -438,10 +1204,13 @@ def reset_config():
 
 @app.route('/api/conversation/clear', methods=['POST'])
 def clear_conversation():
-    """Delete conversation.txt to clear chat history"""
+    """Delete conversation.txt and its archives to clear chat history"""
     try:
-        if os.path.exists(LOG_FILE):
-            os.remove(LOG_FILE)
+        # Queued entries would otherwise land in the cleared log
+        flush_log()
+        if conversation_log.clear():
+            # Don't leave the cleared entries searchable until the next refresh notices
+            conversation_index.reset()
             print(f"[CONVERSATION] Cleared conversation history", flush=True)
             message = 'Conversation history cleared'
         else:
@@ -458,4 +1227,6 @@ def clear_conversation():
         }), 500
 
 if __name__ == '__main__':
+    # Development server (reloader + debugger). For production use:
+    #   gunicorn -c gunicorn.conf.py
     app.run(debug=True, port=5001, host='0.0.0.0')
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark: full-read log parsing vs. reverse tail reading on a large conversation log
+
+Usage: python bench_log_tail.py [size_mb] [entries]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from conversation_log import SEPARATOR, parse_entries, tail_entries
+
+
+def build_log(path, size_mb):
+    """Write a synthetic log of roughly size_mb megabytes"""
+    entry = (
+        "19-10-26 10:00:00 input:\nמה זה פוטוסינתזה?\n\n"
+        "19-10-26 10:00:00 output:\nהגדרה קצרה:\nפוטוסינתזה היא תהליך שבו צמחים מייצרים סוכר מאור.\n\n"
+        "הסבר:\nהתהליך מתרחש בכלורופלסטים. הוא משתמש במים ובפחמן דו-חמצני. התוצר הלוואי הוא חמצן.\n\n"
+        "זמן תגובה: 4.2 שניות\nתצורה: מודל: gemma2:9b | טמפרטורה: 0.5 | דגימה: 0.9 | מילים: 30\n\n"
+        f"{SEPARATOR}\n\n"
+    )
+    target = size_mb * 1024 * 1024
+    block = (entry * 1000).encode('utf-8')
+    written = 0
+    with open(path, 'wb') as f:
+        while written < target:
+            f.write(block)
+            written += len(block)
+    return written
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def full_read(path, count):
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_entries(f.read())[-count:]
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'conversation.txt')
+        print(f"Building {size_mb} MB log...")
+        size = build_log(path, size_mb)
+
+        tail, tail_time = timed(tail_entries, path, count)
+        full, full_time = timed(full_read, path, count)
+
+        assert tail == full, "tail reader returned different entries than a full parse"
+
+        print("=" * 60)
+        print(f"Log size:        {size / (1024 * 1024):.1f} MB")
+        print(f"Entries loaded:  {count}")
+        print(f"Full read:       {full_time * 1000:10.1f} ms")
+        print(f"Tail read:       {tail_time * 1000:10.1f} ms")
+        print(f"Speedup:         {full_time / max(tail_time, 1e-9):10.0f}x")
+        print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Cancellation of a pipeline run from the server
+
+Killing the pipeline subprocess isn't enough: the Ollama generation (and the
+Whisper decode) it started would keep running for nobody while the next
+request queues behind it. Instead the server hands each run its job id and
+deadline through the environment (RABIN_JOB_ID, RABIN_DEADLINE), and the
+pipeline checks a CancelToken between Whisper segments and between streamed
+tokens. A cancelled run closes the Ollama stream - which stops generation -
+and exits with EXIT_CANCELLED, without writing to the conversation log.
+
+A run is cancelled when its deadline passes or when its job is marked
+cancelled in the shared state (the cancel endpoint, or the client
+disconnecting). The shared state is polled at most every CHECK_INTERVAL.
+"""
+import os
+import time
+
+JOB_ENV = 'RABIN_JOB_ID'
+DEADLINE_ENV = 'RABIN_DEADLINE'
+EXIT_CANCELLED = 3
+CHECK_INTERVAL = 0.25
+
+
+class Cancelled(Exception):
+    """The run was cancelled; reason is 'deadline' or 'cancelled'"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    def __init__(self, job_id=None, deadline=None):
+        self.job_id = job_id
+        self.deadline = deadline
+        self._checked = 0.0
+        self._reason = None
+
+    def reason(self):
+        """Why the run should stop, or None to keep going"""
+        if self._reason is None and self.deadline is not None and time.time() >= self.deadline:
+            self._reason = 'deadline'
+        if self._reason is None and self.job_id and time.monotonic() - self._checked >= CHECK_INTERVAL:
+            self._checked = time.monotonic()
+            from shared_state import get_shared_state
+            if get_shared_state().job_cancelled(self.job_id):
+                self._reason = 'cancelled'
+        return self._reason
+
+    def check(self):
+        """Raise Cancelled if the run should stop"""
+        reason = self.reason()
+        if reason:
+            raise Cancelled(reason)
+
+
+_token = None
+
+
+def current():
+    """CancelToken of this pipeline run, from the environment the server set"""
+    global _token
+    if _token is None:
+        deadline = os.environ.get(DEADLINE_ENV)
+        _token = CancelToken(os.environ.get(JOB_ENV) or None, float(deadline) if deadline else None)
+    return _token
+
+
+def pipeline_env(job_id, deadline, env=None):
+    """Environment for a pipeline subprocess carrying its job id and deadline"""
+    env = dict(env if env is not None else os.environ)
+    if job_id:
+        env[JOB_ENV] = job_id
+    env[DEADLINE_ENV] = f"{deadline:.3f}"
+    return env
+
+
+def checked(items, token=None):
+    """Iterate items (e.g. lazily decoded Whisper segments), checking for cancellation before each"""
+    token = token or current()
+    for item in items:
+        token.check()
+        yield item
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Comparison mode: one question to several models at once
+
+process_compare.py runs the models concurrently - as many at a time as the
+capacity allows - so a comparison takes about as long as its slowest model
+instead of the sum of all of them. Capacity, from the "compare" config
+section and the existing budgets:
+
+    max_parallel         - never more models at once than this
+    memory budget        - the largest models running together must fit
+                           "memory.budget_mb" (see memory_manager)
+    CPU budget           - the generate threads are split between the
+                           concurrent models, at least min_threads each
+
+Ollama itself must allow it too: OLLAMA_MAX_LOADED_MODELS and
+OLLAMA_NUM_PARALLEL bound what it loads and runs at the same time.
+"""
+from settings import load_settings
+
+DEFAULT_MAX_MODELS = 4
+DEFAULT_MAX_PARALLEL = 3
+DEFAULT_MIN_THREADS = 2
+
+
+def compare_settings():
+    settings = load_settings('compare')
+    return {
+        'max_models': settings.get('max_models', DEFAULT_MAX_MODELS),
+        'max_parallel': settings.get('max_parallel', DEFAULT_MAX_PARALLEL),
+        'min_threads': settings.get('min_threads', DEFAULT_MIN_THREADS),
+    }
+
+
+def parallel_limit(models):
+    """How many of `models` can generate at the same time"""
+    from memory_manager import get_memory_manager
+    from resource_governor import get_governor
+
+    settings = compare_settings()
+    limit = max(1, min(len(models), settings['max_parallel']))
+
+    memory = get_memory_manager()
+    if memory.budget_mb:
+        sizes = sorted((memory.ollama_model_mb(model) or 0 for model in models), reverse=True)
+        while limit > 1 and sum(sizes[:limit]) > memory.budget_mb:
+            limit -= 1
+
+    generate_threads = get_governor().threads['generate']
+    return max(1, min(limit, generate_threads // settings['min_threads']))
+
+
+def thread_share(parallel):
+    """num_thread for each of `parallel` concurrent generations"""
+    from resource_governor import get_governor
+    return max(1, get_governor().threads['generate'] // parallel)
+
+
+def compare_timeout(models, num_predict=None, overhead_seconds=0):
+    """Seconds to allow a comparison: models run in waves of parallel_limit(),
+    each wave as long as its slowest model (learned timeouts, see model_stats)"""
+    from model_stats import get_model_stats
+
+    stats = get_model_stats()
+    parallel = parallel_limit(models)
+    timeouts = sorted((stats.timeout(model, num_predict) for model in models), reverse=True)
+    waves = [timeouts[i:i + parallel] for i in range(0, len(timeouts), parallel)]
+    return round(overhead_seconds + sum(max(wave) for wave in waves), 1)
+
+
+def comparison_line(results):
+    """Log line with every model's latency and token rate side by side"""
+    parts = []
+    for model, result in results.items():
+        if result.get('error'):
+            parts.append(f"{model} שגיאה")
+        else:
+            stats = result['stats']
+            parts.append(f"{model} {result['seconds']} שניות, {stats['tokens_per_second']} טוקנים/שנייה, "
+                         f"טוקן ראשון {stats['time_to_first_token']} שניות")
+    return "השוואה: " + " | ".join(parts)
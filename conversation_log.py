@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Conversation log storage with size/age based rotation into gzip archives
+
+Writers go through LogWriter, which owns the file for its process: callers
+push framed records onto a queue and one background thread appends them in
+batches under the cross-process lock, with a configurable fsync policy.
+
+Pipelines started by the server don't write at all: write_entry() hands the
+entry back on stdout (RABIN_LOG_HANDOFF is set) and the server queues it on
+its own long-lived writer, so entries from concurrent requests share batches
+and a request only pays for the queue push.
+"""
+import atexit
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+from offload import run_blocking
+from settings import load_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows - rotation still works, just without the lock
+    fcntl = None
+
+DEFAULT_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversation.txt")
+
+SEPARATOR = '=' * 50
+
+# Rotation defaults (overridable via the "log" section in config_runtime.json)
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024  # 5 MB active segment
+DEFAULT_MAX_AGE_DAYS = 30
+
+# Writer defaults (same "log" section): fsync "always" (every record),
+# "batch" (once per batch) or "never" (leave it to the OS)
+FSYNC_POLICIES = ('always', 'batch', 'never')
+DEFAULT_FSYNC = 'batch'
+DEFAULT_BATCH_MAX_RECORDS = 64
+DEFAULT_BATCH_LINGER_MS = 5
+
+# Set by the server for its pipelines: log entries go back on stdout, prefixed
+LOG_HANDOFF_ENV = 'RABIN_LOG_HANDOFF'
+LOG_RECORD_PREFIX = 'LOG_RECORD '
+
+RECORD_END = f"\n{SEPARATOR}\n\n"
+
+
+def parse_entries(content):
+    """Parse log text into a list of entry dicts (input, output, timestamps, metrics)"""
+    entries = []
+    for block in content.split(SEPARATOR):
+        entry = parse_block(block)
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def parse_block(block):
+    """Parse a single log block, returns None if it has no input/output pair"""
+    if not block.strip():
+        return None
+
+    entry = {}
+    current_field = None
+
+    for line in block.strip().split('\n'):
+        if ' input:' in line:
+            entry['input_timestamp'] = line.split(' input:')[0]
+            current_field = 'input'
+            entry['input'] = ''
+        elif ' output:' in line:
+            entry['output_timestamp'] = line.split(' output:')[0]
+            current_field = 'output'
+            entry['output'] = ''
+        elif line.startswith('זמן תגובה:'):
+            entry['response_time'] = line.replace('זמן תגובה:', '').strip()
+            current_field = None
+        elif line.startswith('תצורה:'):
+            entry['config'] = line.replace('תצורה:', '').strip()
+            current_field = None
+        elif line.startswith('עצירה מוקדמת:'):
+            entry['early_stop'] = line.replace('עצירה מוקדמת:', '').strip()
+            current_field = None
+        elif line.startswith('השוואה:'):
+            entry['comparison'] = line.replace('השוואה:', '').strip()
+            current_field = None
+        elif current_field:
+            # Preserve newlines by adding \n instead of space
+            if entry[current_field]:
+                entry[current_field] += '\n' + line
+            else:
+                entry[current_field] = line
+
+    if 'input' in entry and 'output' in entry:
+        return entry
+    return None
+
+
+def tail_entries(path, count, chunk_size=64 * 1024):
+    """
+    Parse only the last `count` entries of a log file.
+
+    Reads backwards from the end in chunk_size steps until enough separators
+    have been seen, so the cost depends on `count`, not on the file size.
+    """
+    if count <= 0 or not os.path.exists(path):
+        return []
+
+    separator = SEPARATOR.encode('utf-8')
+    overlap = len(separator) - 1
+    # count blocks need count + 1 separators (the first block found may be partial)
+    needed = count + 1
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        found = 0
+
+        while True:
+            if found >= needed or position == 0:
+                blocks = data.split(separator)
+                if position > 0:
+                    blocks = blocks[1:]  # may begin mid-block / mid-character
+                entries = []
+                for block in blocks:
+                    entry = parse_block(block.decode('utf-8', errors='replace'))
+                    if entry:
+                        entries.append(entry)
+                if len(entries) >= count or position == 0:
+                    return entries[-count:]
+                # Some blocks had no input/output pair - keep reading
+                needed += count - len(entries)
+
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            chunk = f.read(read_size)
+            # Only scan the new bytes, plus an overlap for a separator split across chunks
+            found += (chunk + data[:overlap]).count(separator)
+            data = chunk + data
+
+
+def frame_record(log_entry):
+    """Make sure a record ends with its own separator so it can't run into the next one"""
+    if log_entry.rstrip().endswith(SEPARATOR):
+        return log_entry.rstrip() + '\n\n'
+    return log_entry.rstrip() + '\n' + RECORD_END
+
+
+def compact(content):
+    """Drop empty blocks and collapse whitespace runs between blocks"""
+    blocks = [b.strip() for b in content.split(SEPARATOR) if b.strip()]
+    return ''.join(f"{b}\n\n{SEPARATOR}\n\n" for b in blocks)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class ConversationLog:
+    """
+    Append-only conversation log that keeps the active file small.
+
+    When the active file grows past max_bytes, or its first entry is older
+    than max_age_days, it is compacted and moved into <name>_archive/ as a
+    dated .txt.gz segment. manifest.json in the archive folder lists every
+    segment (oldest first) so readers can find history without scanning.
+    """
+
+    def __init__(self, path=DEFAULT_LOG_FILE, max_bytes=None, max_age_days=None):
+        settings = load_settings('log')
+        self.path = path
+        self.max_bytes = max_bytes if max_bytes is not None else settings.get('rotate_max_bytes', DEFAULT_MAX_BYTES)
+        self.max_age_days = max_age_days if max_age_days is not None else settings.get('rotate_max_age_days', DEFAULT_MAX_AGE_DAYS)
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        self.archive_dir = os.path.join(os.path.dirname(path), f"{stem}_archive")
+        self.manifest_path = os.path.join(self.archive_dir, 'manifest.json')
+        self.lock_path = path + '.lock'
+        self.stem = stem
+
+    # --- locking -----------------------------------------------------------
+
+    def _lock(self):
+        f = open(self.lock_path, 'a')
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _unlock(self, f):
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    # --- manifest ----------------------------------------------------------
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception:
+                pass
+        return {'segments': [], 'active_started': None}
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    # --- writing -----------------------------------------------------------
+
+    def append(self, log_entry):
+        """Append one formatted entry synchronously (see LogWriter for the queued path)"""
+        self.append_batch([log_entry])
+
+    def append_batch(self, records, fsync=DEFAULT_FSYNC):
+        """Append several entries under one lock, rotating the active segment first if needed"""
+        lock = self._lock()
+        try:
+            manifest = self.load_manifest()
+            if self._should_rotate(manifest):
+                self._rotate(manifest)
+            if not os.path.exists(self.path) or not manifest.get('active_started'):
+                manifest['active_started'] = time.time()
+                self._save_manifest(manifest)
+
+            records = [frame_record(record).encode('utf-8') for record in records]
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # A crash mid-write leaves a torn last record - fence it off so it
+                # doesn't swallow the first record of this batch
+                if not self._ends_cleanly(fd):
+                    records[0] = RECORD_END.encode('utf-8') + records[0]
+                if fsync == 'always':
+                    for record in records:
+                        _write_all(fd, record)
+                        os.fsync(fd)
+                else:
+                    _write_all(fd, b''.join(records))
+                    if fsync == 'batch':
+                        os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            self._unlock(lock)
+
+    def _ends_cleanly(self, fd):
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return True
+        tail = RECORD_END.encode('utf-8')
+        if size < len(tail):
+            return False
+        with open(self.path, 'rb') as f:
+            f.seek(size - len(tail))
+            return f.read() == tail
+
+    def _should_rotate(self, manifest):
+        if not os.path.exists(self.path):
+            return False
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return False
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        started = manifest.get('active_started')
+        if self.max_age_days and started:
+            return time.time() - started >= self.max_age_days * 86400
+        return False
+
+    def rotate(self):
+        """Force rotation of the active segment into the archive"""
+        lock = self._lock()
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                self._rotate(self.load_manifest())
+        finally:
+            self._unlock(lock)
+
+    def _rotate(self, manifest):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            content = compact(f.read())
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        started = manifest.get('active_started') or os.path.getmtime(self.path)
+        ended = time.time()
+        name = f"{self.stem}.{datetime.fromtimestamp(ended).strftime('%Y%m%d-%H%M%S')}.txt.gz"
+        archive_path = os.path.join(self.archive_dir, name)
+        # Two rotations within the same second - keep both segments
+        suffix = 1
+        while os.path.exists(archive_path):
+            archive_path = os.path.join(self.archive_dir, name.replace('.txt.gz', f'-{suffix}.txt.gz'))
+            suffix += 1
+
+        with gzip.open(archive_path, 'wt', encoding='utf-8') as f:
+            f.write(content)
+
+        manifest.setdefault('segments', []).append({
+            'file': os.path.basename(archive_path),
+            'started': started,
+            'ended': ended,
+            'entries': len(parse_entries(content)),
+            'bytes': len(content.encode('utf-8')),
+            'compressed_bytes': os.path.getsize(archive_path),
+        })
+        manifest['active_started'] = None
+        self._save_manifest(manifest)
+        os.remove(self.path)
+        print(f"[LOG] Rotated {self.path} → {archive_path}", file=sys.stderr, flush=True)
+
+    def clear(self):
+        """Delete the active segment, all archives and the manifest"""
+        lock = self._lock()
+        try:
+            removed = False
+            if os.path.exists(self.path):
+                os.remove(self.path)
+                removed = True
+            manifest = self.load_manifest()
+            for segment in manifest.get('segments', []):
+                segment_path = os.path.join(self.archive_dir, segment['file'])
+                if os.path.exists(segment_path):
+                    os.remove(segment_path)
+                    removed = True
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+            return removed
+        finally:
+            self._unlock(lock)
+
+    # --- reading -----------------------------------------------------------
+
+    def read_active(self):
+        if not os.path.exists(self.path):
+            return ''
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def read_segment(self, segment_file):
+        """Decompressed text of one archived segment"""
+        with gzip.open(os.path.join(self.archive_dir, segment_file), 'rt', encoding='utf-8') as f:
+            return f.read()
+
+    def read_archives(self):
+        """Yield the text of each archived segment, oldest first"""
+        for segment in self.load_manifest().get('segments', []):
+            if os.path.exists(os.path.join(self.archive_dir, segment['file'])):
+                yield self.read_segment(segment['file'])
+
+    def tail_entries(self, count):
+        """Last `count` entries from the active segment without reading the whole file"""
+        return tail_entries(self.path, count)
+
+    def read_entries(self, include_archives=False):
+        """Parsed entries from the active segment (plus archives if requested), oldest first"""
+        entries = []
+        if include_archives:
+            for content in self.read_archives():
+                entries.extend(parse_entries(content))
+        entries.extend(parse_entries(self.read_active()))
+        return entries
+
+
+class LogWriteError(Exception):
+    """Records queued on a LogWriter could not be written"""
+
+
+class LogWriter:
+    """
+    Single writer for one conversation log in this process.
+
+    append() only puts the record on a queue; a daemon thread
+    drains the queue in batches (up to batch_max_records, waiting
+    batch_linger_ms for more to arrive) and writes each batch with one
+    ConversationLog.append_batch call (on a real OS thread under gevent, see
+    offload.py). flush() waits until everything queued
+    so far is on disk and raises LogWriteError if a batch failed.
+    on_batch, if set, is called on the writer thread after each written batch.
+    """
+
+    def __init__(self, conversation_log, fsync=None, batch_max_records=None, batch_linger_ms=None):
+        settings = load_settings('log')
+        self.log = conversation_log
+        self.fsync = fsync or settings.get('fsync', DEFAULT_FSYNC)
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {self.fsync!r}")
+        self.batch_max_records = batch_max_records or settings.get('batch_max_records', DEFAULT_BATCH_MAX_RECORDS)
+        linger_ms = batch_linger_ms if batch_linger_ms is not None else settings.get('batch_linger_ms', DEFAULT_BATCH_LINGER_MS)
+        self.batch_linger = linger_ms / 1000
+
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._enqueued = 0
+        self._done = 0
+        self._errors = []
+        self._thread = None
+        self.on_batch = None
+
+    def append(self, log_entry):
+        """Queue one entry for writing"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='conversation-log-writer', daemon=True)
+                self._thread.start()
+            self._enqueued += 1
+        self._queue.put(log_entry)
+
+    def flush(self, timeout=None):
+        """Wait until every record queued so far has been written"""
+        with self._cond:
+            target = self._enqueued
+            if not self._cond.wait_for(lambda: self._done >= target, timeout):
+                raise LogWriteError(f"timed out writing {target - self._done} record(s) to {self.log.path}")
+            if self._errors:
+                errors, self._errors = self._errors, []
+                raise LogWriteError(f"failed to write {sum(n for n, _ in errors)} record(s) to {self.log.path}: {errors[-1][1]}")
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_linger
+            while len(batch) < self.batch_max_records:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # flock, fsync and rotation block - under gevent the writer is a greenlet
+                run_blocking(self.log.append_batch, batch, self.fsync)
+            except Exception as e:
+                print(f"[LOG] Failed to write {len(batch)} record(s) to {self.log.path}: {e}", file=sys.stderr, flush=True)
+                with self._cond:
+                    self._errors.append((len(batch), e))
+            else:
+                if self.on_batch is not None:
+                    try:
+                        self.on_batch()
+                    except Exception as e:
+                        print(f"[LOG] on_batch failed for {self.log.path}: {e}", file=sys.stderr, flush=True)
+            with self._cond:
+                self._done += len(batch)
+                self._cond.notify_all()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(path=DEFAULT_LOG_FILE):
+    """Process-wide LogWriter for the log at `path`"""
+    path = os.path.abspath(path)
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = LogWriter(ConversationLog(path))
+        return _writers[path]
+
+
+def write_entry(log_entry, path=DEFAULT_LOG_FILE):
+    """Log one entry: hand it back on stdout if the parent process owns the
+    writer (LOG_HANDOFF_ENV), else queue it on this process's LogWriter"""
+    if os.environ.get(LOG_HANDOFF_ENV):
+        record = {'path': os.path.abspath(path), 'entry': log_entry}
+        print(LOG_RECORD_PREFIX + json.dumps(record, ensure_ascii=False), file=sys.stdout, flush=True)
+    else:
+        get_log_writer(path).append(log_entry)
+
+
+def handoff_env(env=None):
+    """Environment for a pipeline subprocess that hands its log entries back"""
+    env = dict(env if env is not None else os.environ)
+    env[LOG_HANDOFF_ENV] = '1'
+    return env
+
+
+def take_log_record(line, allowed_paths):
+    """Queue a record handed back by a pipeline on this process's writer.
+    Returns False if the line isn't one - a malformed record, or one for a
+    log outside allowed_paths, is left as ordinary output with a warning"""
+    if not line.startswith(LOG_RECORD_PREFIX):
+        return False
+    try:
+        record = json.loads(line[len(LOG_RECORD_PREFIX):])
+        path, log_entry = os.path.abspath(record['path']), record['entry']
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"[LOG] Ignoring malformed log record: {e!r}", file=sys.stderr, flush=True)
+        return False
+    if path not in {os.path.abspath(allowed) for allowed in allowed_paths} or not isinstance(log_entry, str):
+        print(f"[LOG] Ignoring log record for {path}: not a log this process writes", file=sys.stderr, flush=True)
+        return False
+    get_log_writer(path).append(log_entry)
+    return True
+
+
+def take_log_records(output, allowed_paths):
+    """Queue every record in a pipeline's stdout, returns the output without them"""
+    return ''.join(
+        line for line in (output or '').splitlines(keepends=True)
+        if not take_log_record(line, allowed_paths)
+    )
+
+
+@atexit.register
+def _flush_writers():
+    # Standalone scripts exit right after queueing their entry
+    for writer in list(_writers.values()):
+        try:
+            writer.flush()
+        except LogWriteError as e:
+            print(f"[LOG] {e}", file=sys.stderr, flush=True)
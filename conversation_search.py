@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Full-text search over the conversation log with a Hebrew-aware inverted index
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+
+from conversation_log import SEPARATOR, ConversationLog, parse_block, parse_entries
+
+# Niqqud and cantillation marks (keeps maqaf U+05BE, paseq U+05C0, sof pasuq U+05C3, nun hafukha U+05C6)
+NIQQUD = '\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7'
+NIQQUD_RE = re.compile(f'[{NIQQUD}]')
+# Geresh/gershayim and quotes inside words (צ'יפס, ארה"ב) are dropped, not split on
+TOKEN_RE = re.compile(f'[\\w{NIQQUD}\'"׳״]+')
+QUOTES_RE = re.compile('[\'"׳״_]')
+
+FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+PREFIXES = 'והבלמש'
+# The conjunction ו can come before one more prefix ("והבית", "ובבית")
+CONJUNCTION = 'ו'
+MIN_STEM_LENGTH = 3
+
+# Weight of a match on a prefix-stripped form vs. the exact word
+STEM_WEIGHT = 0.5
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+SNIPPET_RADIUS = 60
+
+
+def normalize_hebrew(word):
+    """Strip niqqud and quotes, lowercase, and unify final letters"""
+    word = NIQQUD_RE.sub('', word)
+    word = QUOTES_RE.sub('', word)
+    return word.lower().translate(FINAL_LETTERS)
+
+
+def strip_prefixes(word):
+    """Forms of `word` without its leading prefix letter (or ו plus one more), longest first.
+
+    Many roots start with one of these letters ("שלום", "ביום"), so callers
+    only use a form that also occurs as a word of its own.
+    """
+    stems = []
+    for i in range(2):
+        if len(word) - (i + 1) < MIN_STEM_LENGTH or word[i] not in PREFIXES:
+            break
+        stems.append(word[i + 1:])
+        if word[i] != CONJUNCTION:
+            break
+    return stems
+
+
+def tokenize(text):
+    """Yield (normalized word, start, end) for every word in the original text"""
+    for match in TOKEN_RE.finditer(text):
+        word = normalize_hebrew(match.group())
+        if word:
+            yield word, match.start(), match.end()
+
+
+def query_terms(query, vocabulary):
+    """Map each term to its weight: exact words weigh 1, prefix-stripped forms
+    STEM_WEIGHT - only those found as whole words in `vocabulary`"""
+    terms = {}
+    for word, _, _ in tokenize(query):
+        terms[word] = max(terms.get(word, 0), 1.0)
+        for stem in strip_prefixes(word):
+            if stem in vocabulary:
+                terms.setdefault(stem, STEM_WEIGHT)
+    return terms
+
+
+def make_snippet(text, terms):
+    """Short excerpt around the first matching word, with highlight offsets inside it"""
+    spans = []
+    for word, start, end in tokenize(text):
+        if word in terms:
+            spans.append((start, end))
+    if not spans:
+        return None
+
+    first_start = spans[0][0]
+    snippet_start = max(0, first_start - SNIPPET_RADIUS)
+    snippet_end = min(len(text), first_start + SNIPPET_RADIUS * 2)
+    # Don't cut words in half
+    while snippet_start > 0 and not text[snippet_start - 1].isspace():
+        snippet_start -= 1
+    while snippet_end < len(text) and not text[snippet_end].isspace():
+        snippet_end += 1
+
+    prefix = '…' if snippet_start > 0 else ''
+    suffix = '…' if snippet_end < len(text) else ''
+    offset = len(prefix) - snippet_start
+    highlights = [[s + offset, e + offset] for s, e in spans if s >= snippet_start and e <= snippet_end]
+
+    return {
+        'text': prefix + text[snippet_start:snippet_end].replace('\n', ' ') + suffix,
+        'highlights': highlights,
+    }
+
+
+class ConversationIndex:
+    """
+    Inverted index over conversation inputs and outputs.
+
+    Archived segments are indexed once; the active segment is followed by
+    byte offset, so refresh() only parses entries appended since the last
+    call. Rotation and clearing are detected from the manifest.
+    """
+
+    def __init__(self, conversation_log=None):
+        self.log = conversation_log or ConversationLog()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.docs = []  # doc_id -> entry dict
+        self.doc_lengths = []
+        self.postings = {}  # term -> {doc_id: term frequency}
+        self.total_length = 0
+        self._keys = set()
+        self._segments = []  # archived segment files already indexed
+        self._offset = 0  # bytes of the active segment already indexed
+        self._active_id = None
+
+    # --- indexing ----------------------------------------------------------
+
+    def add_entry(self, entry):
+        """Index a single parsed entry (duplicates of already indexed entries are skipped)"""
+        key = hashlib.sha1('\0'.join(
+            entry.get(field, '') for field in ('input_timestamp', 'output_timestamp', 'input', 'output')
+        ).encode('utf-8')).hexdigest()
+        if key in self._keys:
+            return
+        self._keys.add(key)
+
+        doc_id = len(self.docs)
+        self.docs.append(entry)
+
+        frequencies = {}
+        length = 0
+        for field in ('input', 'output'):
+            for word, _, _ in tokenize(entry.get(field, '')):
+                length += 1
+                frequencies[word] = frequencies.get(word, 0) + 1
+
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+        self.doc_lengths.append(length)
+        self.total_length += length
+
+    def reset(self):
+        """Drop everything indexed (after the log was cleared); the next refresh() starts over"""
+        with self._lock:
+            self._reset()
+
+    def refresh(self):
+        """Bring the index up to date with the log, indexing only new entries"""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        segments = [segment['file'] for segment in self.log.load_manifest().get('segments', [])]
+        active_id = None
+        size = 0
+        if os.path.exists(self.log.path):
+            stat = os.stat(self.log.path)
+            active_id = (stat.st_dev, stat.st_ino)
+            size = stat.st_size
+
+        # The active file was replaced or truncated without a new archive segment
+        rotated = len(segments) > len(self._segments)
+        replaced = active_id != self._active_id or size < self._offset
+        cleared = segments[:len(self._segments)] != self._segments or (
+            self._active_id is not None and replaced and not rotated
+        )
+        if cleared:
+            self._reset()
+
+        for segment_file in segments[len(self._segments):]:
+            if os.path.exists(os.path.join(self.log.archive_dir, segment_file)):
+                # Entries already indexed from the active file are skipped as duplicates
+                for entry in parse_entries(self.log.read_segment(segment_file)):
+                    self.add_entry(entry)
+            self._segments.append(segment_file)
+
+        if active_id is None:
+            self._offset = 0
+            self._active_id = None
+            return
+
+        if replaced:
+            # Rotated into a new active file - the old entries came in via the new segment
+            self._offset = 0
+            self._active_id = active_id
+
+        if size == self._offset:
+            return
+
+        separator = SEPARATOR.encode('utf-8')
+        with open(self.log.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        # Only consume complete blocks; a block still being written is picked up next time
+        end = data.rfind(separator)
+        if end < 0:
+            return
+        for block in data[:end].split(separator):
+            entry = parse_block(block.decode('utf-8', errors='replace'))
+            if entry:
+                self.add_entry(entry)
+        self._offset += end + len(separator)
+
+    # --- searching ---------------------------------------------------------
+
+    def search(self, query, page=1, per_page=20):
+        """BM25-ranked entries matching `query`, newest first on equal score"""
+        with self._lock:
+            self._refresh()
+            terms = query_terms(query, self.postings)
+            total_docs = len(self.docs)
+            if not terms or not total_docs:
+                return {'total': 0, 'page': page, 'per_page': per_page, 'results': []}
+
+            average_length = self.total_length / total_docs or 1
+            scores = {}
+            for term, weight in terms.items():
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self.doc_lengths[doc_id] / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0) + weight * idf * frequency * (K1 + 1) / (frequency + norm)
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+            start = (page - 1) * per_page
+            results = []
+            for doc_id, score in ranked[start:start + per_page]:
+                entry = self.docs[doc_id]
+                results.append({
+                    **entry,
+                    'score': round(score, 4),
+                    'snippets': {
+                        'input': make_snippet(entry.get('input', ''), terms),
+                        'output': make_snippet(entry.get('output', ''), terms),
+                    },
+                })
+
+            return {'total': len(ranked), 'page': page, 'per_page': per_page, 'results': results}
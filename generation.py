@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Shared Ollama generation step for the text and audio pipelines
+
+Streams the answer so a FormatValidator can stop generation as soon as the
+required structure is complete, and measures what that saved. The stream is
+also closed when the run is cancelled (see cancellation). Every run feeds the
+model's latency stats, which may lower num_predict to meet the latency target
+or the run's deadline (see model_stats).
+"""
+import sys
+import time
+
+import cancellation
+from memory_manager import get_memory_manager
+from model_loader import get_ollama
+from model_stats import DEFAULT_NUM_PREDICT, get_model_stats
+from resource_governor import get_governor
+from response_format import FormatValidator, load_format_settings
+
+
+def chat(model_name, messages, options, context=None, cancel=None, on_piece=None):
+    """
+    Stream a chat completion from Ollama.
+
+    Returns (ai_response, stats). When the system context uses the structured
+    answer format, the stream is closed as soon as the format is complete -
+    Ollama stops generating when the client disconnects. The same happens
+    when `cancel` (default: this run's CancelToken) fires, raising Cancelled.
+    on_piece(text) is called with every streamed piece.
+    """
+    cancel = cancel or cancellation.current()
+    sections = load_format_settings(context)
+    validator = FormatValidator(sections) if sections else None
+
+    start_time = time.time()
+    first_token_time = None
+    content = ''
+    chunks = 0
+    final = None
+    stopped_early = False
+
+    # Fixed num_thread (changing it makes Ollama reload the model) within the generate budget
+    governor = get_governor()
+    options = dict(options)
+    options.setdefault('num_thread', governor.threads['generate'])
+
+    memory = get_memory_manager()
+
+    # Concurrent generations (comparison mode) each pass their share as num_thread
+    with governor.acquire('generate', options['num_thread']):
+        queued_seconds = time.time() - start_time
+        cancel.check()
+        # Fit the answer in the latency target and the time left before the deadline
+        num_predict, capped_by = get_model_stats().plan_num_predict(
+            model_name, options.get('num_predict') or DEFAULT_NUM_PREDICT, cancel.deadline)
+        if capped_by:
+            options['num_predict'] = num_predict
+            print(f"⏱️  num_predict הוגבל ל-{num_predict} ({capped_by})", file=sys.stderr)
+        # Unload other idle models first if loading this one would exceed the memory budget
+        memory.prepare_ollama(model_name)
+        memory.touch(model_name)
+        stream = get_ollama().chat(model=model_name, messages=messages, options=options, stream=True,
+                                   keep_alive=memory.keep_alive(model_name))
+        try:
+            for chunk in stream:
+                piece = chunk['message']['content']
+                if piece:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    chunks += 1
+                    content += piece
+                    if on_piece:
+                        on_piece(piece)
+                if chunk.get('done'):
+                    final = chunk
+                if validator and piece and validator.feed(piece):
+                    stopped_early = True
+                    break
+                cancel.check()
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+            memory.touch(model_name)
+            # Cancelled and early-stopped runs still tell us the model's speed
+            if first_token_time is not None:
+                _learn(model_name, start_time + queued_seconds, first_token_time, final, chunks)
+
+    end_time = time.time()
+    # Ollama reports exact counts in the final chunk; when we stop early we count chunks (~1 token each)
+    tokens = final.get('eval_count') if final and final.get('eval_count') else chunks
+    generation_seconds = end_time - (first_token_time or start_time)
+    tokens_per_second = tokens / generation_seconds if generation_seconds > 0 else 0
+
+    stats = {
+        'tokens': tokens,
+        'queued_seconds': round(queued_seconds, 2),
+        'time_to_first_token': round((first_token_time or end_time) - start_time - queued_seconds, 2),
+        'generation_seconds': round(generation_seconds, 2),
+        'tokens_per_second': round(tokens_per_second, 1),
+        'stopped_early': stopped_early,
+    }
+    if capped_by:
+        stats['num_predict_capped'] = {'num_predict': num_predict, 'by': capped_by}
+
+    if validator:
+        stats['format'] = validator.report()
+    if stopped_early:
+        content = validator.final_text()
+        # Upper bound: the model could have kept going until num_predict
+        budget = options.get('num_predict')
+        if budget and budget > tokens:
+            stats['tokens_saved_max'] = budget - tokens
+            stats['seconds_saved_max'] = round(stats['tokens_saved_max'] / tokens_per_second, 1) if tokens_per_second else None
+        print(f"✂️  עצירה מוקדמת אחרי {tokens} טוקנים - הפורמט הושלם", file=sys.stderr)
+
+    return content.strip(), stats
+
+
+def _learn(model_name, request_time, first_token_time, final, chunks):
+    """Record time to first token and token rate (Ollama's own counts when the stream finished)"""
+    if final and final.get('eval_count') and final.get('eval_duration'):
+        tokens, eval_seconds = final['eval_count'], final['eval_duration'] / 1e9
+    else:
+        tokens, eval_seconds = chunks, time.time() - first_token_time
+    try:
+        get_model_stats().record(model_name, first_token_time - request_time, tokens, eval_seconds)
+    except Exception as e:
+        print(f"⚠️  שמירת סטטיסטיקת המודל נכשלה: {e}", file=sys.stderr)
+
+
+def early_stop_line(stats):
+    """Log line describing an early stop (empty if generation ran to the end)"""
+    if not stats.get('stopped_early'):
+        return ''
+    line = f"עצירה מוקדמת: {stats['tokens']} טוקנים"
+    if stats.get('tokens_saved_max'):
+        line += f" (נחסכו עד {stats['tokens_saved_max']} טוקנים"
+        if stats.get('seconds_saved_max'):
+            line += f", ~{stats['seconds_saved_max']} שניות"
+        line += ")"
+    return line + "\n"
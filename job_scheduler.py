@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Weighted fair scheduling of pipeline runs into a fixed number of slots
+
+A single FIFO semaphore makes a typed question on gemma2 wait behind audio
+uploads and 45-second deepseek runs. Instead each request is queued in a
+lane by type ("text", "audio", "record", "compare") and tagged (start-time fair queuing)
+
+    start  = max(virtual time, previous finish of this lane+client)
+    finish = start + cost / lane weight
+
+Free slots go to the smallest finish tag, and virtual time advances to the
+start tag of each admitted job. Lightly weighted lanes and expensive models
+(cost from "model_costs") therefore get a proportionally smaller share, and
+every client is its own flow - a burst from one client can't starve the
+others in the same lane. A lane can also reserve slots that other lanes never
+fill, keeping interactive text latency low while long runs hold the rest.
+
+Wait times are recorded per lane; see snapshot().
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from settings import load_settings
+
+DEFAULT_LANES = {
+    'text': {'weight': 4, 'reserved': 1},
+    'audio': {'weight': 2, 'reserved': 0},
+    'record': {'weight': 1, 'reserved': 0},
+    'compare': {'weight': 1, 'reserved': 0},
+}
+DEFAULT_MODEL_COSTS = {
+    'deepseek-r1:14b': 6,
+    'llama3.3:70b': 20,
+}
+DEFAULT_COST = 1.0
+MAX_FLOWS = 1000
+
+
+class _Ticket:
+    __slots__ = ('lane', 'client', 'cost', 'start', 'finish', 'seq', 'enqueued')
+
+    def __init__(self, lane, client, cost, start, finish, seq):
+        self.lane = lane
+        self.client = client
+        self.cost = cost
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+
+class FairScheduler:
+    """Admits at most `slots` concurrent jobs, choosing among waiters by weighted fair queuing"""
+
+    def __init__(self, slots, lanes=None, model_costs=None, default_cost=DEFAULT_COST):
+        self.slots = max(1, slots)
+        self.lanes = {name: {'weight': 1, 'reserved': 0, **lane} for name, lane in (lanes or DEFAULT_LANES).items()}
+        # Reservations can never take every slot - at least one stays shared
+        reserved = sum(lane['reserved'] for lane in self.lanes.values())
+        if reserved >= self.slots:
+            for lane in self.lanes.values():
+                lane['reserved'] = 0
+        self.model_costs = model_costs if model_costs is not None else DEFAULT_MODEL_COSTS
+        self.default_cost = default_cost
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._running = {name: 0 for name in self.lanes}
+        self._virtual_time = 0.0
+        self._flow_finish = {}
+        self._seq = 0
+        self._stats = {name: {'admitted': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0} for name in self.lanes}
+
+    def cost(self, model=None):
+        """Relative cost of one run on `model`"""
+        return self.model_costs.get(model, self.default_cost) if model else self.default_cost
+
+    # --- admission ---------------------------------------------------------
+
+    def _shared_capacity(self):
+        return self.slots - sum(lane['reserved'] for lane in self.lanes.values())
+
+    def _can_start(self, lane):
+        if sum(self._running.values()) >= self.slots:
+            return False
+        if self._running[lane] < self.lanes[lane]['reserved']:
+            return True
+        shared_used = sum(max(0, running - self.lanes[name]['reserved']) for name, running in self._running.items())
+        return shared_used < self._shared_capacity()
+
+    def _next(self):
+        """The waiting ticket with the smallest finish tag among lanes that can start now"""
+        best = None
+        for ticket in self._queue:
+            if (best is None or (ticket.finish, ticket.seq) < (best.finish, best.seq)) and self._can_start(ticket.lane):
+                best = ticket
+        return best
+
+    @contextmanager
+    def slot(self, lane, client=None, cost=None):
+        """Wait for a slot in `lane` on behalf of `client`. Yields the seconds spent queued"""
+        if lane not in self.lanes:
+            raise ValueError(f"unknown lane {lane!r}")
+        cost = self.default_cost if cost is None else cost
+
+        with self._cond:
+            flow = (lane, client)
+            start = max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+            finish = start + cost / self.lanes[lane]['weight']
+            self._flow_finish[flow] = finish
+            self._seq += 1
+            ticket = _Ticket(lane, client, cost, start, finish, self._seq)
+            self._queue.append(ticket)
+
+            try:
+                while self._next() is not ticket:
+                    self._cond.wait()
+            except BaseException:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+                raise
+
+            self._queue.remove(ticket)
+            self._running[lane] += 1
+            # Virtual time follows the start tag of the job entering service
+            self._virtual_time = max(self._virtual_time, ticket.start)
+            waited = time.monotonic() - ticket.enqueued
+            self._record(lane, waited)
+            self._prune_flows()
+            # Another lane may still fit (e.g. a reserved slot) - let its waiters re-check
+            self._cond.notify_all()
+
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                self._running[lane] -= 1
+                self._cond.notify_all()
+
+    def _record(self, lane, waited):
+        stats = self._stats[lane]
+        stats['admitted'] += 1
+        stats['wait_seconds'] += waited
+        stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+
+    def _prune_flows(self):
+        # Flows that finished before the current virtual time start from it anyway
+        if len(self._flow_finish) > MAX_FLOWS:
+            self._flow_finish = {flow: finish for flow, finish in self._flow_finish.items() if finish > self._virtual_time}
+
+    # --- reporting ---------------------------------------------------------
+
+    def snapshot(self):
+        """Per-lane running/queued counts and queue wait statistics"""
+        with self._cond:
+            now = time.monotonic()
+            lanes = {}
+            for name, lane in self.lanes.items():
+                stats = self._stats[name]
+                waiting = [now - t.enqueued for t in self._queue if t.lane == name]
+                lanes[name] = {
+                    'weight': lane['weight'],
+                    'reserved': lane['reserved'],
+                    'running': self._running[name],
+                    'queued': len(waiting),
+                    'oldest_wait_seconds': round(max(waiting), 2) if waiting else 0,
+                    'admitted': stats['admitted'],
+                    'avg_wait_seconds': round(stats['wait_seconds'] / stats['admitted'], 3) if stats['admitted'] else 0,
+                    'max_wait_seconds': round(stats['max_wait_seconds'], 3),
+                }
+            return {'slots': self.slots, 'running': sum(self._running.values()), 'lanes': lanes}
+
+
+def scheduler_from_settings(slots):
+    """FairScheduler configured from the "scheduler" config section"""
+    settings = load_settings('scheduler')
+    return FairScheduler(
+        slots,
+        # Configured lanes override the defaults; lanes added since the config was written keep theirs
+        lanes={**DEFAULT_LANES, **(settings.get('lanes') or {})},
+        model_costs=settings.get('model_costs', DEFAULT_MODEL_COSTS),
+        default_cost=settings.get('default_cost', DEFAULT_COST),
+    )
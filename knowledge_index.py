@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Retrieval over a folder of local knowledge files
+
+Instead of pasting domain material into the system context (and paying for
+it on every call), the .txt/.md files under knowledge/ are split into
+chunks, embedded once with a local Ollama embedding model and kept in a
+vector index. Each question then gets only its top-k chunks injected.
+
+The index lives in .knowledge_index/:
+    vectors.f32  - float32 matrix (capacity x dim), memory-mapped with NumPy
+    meta.json    - embedder, dimension, row count and per-file chunk rows
+
+Updates are incremental: files are re-chunked only when their size/mtime and
+content hash change; their old rows are marked free and reused. A model (or
+dimension) change rebuilds from scratch. Refreshes take an flock, so the
+server's pipeline subprocesses share one index.
+
+Questions don't rescan the folder: meta.json records the folder's directory
+mtimes and when it was last scanned. A request only refreshes when a
+directory changed (a file was added, removed or renamed), or when the last
+scan is older than "refresh_seconds" (in-place edits).
+
+    python knowledge_index.py build            # (re)index the folder
+    python knowledge_index.py search "שאלה"    # show the top-k chunks
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from conversation_search import tokenize
+from settings import load_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows - no cross-process lock
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+KNOWLEDGE_DIR = os.path.join(BASE_DIR, 'knowledge')
+INDEX_DIR = os.path.join(BASE_DIR, '.knowledge_index')
+
+FILE_EXTENSIONS = ('.txt', '.md')
+DEFAULT_EMBED_MODEL = 'nomic-embed-text'
+DEFAULT_CHUNK_CHARS = 800
+DEFAULT_CHUNK_OVERLAP = 150
+DEFAULT_TOP_K = 3
+DEFAULT_MIN_SCORE = 0.3
+DEFAULT_REFRESH_SECONDS = 60
+EMBED_BATCH = 32
+INITIAL_CAPACITY = 256
+HASH_DIM = 256
+
+CONTEXT_HEADER = "מידע רלוונטי מתוך מאגר הידע (השתמש בו רק אם הוא נוגע לשאלה):"
+
+
+def chunk_text(text, chunk_chars=DEFAULT_CHUNK_CHARS, overlap=DEFAULT_CHUNK_OVERLAP):
+    """Split text into chunks of up to chunk_chars on paragraph boundaries.
+    Consecutive chunks share up to `overlap` trailing characters for context."""
+    paragraphs = [p.strip() for p in text.replace('\r\n', '\n').split('\n\n') if p.strip()]
+    pieces = []
+    for paragraph in paragraphs:
+        # Paragraphs longer than a chunk are cut on whitespace
+        while len(paragraph) > chunk_chars:
+            cut = paragraph.rfind(' ', 0, chunk_chars)
+            if cut <= 0:
+                cut = chunk_chars
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > chunk_chars:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap else ''
+            # Start the overlap on a word boundary
+            if tail and ' ' in tail:
+                tail = tail[tail.index(' ') + 1:]
+            current = f"{tail}\n\n{piece}" if tail and len(tail) + len(piece) + 2 <= chunk_chars else piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class OllamaEmbedder:
+    """Embeddings from a local Ollama embedding model"""
+
+    def __init__(self, model=DEFAULT_EMBED_MODEL):
+        self.model = model
+        self.name = f"ollama:{model}"
+
+    def embed(self, texts):
+        from model_loader import get_ollama
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH):
+            response = get_ollama().embed(model=self.model, input=texts[i:i + EMBED_BATCH])
+            vectors.extend(response['embeddings'])
+        return vectors
+
+
+class HashEmbedder:
+    """Deterministic stub embedder: signed feature hashing of normalized words.
+
+    Needs no model, so the index can be built and tested offline; it matches
+    on shared words only, not meaning."""
+
+    def __init__(self, dim=HASH_DIM):
+        self.dim = dim
+        self.name = f"hash:{dim}"
+
+    def embed(self, texts):
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dim
+            for word, _, _ in tokenize(text):
+                digest = hashlib.md5(word.encode('utf-8')).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dim
+                vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+            vectors.append(vector)
+        return vectors
+
+
+def make_embedder(settings):
+    if settings.get('embedder') == 'hash':
+        return HashEmbedder()
+    return OllamaEmbedder(settings.get('embed_model') or DEFAULT_EMBED_MODEL)
+
+
+class KnowledgeIndex:
+    """Chunked, embedded knowledge files with top-k cosine search"""
+
+    def __init__(self, knowledge_dir=None, index_dir=INDEX_DIR, embedder=None, settings=None):
+        self.settings = settings if settings is not None else load_settings('knowledge')
+        self.knowledge_dir = knowledge_dir or self.settings.get('dir') or KNOWLEDGE_DIR
+        if not os.path.isabs(self.knowledge_dir):
+            self.knowledge_dir = os.path.join(BASE_DIR, self.knowledge_dir)
+        self.index_dir = index_dir
+        self.vectors_file = os.path.join(index_dir, 'vectors.f32')
+        self.meta_file = os.path.join(index_dir, 'meta.json')
+        self.lock_file = os.path.join(index_dir, 'index.lock')
+        self.embedder = embedder or make_embedder(self.settings)
+        self.chunk_chars = self.settings.get('chunk_chars') or DEFAULT_CHUNK_CHARS
+        self.chunk_overlap = self.settings.get('chunk_overlap', DEFAULT_CHUNK_OVERLAP)
+        self.top_k = self.settings.get('top_k') or DEFAULT_TOP_K
+        self.min_score = self.settings.get('min_score', DEFAULT_MIN_SCORE)
+        self.refresh_seconds = self.settings.get('refresh_seconds', DEFAULT_REFRESH_SECONDS)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        lock = open(self.lock_file, 'a')
+        try:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _empty_meta(self, dim):
+        return {'embedder': self.embedder.name, 'dim': dim, 'capacity': 0, 'rows': 0, 'free': [], 'files': {}}
+
+    def load_meta(self):
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_meta(self, meta):
+        tmp_path = self.meta_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_file)
+
+    def _open_vectors(self, meta, mode='r'):
+        import numpy as np
+        return np.memmap(self.vectors_file, dtype=np.float32, mode=mode, shape=(meta['capacity'], meta['dim']))
+
+    def _grow(self, meta, needed):
+        """Extend the matrix file so at least `needed` rows fit (doubling)"""
+        capacity = max(meta['capacity'], INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        if capacity != meta['capacity']:
+            with open(self.vectors_file, 'ab') as f:
+                f.truncate(capacity * meta['dim'] * 4)
+            meta['capacity'] = capacity
+
+    def _source_files(self):
+        """({relative path: path} of the knowledge files, {relative dir: mtime} of the folders)"""
+        files = {}
+        dirs = {}
+        if not os.path.isdir(self.knowledge_dir):
+            return files, dirs
+        for root, _, names in os.walk(self.knowledge_dir):
+            dirs[os.path.relpath(root, self.knowledge_dir)] = os.stat(root).st_mtime
+            for name in sorted(names):
+                if name.lower().endswith(FILE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, self.knowledge_dir)] = path
+        return files, dirs
+
+    def is_stale(self, meta):
+        """Whether refresh() could find changes: a folder's mtime moved, or the
+        last scan is older than refresh_seconds. Only stats the folders"""
+        if meta is None or meta['embedder'] != self.embedder.name or not meta.get('dirs'):
+            return True
+        if time.time() - meta.get('refreshed_at', 0) >= self.refresh_seconds:
+            return True
+        for rel, mtime in meta['dirs'].items():
+            try:
+                if os.stat(os.path.join(self.knowledge_dir, rel)).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self):
+        """Bring the index up to date with the folder. Returns counts of indexed/removed files"""
+        import numpy as np
+
+        sources, dirs = self._source_files()
+        with self._locked():
+            meta = self.load_meta()
+            if meta and (meta['embedder'] != self.embedder.name or not os.path.exists(self.vectors_file)):
+                meta = None  # different model - old vectors aren't comparable
+            if meta is None and os.path.exists(self.vectors_file):
+                os.remove(self.vectors_file)
+
+            known = meta['files'] if meta else {}
+            changed = {}
+            for rel, path in sources.items():
+                stat = os.stat(path)
+                entry = known.get(rel)
+                if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    continue
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    text = f.read()
+                digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                if entry and entry['sha256'] == digest:
+                    # Touched but unchanged - just remember the new mtime
+                    entry['mtime'] = stat.st_mtime
+                    changed[rel] = None
+                    continue
+                changed[rel] = (stat, digest, chunk_text(text, self.chunk_chars, self.chunk_overlap))
+            removed = [rel for rel in known if rel not in sources]
+
+            if not changed and not removed and meta is not None:
+                meta.update(dirs=dirs, refreshed_at=time.time())
+                self._save_meta(meta)
+                return {'indexed': 0, 'removed': 0}
+
+            to_embed = [(rel, chunk) for rel, item in changed.items() if item for chunk in item[2]]
+            vectors = self.embedder.embed([chunk for _, chunk in to_embed]) if to_embed else []
+            if meta is None:
+                dim = len(vectors[0]) if vectors else getattr(self.embedder, 'dim', None)
+                if dim is None:
+                    return {'indexed': 0, 'removed': 0}
+                meta = self._empty_meta(dim)
+
+            # Free the rows of changed and deleted files before reusing them
+            for rel in removed + [rel for rel, item in changed.items() if item]:
+                entry = meta['files'].pop(rel, None)
+                if entry:
+                    meta['free'].extend(chunk['row'] for chunk in entry['chunks'])
+
+            self._grow(meta, meta['rows'] + max(0, len(vectors) - len(meta['free'])))
+            matrix = self._open_vectors(meta, mode='r+')
+            free = sorted(meta['free'], reverse=True)
+            for (rel, chunk), vector in zip(to_embed, vectors):
+                if free:
+                    row = free.pop()
+                else:
+                    row = meta['rows']
+                    meta['rows'] += 1
+                vector = np.asarray(vector, dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                matrix[row] = vector / norm if norm else vector
+                if rel not in meta['files']:
+                    stat, digest, _ = changed[rel]
+                    meta['files'][rel] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest, 'chunks': []}
+                meta['files'][rel]['chunks'].append({'row': row, 'text': chunk})
+            # Files whose new content produced no chunks (emptied) are still tracked
+            for rel, item in changed.items():
+                if item and rel not in meta['files']:
+                    stat, digest, _ = item
+                    meta['files'][rel] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest, 'chunks': []}
+            for row in free:
+                matrix[row] = 0  # zero rows never score above min_score
+            meta['free'] = sorted(free)
+            matrix.flush()
+            del matrix
+            meta.update(dirs=dirs, refreshed_at=time.time())
+            self._save_meta(meta)
+            return {'indexed': sum(1 for item in changed.values() if item), 'removed': len(removed)}
+
+    def search(self, question, top_k=None):
+        """Top-k chunks for `question` as [{'file', 'text', 'score'}], best first"""
+        import numpy as np
+
+        meta = self.load_meta()
+        if not meta or not meta['rows']:
+            return []
+        query = np.asarray(self.embedder.embed([question])[0], dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if not norm:
+            return []
+
+        rows = {}
+        for rel, entry in meta['files'].items():
+            for chunk in entry['chunks']:
+                rows[chunk['row']] = (rel, chunk['text'])
+
+        matrix = self._open_vectors(meta)[:meta['rows']]
+        scores = matrix @ (query / norm)
+        k = min(top_k or self.top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        results = []
+        for row in sorted(best, key=lambda r: -scores[r]):
+            row = int(row)
+            if row in rows and scores[row] >= self.min_score:
+                rel, text = rows[row]
+                results.append({'file': rel, 'text': text, 'score': round(float(scores[row]), 3)})
+        return results
+
+
+def knowledge_messages(question):
+    """System message with the chunks relevant to `question`, as a list (empty if none).
+
+    Retrieval is best effort - a missing folder, embedding model or NumPy just
+    means the question is answered without it."""
+    settings = load_settings('knowledge')
+    if not settings.get('enabled', True):
+        return []
+    index = KnowledgeIndex(settings=settings)
+    if not os.path.isdir(index.knowledge_dir):
+        return []
+    try:
+        # Usually just a few directory stats - the folder is rescanned only when it may have changed
+        if index.is_stale(index.load_meta()):
+            index.refresh()
+        results = index.search(question)
+    except Exception as e:
+        print(f"⚠️  אחזור ממאגר הידע נכשל: {e}", file=sys.stderr)
+        return []
+    if not results:
+        return []
+    print(f"📚 נמצאו {len(results)} קטעים רלוונטיים במאגר הידע ({', '.join(r['file'] for r in results)})", file=sys.stderr)
+    passages = "\n\n---\n\n".join(f"[{r['file']}]\n{r['text']}" for r in results)
+    return [{'role': 'system', 'content': f"{CONTEXT_HEADER}\n\n{passages}"}]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ('build', 'search') or (sys.argv[1] == 'search' and len(sys.argv) < 3):
+        print("שימוש: python knowledge_index.py build | search <שאלה>", file=sys.stderr)
+        sys.exit(1)
+
+    index = KnowledgeIndex()
+    counts = index.refresh()
+    print(f"✓ עודכנו {counts['indexed']} קבצים, הוסרו {counts['removed']} ({index.knowledge_dir})", file=sys.stderr)
+    if sys.argv[1] == 'search':
+        for result in index.search(sys.argv[2]):
+            print(f"\n[{result['score']}] {result['file']}\n{result['text']}")
@@ -1,12 +1,14 @@
-import ollama
-from faster_whisper import WhisperModel
 import speech_recognition as sr
 from datetime import datetime
 import os
+import sys
 
-# 1. טעינת מודל השמיעה (לוקאלי)
-model_size = "base" # אפשר לשנות ל-medium לדיוק גבוה יותר בעברית
-model = WhisperModel(model_size, device="cpu", compute_type="int8")
+# Shared modules live in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversation_log import get_log_writer
+from model_loader import get_ollama, get_whisper_model
+
+# 1. מודל השמיעה (לוקאלי) נטען בשימוש הראשון - ראה model_loader.py
 
 def listen_and_process():
     r = sr.Recognizer()
@@ -19,12 +21,12 @@ def listen_and_process():
             f.write(audio.get_wav_data())
 
     # 2. המרה לטקסט
-    segments, _ = model.transcribe("temp.wav", language="he")
+    segments, _ = get_whisper_model().transcribe("temp.wav", language="he")
     user_text = " ".join([seg.text for seg in segments])
     print(f"זיהיתי: {user_text}")
 
     # 3. שליחה ל-Ollama
-    response = ollama.chat(model='gemma2:9b', messages=[
+    response = get_ollama().chat(model='gemma2:9b', messages=[
         {'role': 'user', 'content': user_text},
     ])
     
@@ -38,11 +40,12 @@ def listen_and_process():
     
     log_entry = f"{timestamp_input} input: {user_text}\n{timestamp_output} output: {ai_response}\n\n"
     
-    # Write to same directory as the script
+    # Write to same directory as the script, through the single log writer
     script_dir = os.path.dirname(os.path.abspath(__file__))
     log_path = os.path.join(script_dir, "listen_conversation_log.txt")
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(log_entry)
+    writer = get_log_writer(log_path)
+    writer.append(log_entry)
+    writer.flush()
     
     print("✓ נשמר לקובץ listen_conversation_log.txt")
 
@@ -0,0 +1,85 @@
+"""
+Resident listener for the hands-free kiosk setup
+
+Unlike listen2_single.py (one utterance per process), this keeps the
+microphone stream and the Whisper model open and segments utterances
+continuously, so there is no model load, history read or ambient-noise
+calibration per question.
+
+Usage: python listen2_daemon.py
+"""
+import os
+import queue
+import sys
+
+import speech_recognition as sr
+
+# Shared modules live in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from memory_manager import get_memory_manager
+from model_loader import get_whisper_model, set_whisper_idle_seconds
+from listen2_single import make_recognizer, process_utterance
+
+# Utterances waiting for transcription/response; when full the oldest is dropped
+MAX_PENDING_UTTERANCES = 3
+
+# VAD: an utterance ends after this much silence (seconds)
+PAUSE_THRESHOLD = 0.8
+PHRASE_TIME_LIMIT = 15
+
+# Noise floor tracking - while nobody is speaking the energy threshold moves
+# towards (ambient energy * ratio), damped per audio buffer
+DYNAMIC_ENERGY_DAMPING = 0.15
+DYNAMIC_ENERGY_RATIO = 1.5
+
+
+def run():
+    pending = queue.Queue(maxsize=MAX_PENDING_UTTERANCES)
+
+    # Warm up the model once, before the first question - and keep it (its own idle setting)
+    set_whisper_idle_seconds(get_memory_manager().daemon_whisper_idle_seconds)
+    get_whisper_model()
+
+    r = make_recognizer()
+    r.pause_threshold = PAUSE_THRESHOLD
+    r.dynamic_energy_adjustment_damping = DYNAMIC_ENERGY_DAMPING
+    r.dynamic_energy_ratio = DYNAMIC_ENERGY_RATIO
+
+    microphone = sr.Microphone()
+    with microphone as source:
+        print("מכוון לרעש רקע (פעם אחת)...", file=sys.stderr)
+        r.adjust_for_ambient_noise(source, duration=1)
+
+    def on_utterance(recognizer, audio):
+        # Runs on the listener thread - hand off immediately so listening continues
+        try:
+            pending.put_nowait(audio.get_wav_data())
+        except queue.Full:
+            dropped = pending.get_nowait()
+            pending.put_nowait(audio.get_wav_data())
+            print(f"⚠️  תור מלא - דילגתי על קטע ישן ({len(dropped)} בתים)", file=sys.stderr)
+
+    # Opens the stream once and keeps it open until stop_listening()
+    stop_listening = r.listen_in_background(microphone, on_utterance, phrase_time_limit=PHRASE_TIME_LIMIT)
+    print(f"אני מקשיב ברציפות... (סף רעש: {r.energy_threshold:.0f}, Ctrl+C ליציאה)", file=sys.stderr)
+
+    try:
+        while True:
+            try:
+                wav_data = pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                process_utterance(wav_data)
+            except Exception as e:
+                print(f"שגיאה: {e}", file=sys.stderr)
+            print(f"אני מקשיב... (סף רעש: {r.energy_threshold:.0f})", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_listening(wait_for_stop=False)
+        print("הפסקתי להקשיב", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run()
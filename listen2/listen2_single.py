@@ -1,14 +1,20 @@
-import ollama
-from faster_whisper import WhisperModel
 import speech_recognition as sr
 from datetime import datetime
+import io
 import os
 import sys
 import re
 
-# 1. טעינת מודל השמיעה (לוקאלי)
-model_size = "base"
-model = WhisperModel(model_size, device="cpu", compute_type="int8")
+# Shared modules live in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cancellation import EXIT_CANCELLED, Cancelled, checked
+from conversation_log import ConversationLog, get_log_writer, write_entry
+from generation import chat
+from model_loader import get_whisper_model
+from record_settings import AMBIENT_NOISE_SECONDS, PHRASE_TIME_LIMIT, RECORD_MODEL, RECORD_NUM_PREDICT, SPEECH_START_TIMEOUT
+from resource_governor import get_governor
+
+# 1. מודל השמיעה (לוקאלי) נטען בשימוש הראשון - ראה model_loader.py
 
 # הגדרת ההקשר והיסטוריה
 context = """אתה עוזר אדיב ודברן המסייע להסביר מושגים. המשתמש יבקש ממך להסביר או להגדיר משהו, ואתה תיתן הסבר מפורט על המושג.
@@ -39,51 +45,21 @@ context = """אתה עוזר אדיב ודברן המסייע להסביר מו
 אחרי הלידה: יוצא השליה והתינוק מתחיל לנשום בעצמו."
 """
 
+# Log file in same directory as script (rotated into listen2_conversation_log_archive/)
+script_dir = os.path.dirname(os.path.abspath(__file__))
+conversation_log = ConversationLog(os.path.join(script_dir, "listen2_conversation_log.txt"))
+
 # Load history from log file
 def load_history_from_log(max_exchanges=5):
-    """Load the last N conversation exchanges from the log file"""
+    """Load the last N conversation exchanges from the active log segment"""
     history = []
     
-    # Get log file in same directory as script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    log_file = os.path.join(script_dir, "listen2_conversation_log.txt")
-    
-    if not os.path.exists(log_file):
-        return history
-    
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Split by separator
-        blocks = content.split('=' * 50)
-        
-        # Get last N blocks (each block is one exchange)
-        recent_blocks = [b for b in blocks if b.strip()][-max_exchanges:]
-        
-        for block in recent_blocks:
-            lines = block.strip().split('\n')
-            user_msg = None
-            ai_msg = None
-            current_field = None
-            
-            for line in lines:
-                if ' input:' in line:
-                    current_field = 'input'
-                    user_msg = ''
-                elif ' output:' in line:
-                    current_field = 'output'
-                    ai_msg = ''
-                elif current_field == 'input' and user_msg is not None:
-                    user_msg += line + '\n'
-                elif current_field == 'output' and ai_msg is not None:
-                    ai_msg += line + '\n'
-            
-            # Add to history
-            if user_msg and user_msg.strip():
-                history.append({'role': 'user', 'content': user_msg.strip()})
-            if ai_msg and ai_msg.strip():
-                history.append({'role': 'assistant', 'content': ai_msg.strip()})
+        for entry in conversation_log.tail_entries(max_exchanges):
+            if entry['input'].strip():
+                history.append({'role': 'user', 'content': entry['input'].strip()})
+            if entry['output'].strip():
+                history.append({'role': 'assistant', 'content': entry['output'].strip()})
         
         print(f"📖 טענתי {len(history)//2} חילופי דברים מההיסטוריה", file=sys.stderr)
         return history
@@ -92,37 +68,50 @@ def load_history_from_log(max_exchanges=5):
         print(f"⚠️  שגיאה בטעינת היסטוריה: {e}", file=sys.stderr)
         return history
 
-# Initialize conversation history with context and previous exchanges
-conversation_history = [{'role': 'system', 'content': context}]
-previous_history = load_history_from_log()
-conversation_history.extend(previous_history)
+# Conversation history (context + previous exchanges), loaded on first use
+conversation_history = None
 
-def listen_and_process():
-    global conversation_history
-    
+def make_recognizer():
+    """Recognizer with lenient, adaptive energy thresholds"""
     r = sr.Recognizer()
-    # Adjust for ambient noise and set more lenient thresholds
     r.energy_threshold = 300  # Lower threshold for quieter speech
     r.dynamic_energy_threshold = True
+    return r
+
+def listen_and_process():
+    r = make_recognizer()
     
     with sr.Microphone() as source:
         print("מכוון לרעש רקע...", file=sys.stderr)
-        r.adjust_for_ambient_noise(source, duration=1)
+        r.adjust_for_ambient_noise(source, duration=AMBIENT_NOISE_SECONDS)
         print("אני מקשיב... (דבר בעברית)", file=sys.stderr)
-        audio = r.listen(source, timeout=10, phrase_time_limit=15)
-        
-        # שמירת האודיו זמנית
-        with open("temp.wav", "wb") as f:
-            f.write(audio.get_wav_data())
+        audio = r.listen(source, timeout=SPEECH_START_TIMEOUT, phrase_time_limit=PHRASE_TIME_LIMIT)
+    
+    if not process_utterance(audio.get_wav_data()):
+        sys.exit(1)  # Exit with error code so backend knows it failed
+    
+    print("SUCCESS", file=sys.stdout)  # Signal success to backend
+    return True
 
-    # 2. המרה לטקסט
-    segments, _ = model.transcribe("temp.wav", language="he")
-    user_text = " ".join([seg.text for seg in segments]).strip()
+def process_utterance(wav_data):
+    """Transcribe one recorded utterance, get the AI response and log it.
+    Returns False if no speech was recognized."""
+    global conversation_history
+    
+    if conversation_history is None:
+        conversation_history = [{'role': 'system', 'content': context}]
+        conversation_history.extend(load_history_from_log())
+    
+    # 2. המרה לטקסט (ישירות מהזיכרון, בלי קובץ זמני)
+    with get_governor().acquire('transcribe'):
+        segments, _ = get_whisper_model().transcribe(io.BytesIO(wav_data), language="he")
+        # Segments decode lazily - a cancelled run stops between them
+        user_text = " ".join([seg.text for seg in checked(segments)]).strip()
     
     # בדיקה אם הקלט ריק
     if not user_text:
         print("⚠️  לא זיהיתי דיבור. נסה שוב...", file=sys.stderr)
-        sys.exit(1)  # Exit with error code so backend knows it failed
+        return False
     
     print(f"זיהיתי: {user_text}", file=sys.stderr)
 
@@ -135,21 +124,20 @@ def listen_and_process():
         conversation_history = [conversation_history[0]] + conversation_history[-10:]
 
     # 5. שליחה ל-Ollama עם ההיסטוריה המצומצמת
-    response = ollama.chat(
-        model='gemma2:9b',
-        messages=conversation_history,
-        options={
+    ai_response, _ = chat(
+        RECORD_MODEL,
+        conversation_history,
+        {
             'temperature': 0.6,
             'top_p': 0.9,
             'top_k': 40,
             'repeat_penalty': 1.2,
-            'num_predict': 800,
+            'num_predict': RECORD_NUM_PREDICT,
             'stop': ['\n\n\n\n\n'],
-        }
+        },
+        context
     )
     
-    ai_response = response['message']['content'].strip()
-    
     # Clean up excessive blank lines
     ai_response = re.sub(r'\n{3,}', '\n\n', ai_response)
     
@@ -165,23 +153,23 @@ def listen_and_process():
     
     log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{ai_response}\n\n{'='*50}\n\n"
     
-    # Write to same directory as the script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    log_path = os.path.join(script_dir, "listen2_conversation_log.txt")
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(log_entry)
+    # Handed to the server's writer, or queued on this process's (the daemon's) own
+    write_entry(log_entry, conversation_log.path)
     
     print("✓ נשמר לקובץ listen2_conversation_log.txt", file=sys.stderr)
-    print("SUCCESS", file=sys.stdout)  # Signal success to backend
     return True
 
 if __name__ == "__main__":
     try:
         result = listen_and_process()
+        get_log_writer(conversation_log.path).flush()
         if result:
             sys.exit(0)
         else:
             sys.exit(1)
+    except Cancelled as e:
+        print(f"🛑 הבקשה בוטלה ({e.reason})", file=sys.stderr)
+        sys.exit(EXIT_CANCELLED)
     except Exception as e:
         print(f"שגיאה: {e}", file=sys.stderr)
         sys.exit(1)
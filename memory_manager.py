@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Residency tracking and a memory budget for Whisper and the Ollama models
+
+An 8GB machine can't keep gemma2:9b, llama3.1, deepseek-r1:14b and Whisper
+loaded together. This keeps them within the "memory" config section:
+
+    budget_mb             - total for resident models (null = no limit, and
+                            no LRU unloading of Ollama models)
+    whisper_idle_seconds  - a Whisper model unused this long is unloaded by
+                            the process holding it (pipeline processes exit
+                            after one request, so this is for long-lived ones)
+    daemon_whisper_idle_seconds - the same for listen2_daemon.py, which keeps
+                            Whisper warm between questions (0 = never unload)
+    ollama_keep_alive     - sent with every request; Ollama unloads the
+                            model after this much idle time
+    keep_alive            - per-model overrides (e.g. short for deepseek)
+
+Before a model is loaded (Whisper in any process, or an Ollama model not
+currently resident), the least recently used other Ollama models are
+unloaded until the new one fits. Every generation records its model's last
+use in the shared state (Ollama's expires_at can't be compared across models
+with different keep_alive). Whisper residency is recorded per process in the
+shared state too; Ollama's own view comes from its /api/ps.
+
+Sizes are estimates: Ollama's size on disk, and a per-size table for
+Whisper at int8.
+"""
+import os
+import sys
+import threading
+
+from settings import load_settings
+
+DEFAULT_WHISPER_IDLE_SECONDS = 300
+# The daemon answers questions minutes apart - keep Whisper through a session, free it overnight
+DEFAULT_DAEMON_WHISPER_IDLE_SECONDS = 1800
+DEFAULT_OLLAMA_KEEP_ALIVE = '5m'
+
+# Approximate resident size of faster-whisper models with int8 weights
+WHISPER_MEMORY_MB = {
+    'tiny': 75,
+    'base': 150,
+    'small': 400,
+    'medium': 1000,
+    'large-v2': 2000,
+    'large-v3': 2000,
+}
+DEFAULT_WHISPER_MB = 500
+
+
+def process_rss_mb():
+    """Resident set size of this process (Linux), or None"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _field(item, name, default=None):
+    # The ollama client returns dicts in older versions and models in newer ones
+    try:
+        return item[name]
+    except (KeyError, TypeError):
+        return getattr(item, name, default)
+
+
+class MemoryManager:
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else load_settings('memory')
+        self.budget_mb = self.settings.get('budget_mb')
+        self.whisper_idle_seconds = self.settings.get('whisper_idle_seconds', DEFAULT_WHISPER_IDLE_SECONDS)
+        self.daemon_whisper_idle_seconds = self.settings.get('daemon_whisper_idle_seconds', DEFAULT_DAEMON_WHISPER_IDLE_SECONDS)
+        self._lock = threading.Lock()
+        self._model_sizes = {}
+
+    # --- Ollama ------------------------------------------------------------
+
+    def keep_alive(self, model_name):
+        """keep_alive to send with a request for model_name"""
+        return (self.settings.get('keep_alive') or {}).get(
+            model_name, self.settings.get('ollama_keep_alive', DEFAULT_OLLAMA_KEEP_ALIVE))
+
+    def ollama_resident(self):
+        """Models Ollama has loaded: [{'name', 'mb', 'vram_mb', 'expires_at'}], [] if unreachable"""
+        from model_loader import get_ollama
+        try:
+            models = _field(get_ollama().ps(), 'models') or []
+        except Exception:
+            return []
+        resident = []
+        for model in models:
+            expires_at = _field(model, 'expires_at')
+            resident.append({
+                'name': _field(model, 'model') or _field(model, 'name'),
+                'mb': round((_field(model, 'size') or 0) / (1024 * 1024)),
+                'vram_mb': round((_field(model, 'size_vram') or 0) / (1024 * 1024)),
+                'expires_at': expires_at.isoformat() if hasattr(expires_at, 'isoformat') else expires_at,
+            })
+        return resident
+
+    def ollama_model_mb(self, model_name):
+        """Estimated memory for model_name: its size on disk (cached), or None if unknown"""
+        if model_name not in self._model_sizes:
+            from model_loader import get_ollama
+            try:
+                for model in _field(get_ollama().list(), 'models') or []:
+                    name = _field(model, 'model') or _field(model, 'name')
+                    self._model_sizes[name] = round((_field(model, 'size') or 0) / (1024 * 1024))
+            except Exception:
+                return None
+        return self._model_sizes.get(model_name)
+
+    def touch(self, model_name):
+        """Record a use of model_name (for least-recently-used eviction)"""
+        from shared_state import get_shared_state
+        get_shared_state().touch_model(model_name)
+
+    def unload_ollama(self, model_name):
+        from model_loader import get_ollama
+        # An empty request with keep_alive=0 makes Ollama unload the model now
+        get_ollama().generate(model=model_name, keep_alive=0)
+        print(f"🧹 פינוי מודל {model_name} מהזיכרון", file=sys.stderr)
+
+    # --- budget ------------------------------------------------------------
+
+    def whisper_resident(self):
+        from shared_state import get_shared_state
+        return [m for m in get_shared_state().resident_models() if m['kind'] == 'whisper']
+
+    def used_mb(self, ollama=None):
+        ollama = self.ollama_resident() if ollama is None else ollama
+        return sum(m['mb'] for m in ollama) + sum(m['mb'] or 0 for m in self.whisper_resident())
+
+    def ensure_room(self, needed_mb, keep=None):
+        """Unload least recently used Ollama models (except `keep`) until needed_mb fits the budget"""
+        if not self.budget_mb or not needed_mb:
+            return
+        with self._lock:
+            from shared_state import get_shared_state
+            ollama = self.ollama_resident()
+            used = self.used_mb(ollama)
+            # Models loaded by anyone else (never used through us) go first
+            last_used = get_shared_state().model_last_used()
+            candidates = sorted((m for m in ollama if m['name'] != keep), key=lambda m: last_used.get(m['name'], 0))
+            for model in candidates:
+                if used + needed_mb <= self.budget_mb:
+                    break
+                try:
+                    self.unload_ollama(model['name'])
+                    used -= model['mb']
+                except Exception as e:
+                    print(f"⚠️  פינוי {model['name']} נכשל: {e}", file=sys.stderr)
+            if used + needed_mb > self.budget_mb:
+                print(f"⚠️  חריגה מתקציב הזיכרון: {used + needed_mb:.0f}MB מתוך {self.budget_mb}MB", file=sys.stderr)
+
+    def prepare_ollama(self, model_name):
+        """Make room for model_name if Ollama will have to load it"""
+        if not self.budget_mb:
+            return
+        if any(m['name'] == model_name for m in self.ollama_resident()):
+            return
+        self.ensure_room(self.ollama_model_mb(model_name), keep=model_name)
+
+    def prepare_whisper(self, model_size):
+        """Make room for a Whisper model about to be loaded. Returns its estimated size"""
+        mb = WHISPER_MEMORY_MB.get(model_size, DEFAULT_WHISPER_MB)
+        self.ensure_room(mb)
+        return mb
+
+    # --- reporting ---------------------------------------------------------
+
+    def snapshot(self):
+        """Resident models across processes and estimated use against the budget"""
+        from shared_state import get_shared_state
+        ollama = self.ollama_resident()
+        whisper = self.whisper_resident()
+        last_used = get_shared_state().model_last_used()
+        return {
+            'budget_mb': self.budget_mb,
+            'used_mb': sum(m['mb'] for m in ollama) + sum(m['mb'] or 0 for m in whisper),
+            'whisper_idle_seconds': self.whisper_idle_seconds,
+            'daemon_whisper_idle_seconds': self.daemon_whisper_idle_seconds,
+            'ollama': [{**m, 'keep_alive': self.keep_alive(m['name']), 'last_used': last_used.get(m['name'])}
+                       for m in ollama],
+            'whisper': whisper,
+            'process_rss_mb': process_rss_mb(),
+        }
+
+
+_manager = None
+
+
+def get_memory_manager():
+    """Process-wide MemoryManager"""
+    global _manager
+    if _manager is None:
+        _manager = MemoryManager()
+    return _manager
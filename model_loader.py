@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Lazy, on-first-use loading of the Whisper model and the Ollama client
+
+Importing this module is cheap - faster_whisper and ollama are only
+imported (and the Whisper weights only loaded) the first time they're used,
+so the text-only path and the server never pay for them. Processes holding
+Whisper unload it again after "memory.whisper_idle_seconds" idle (see
+set_whisper_idle_seconds for the listener daemon).
+"""
+import gc
+import sys
+import threading
+import time
+
+WHISPER_MODEL_SIZE = "base"  # אפשר לשנות ל-medium לדיוק גבוה יותר בעברית
+WHISPER_DEVICE = "cpu"
+WHISPER_COMPUTE_TYPE = "int8"
+
+_whisper_models = {}
+_whisper_last_used = {}
+_whisper_lock = threading.Lock()
+_reaper = None
+# None: "memory.whisper_idle_seconds"
+_whisper_idle_seconds = None
+
+
+def set_whisper_idle_seconds(seconds):
+    """Override the idle time after which this process unloads Whisper (0 = never).
+    Call before the model is first loaded"""
+    global _whisper_idle_seconds
+    _whisper_idle_seconds = seconds
+
+
+def get_whisper_model(model_size=WHISPER_MODEL_SIZE):
+    """Return the shared WhisperModel, loading it on first use (or after it was unloaded for idleness)"""
+    model = _whisper_models.get(model_size)
+    if model is not None:
+        _whisper_last_used[model_size] = time.monotonic()
+        return model
+
+    with _whisper_lock:
+        if model_size not in _whisper_models:
+            from faster_whisper import WhisperModel
+            from memory_manager import get_memory_manager
+            from resource_governor import thread_budget
+            from shared_state import get_shared_state
+            _, transcribe_threads, _ = thread_budget()
+            # Unload idle Ollama models first if the budget needs the room
+            memory_mb = get_memory_manager().prepare_whisper(model_size)
+            print(f"⏳ טוען מודל Whisper ({model_size}, {transcribe_threads} תהליכונים)...", file=sys.stderr)
+            # Pin the thread count so transcription stays inside its CPU budget
+            _whisper_models[model_size] = WhisperModel(
+                model_size, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE_TYPE,
+                cpu_threads=transcribe_threads, num_workers=1
+            )
+            get_shared_state().register_model('whisper', model_size, memory_mb)
+            _start_reaper()
+        _whisper_last_used[model_size] = time.monotonic()
+        return _whisper_models[model_size]
+
+
+def unload_idle_whisper(idle_seconds):
+    """Drop Whisper models unused for idle_seconds. Returns the unloaded sizes"""
+    from shared_state import get_shared_state
+    now = time.monotonic()
+    unloaded = []
+    with _whisper_lock:
+        for model_size in list(_whisper_models):
+            if now - _whisper_last_used.get(model_size, now) >= idle_seconds:
+                # A transcription still running keeps its own reference until it finishes
+                del _whisper_models[model_size]
+                unloaded.append(model_size)
+                get_shared_state().unregister_model('whisper', model_size)
+    if unloaded:
+        gc.collect()
+        print(f"🧹 מודל Whisper ({', '.join(unloaded)}) לא היה בשימוש {idle_seconds} שניות - פונה מהזיכרון", file=sys.stderr)
+    return unloaded
+
+
+def _start_reaper():
+    """Background thread unloading idle Whisper models"""
+    global _reaper
+    if _reaper is not None:
+        return
+    idle_seconds = _whisper_idle_seconds
+    if idle_seconds is None:
+        from memory_manager import get_memory_manager
+        idle_seconds = get_memory_manager().whisper_idle_seconds
+    if not idle_seconds:
+        return
+
+    def reap():
+        while True:
+            time.sleep(max(1, min(idle_seconds / 4, 30)))
+            unload_idle_whisper(idle_seconds)
+
+    _reaper = threading.Thread(target=reap, name='whisper-reaper', daemon=True)
+    _reaper.start()
+
+
+def get_ollama():
+    """Return the ollama module, importing it on first use"""
+    import ollama
+    return ollama
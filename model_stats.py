@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Rolling per-model latency statistics, and the deadlines and num_predict caps
+derived from them
+
+A fixed 40 second timeout is too long to notice a failing gemma2 run and too
+short for deepseek. Every generation records, per model, its time to first
+token (model load + prompt evaluation) and its token rate (Ollama's
+eval_count / eval_duration) as exponentially weighted moving averages, with
+a moving mean deviation of the time to first token (cold loads vary a lot).
+The stats live in the shared state database, so they are shared by every
+process and survive restarts.
+
+From them, with the "latency" config section:
+
+    timeout         - expected seconds for num_predict tokens, times
+                      safety_factor, within [min_timeout, max_timeout].
+                      A model without stats gets max_timeout, so its first
+                      run can finish and be learned from.
+    num_predict cap - when target_seconds is set (or the run's deadline is
+                      closer), num_predict is lowered so the answer fits in
+                      the time left instead of being cut off by the timeout.
+"""
+import time
+
+from settings import load_settings
+
+DEFAULT_ALPHA = 0.2
+DEFAULT_SAFETY_FACTOR = 1.5
+DEFAULT_MIN_TIMEOUT = 15
+DEFAULT_MAX_TIMEOUT = 180
+DEFAULT_MIN_NUM_PREDICT = 150
+DEFAULT_AUDIO_OVERHEAD_SECONDS = 10
+DEFAULT_NUM_PREDICT = 600
+# Time to first token is budgeted at mean + this many mean deviations
+TTFT_DEVIATIONS = 2
+# Kept free before a run's deadline for writing the log and exiting
+DEADLINE_RESERVE_SECONDS = 2
+
+
+def _ewma(mean, value, alpha):
+    return value if mean is None else mean + alpha * (value - mean)
+
+
+class ModelStats:
+    def __init__(self, settings=None, state=None):
+        self.settings = settings if settings is not None else load_settings('latency')
+        self.alpha = self.settings.get('alpha', DEFAULT_ALPHA)
+        self.safety_factor = self.settings.get('safety_factor', DEFAULT_SAFETY_FACTOR)
+        self.min_timeout = self.settings.get('min_timeout', DEFAULT_MIN_TIMEOUT)
+        self.max_timeout = self.settings.get('max_timeout', DEFAULT_MAX_TIMEOUT)
+        self.min_num_predict = self.settings.get('min_num_predict', DEFAULT_MIN_NUM_PREDICT)
+        self.target_seconds = self.settings.get('target_seconds')
+        self._state = state
+
+    @property
+    def state(self):
+        if self._state is None:
+            from shared_state import get_shared_state
+            self._state = get_shared_state()
+        return self._state
+
+    # --- learning ----------------------------------------------------------
+
+    def record(self, model, ttft_seconds, tokens, eval_seconds):
+        """Add one generation: its time to first token, and tokens generated in eval_seconds"""
+        if not model or ttft_seconds is None:
+            return None
+        tokens_per_second = tokens / eval_seconds if tokens and eval_seconds and eval_seconds > 0 else None
+
+        def update(stats):
+            stats = stats or {'samples': 0, 'ttft_seconds': None, 'ttft_deviation': 0.0, 'tokens_per_second': None}
+            samples = stats['samples'] + 1
+            # Plain average over the first samples, so the first (cold) run doesn't dominate for long
+            alpha = max(self.alpha, 1 / samples)
+            previous = stats['ttft_seconds']
+            if previous is not None:
+                stats['ttft_deviation'] = _ewma(stats['ttft_deviation'], abs(ttft_seconds - previous), alpha)
+            stats['ttft_seconds'] = _ewma(previous, ttft_seconds, alpha)
+            if tokens_per_second:
+                stats['tokens_per_second'] = _ewma(stats['tokens_per_second'], tokens_per_second, alpha)
+            stats['samples'] = samples
+            stats['updated'] = time.time()
+            return stats
+
+        return self.state.update_model_stats(model, update)
+
+    def get(self, model):
+        """Stats of one model, or None until it has both a TTFT and a token rate"""
+        stats = self.state.get_model_stats().get(model)
+        if not stats or not stats.get('ttft_seconds') or not stats.get('tokens_per_second'):
+            return None
+        return stats
+
+    # --- planning ----------------------------------------------------------
+
+    @staticmethod
+    def _first_token_seconds(stats):
+        return stats['ttft_seconds'] + TTFT_DEVIATIONS * stats['ttft_deviation']
+
+    def expected_seconds(self, model, num_predict, stats=None):
+        """Expected seconds to generate num_predict tokens on model (None without stats)"""
+        stats = stats or self.get(model)
+        if stats is None:
+            return None
+        return self._first_token_seconds(stats) + num_predict / stats['tokens_per_second']
+
+    def num_predict_cap(self, model, seconds, stats=None):
+        """Most tokens model can generate in `seconds` (None without stats)"""
+        stats = stats or self.get(model)
+        if stats is None:
+            return None
+        budget = seconds - self._first_token_seconds(stats)
+        return max(self.min_num_predict, int(budget * stats['tokens_per_second']))
+
+    def plan_num_predict(self, model, num_predict, deadline=None):
+        """num_predict for a run: lowered to fit target_seconds and the time left
+        before `deadline` (epoch seconds). Returns (num_predict, capped_by or None)"""
+        stats = self.get(model)
+        if stats is None:
+            return num_predict, None
+        capped_by = None
+        if self.target_seconds:
+            cap = self.num_predict_cap(model, self.target_seconds, stats)
+            if cap < num_predict:
+                num_predict, capped_by = cap, 'target'
+        if deadline is not None:
+            # Only when the run is actually running late - the deadline already has the safety margin
+            seconds_left = deadline - time.time() - DEADLINE_RESERVE_SECONDS
+            if seconds_left < self.expected_seconds(model, num_predict, stats):
+                cap = self.num_predict_cap(model, seconds_left, stats)
+                if cap < num_predict:
+                    num_predict, capped_by = cap, 'deadline'
+        return num_predict, capped_by
+
+    def timeout(self, model, num_predict=None, overhead_seconds=0):
+        """Seconds to allow one pipeline run on model"""
+        num_predict = num_predict or DEFAULT_NUM_PREDICT
+        stats = self.get(model)
+        if stats is None:
+            return self.max_timeout
+        if self.target_seconds:
+            num_predict = min(num_predict, self.num_predict_cap(model, self.target_seconds, stats))
+        seconds = (overhead_seconds + self.expected_seconds(model, num_predict, stats)) * self.safety_factor
+        return round(min(self.max_timeout, max(self.min_timeout, seconds)), 1)
+
+    def audio_overhead_seconds(self):
+        return self.settings.get('audio_overhead_seconds', DEFAULT_AUDIO_OVERHEAD_SECONDS)
+
+    # --- reporting ---------------------------------------------------------
+
+    def snapshot(self, num_predict=None):
+        """Learned stats per model with the timeout each would get now"""
+        models = {}
+        for model, stats in self.state.get_model_stats().items():
+            models[model] = {
+                'samples': stats['samples'],
+                'ttft_seconds': round(stats['ttft_seconds'], 2) if stats.get('ttft_seconds') else None,
+                'ttft_deviation': round(stats['ttft_deviation'], 2),
+                'tokens_per_second': round(stats['tokens_per_second'], 1) if stats.get('tokens_per_second') else None,
+                'updated': stats.get('updated'),
+                'timeout': self.timeout(model, num_predict),
+            }
+        return {'target_seconds': self.target_seconds, 'models': models}
+
+
+_stats = None
+
+
+def get_model_stats():
+    """Process-wide ModelStats"""
+    global _stats
+    if _stats is None:
+        _stats = ModelStats()
+    return _stats
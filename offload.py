@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Blocking file and SQLite I/O off the gevent event loop
+
+The production server runs gevent workers (backend/gunicorn.conf.py), where
+threading is monkey-patched: a "thread" is a greenlet, and a blocking flock,
+fsync or SQLite busy wait in one stalls every request of the worker. Calls
+made through run_blocking() or a SerialExecutor run on real OS threads there
+and only block the calling greenlet. Everywhere else (pipeline scripts, the
+Flask dev server) they are plain calls.
+"""
+import os
+import sys
+import threading
+
+
+def gevent_active():
+    """True in a process where gevent has patched threading"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_blocking(func, *args):
+    """func(*args), on gevent's thread pool when running under gevent"""
+    if not gevent_active():
+        return func(*args)
+    from gevent import get_hub
+    return get_hub().threadpool.apply(func, args)
+
+
+class SerialExecutor:
+    """
+    Runs calls one at a time.
+
+    Under gevent they run on one OS thread of its own (created per process,
+    so a forked worker doesn't inherit its parent's), otherwise in the
+    calling thread under a lock. Either way state only touched from inside
+    the calls - a SQLite connection - is never used concurrently. Nested
+    calls run directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pool = None
+        self._pool_pid = None
+
+    def run(self, func, *args):
+        if not gevent_active():
+            with self._lock:
+                return func(*args)
+        if self._pool_pid != os.getpid():
+            from gevent.threadpool import ThreadPool
+            self._pool, self._pool_pid = ThreadPool(1), os.getpid()
+        # gevent runs the call inline when it's already on this pool's thread
+        return self._pool.apply(func, args)
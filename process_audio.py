@@ -2,8 +2,6 @@
 """
 Process pre-recorded audio file for transcription and AI response
 """
-import ollama
-from faster_whisper import WhisperModel
 from datetime import datetime
 import sys
 import os
@@ -11,9 +9,14 @@ import re
 import time
 import json
 
-# Load Whisper model
-model_size = "base"
-model = WhisperModel(model_size, device="cpu", compute_type="int8")
+from cancellation import EXIT_CANCELLED, Cancelled, checked
+from conversation_log import get_log_writer, write_entry
+from generation import chat, early_stop_line
+from knowledge_index import knowledge_messages
+from profiling import span, start_from_env
+from model_loader import WHISPER_COMPUTE_TYPE, WHISPER_MODEL_SIZE, get_whisper_model
+from resource_governor import get_governor
+from transcript_cache import audio_fingerprint, cache_key, get_transcript_cache
 
 # Load configuration
 def load_config():
@@ -47,9 +50,26 @@ def load_config():
         print(f"⚠️  Failed to load config: {e}", file=sys.stderr)
         sys.exit(1)
 
-# Initialize conversation history with context from config
-model_name, model_options, context = load_config()
-conversation_history = [{'role': 'system', 'content': context}]
+def transcribe(audio_path, language="he"):
+    """Transcribe an audio file (a retried upload of the same recording reuses the cached transcript)"""
+    transcript_cache = get_transcript_cache()
+    with span('transcribe'):
+        key = cache_key(audio_fingerprint(audio_path), WHISPER_MODEL_SIZE, WHISPER_COMPUTE_TYPE, language)
+        user_text = transcript_cache.get(key)
+        if user_text is not None:
+            print("✓ תמלול מהמטמון - מדלג על Whisper", file=sys.stderr)
+            return user_text
+        # Segments are decoded lazily, so keep the CPU reservation until they're joined
+        with get_governor().acquire('transcribe'):
+            segments, _ = get_whisper_model().transcribe(audio_path, language=language)
+            # A cancelled run stops between segments
+            user_text = " ".join([seg.text for seg in checked(segments)]).strip()
+        if user_text:
+            transcript_cache.put(key, user_text)
+    return user_text
+
+# Conversation history, initialized with the config context on first use
+conversation_history = None
 
 def process_audio_file(audio_path):
     """Process an audio file and generate AI response"""
@@ -57,6 +77,12 @@ def process_audio_file(audio_path):
     
     start_time = time.time()  # Track start time
     
+    # One config snapshot per request, used for the context, generation and the log
+    model_name, model_options, context = load_config()
+    
+    if conversation_history is None:
+        conversation_history = [{'role': 'system', 'content': context}]
+    
     if not os.path.exists(audio_path):
         print(f"שגיאה: קובץ אודיו לא נמצא: {audio_path}", file=sys.stderr)
         sys.exit(1)
@@ -65,8 +91,9 @@ def process_audio_file(audio_path):
     
     # Transcribe audio
     try:
-        segments, _ = model.transcribe(audio_path, language="he")
-        user_text = " ".join([seg.text for seg in segments]).strip()
+        user_text = transcribe(audio_path)
+    except Cancelled:
+        raise
     except Exception as e:
         print(f"שגיאה בתמלול: {e}", file=sys.stderr)
         sys.exit(1)
@@ -88,23 +115,23 @@ def process_audio_file(audio_path):
     
     # Get AI response with configured parameters
     try:
-        model_name, model_options, _ = load_config()
         # Add stop sequences
         model_options['stop'] = ['\n\n\n\n\n']
         
         print(f"⏳ שולח ל-Ollama (מודל: {model_name})...", file=sys.stderr)
-        response = ollama.chat(
-            model=model_name,
-            messages=conversation_history,
-            options=model_options
-        )
-        print(f"✓ קיבלתי תשובה מ-Ollama", file=sys.stderr)
-        ai_response = response['message']['content'].strip()
+        with span('prompt_build'):
+            # Relevant knowledge chunks go right before the question and aren't kept in the history
+            messages = conversation_history[:-1] + knowledge_messages(user_text) + conversation_history[-1:]
+        with span('generation'):
+            ai_response, generation_stats = chat(model_name, messages, model_options, context)
+        print(f"✓ קיבלתי תשובה מ-Ollama ({generation_stats['tokens']} טוקנים, {generation_stats['tokens_per_second']} טוקנים/שנייה)", file=sys.stderr)
         
         # Clean up excessive blank lines (max 2 consecutive newlines)
         ai_response = re.sub(r'\n{3,}', '\n\n', ai_response)
         
         print(f"תשובת ה-AI: {ai_response}", file=sys.stderr)
+    except Cancelled:
+        raise
     except Exception as e:
         print(f"שגיאה בקבלת תשובה מ-AI: {e}", file=sys.stderr)
         sys.exit(1)
@@ -122,14 +149,13 @@ def process_audio_file(audio_path):
     timestamp_output = now.strftime("%d-%m-%y %H:%M:%S")
     
     # Include config in log
-    model_name, model_options, _ = load_config()
     config_str = f"מודל: {model_name} | טמפרטורה: {model_options.get('temperature', 0.6)} | דגימה: {model_options.get('top_p', 0.9)} | מילים: {model_options.get('top_k', 40)}"
     
-    log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{ai_response}\n\nזמן תגובה: {response_time} שניות\nתצורה: {config_str}\n\n{'='*50}\n\n"
+    log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{ai_response}\n\nזמן תגובה: {response_time} שניות\nתצורה: {config_str}\n{early_stop_line(generation_stats)}\n{'='*50}\n\n"
     
     try:
-        with open("conversation.txt", "a", encoding="utf-8") as f:
-            f.write(log_entry)
+        # Handed to the server's writer (or queued here and flushed before exit)
+        write_entry(log_entry)
         print("✓ נשמר לקובץ conversation.txt", file=sys.stderr)
         print("SUCCESS", file=sys.stdout)
     except Exception as e:
@@ -142,10 +168,18 @@ if __name__ == "__main__":
         sys.exit(1)
     
     audio_path = sys.argv[1]
+    start_from_env('process_audio')
     
     try:
         process_audio_file(audio_path)
+        # Surface a failed log write as a failed run (nothing queued here under the server)
+        with span('persist'):
+            get_log_writer().flush()
         sys.exit(0)
+    except Cancelled as e:
+        # Nothing is logged for a cancelled recording
+        print(f"🛑 הבקשה בוטלה ({e.reason})", file=sys.stderr)
+        sys.exit(EXIT_CANCELLED)
     except Exception as e:
         print(f"שגיאה: {e}", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Ask several models the same question concurrently (comparison mode)
+
+    python process_compare.py <model,model,...> text <question>
+    python process_compare.py <model,model,...> audio <audio_file_path>
+
+A recording is transcribed once for all models. Progress is written to
+stdout as JSON lines, which the server streams on to the client:
+
+    {"event": "question", "text": ..., "models": [...], "parallel": N}
+    {"event": "start", "model": ...}
+    {"event": "token", "model": ..., "text": ...}
+    {"event": "done", "model": ..., "answer": ..., "seconds": ..., "stats": {...}}
+    {"event": "error", "model": ..., "error": ...}
+
+Each model's answer is logged as its own entry, all with the same line
+comparing the models' latency and token rate side by side.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import re
+import sys
+import threading
+import time
+
+from cancellation import EXIT_CANCELLED, Cancelled
+from comparison import comparison_line, parallel_limit, thread_share
+from conversation_log import get_log_writer, write_entry
+from generation import chat, early_stop_line
+from knowledge_index import knowledge_messages
+from process_audio import transcribe
+from process_text import load_config
+from profiling import span, start_from_env
+
+_emit_lock = threading.Lock()
+
+
+def emit(event, **fields):
+    """Write one event line to stdout (models answer concurrently - one line at a time)"""
+    line = json.dumps({'event': event, **fields}, ensure_ascii=False)
+    with _emit_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def ask(model_name, messages, options, context):
+    """Run one model of the comparison, streaming its answer. Returns its result dict"""
+    emit('start', model=model_name)
+    start_time = time.time()
+    try:
+        ai_response, generation_stats = chat(model_name, messages, options, context,
+                                             on_piece=lambda piece: emit('token', model=model_name, text=piece))
+    except Cancelled:
+        raise
+    except Exception as e:
+        print(f"שגיאה בקבלת תשובה מ-{model_name}: {e}", file=sys.stderr)
+        emit('error', model=model_name, error=str(e))
+        return {'error': str(e)}
+
+    # Clean up excessive blank lines
+    ai_response = re.sub(r'\n{3,}', '\n\n', ai_response)
+    seconds = round(time.time() - start_time, 2)
+    print(f"✓ {model_name}: {seconds} שניות ({generation_stats['tokens_per_second']} טוקנים/שנייה)", file=sys.stderr)
+    emit('done', model=model_name, answer=ai_response, seconds=seconds, stats=generation_stats)
+    return {'answer': ai_response, 'seconds': seconds, 'stats': generation_stats, 'finished': datetime.now()}
+
+
+def compare(models, user_text):
+    """Ask every model user_text, up to parallel_limit() at a time, and log the answers"""
+    asked_at = datetime.now()
+
+    with span('prompt_build'):
+        # Same snapshot of the options and context for every model
+        _, model_options, context = load_config()
+        messages = [
+            {'role': 'system', 'content': context},
+            *knowledge_messages(user_text),
+            {'role': 'user', 'content': user_text}
+        ]
+
+    parallel = parallel_limit(models)
+    # The generate thread budget is shared by the models running together
+    options = {**model_options, 'stop': ['\n\n\n\n\n'], 'num_thread': thread_share(parallel)}
+    emit('question', text=user_text, models=models, parallel=parallel)
+    print(f"⏳ משווה {len(models)} מודלים, {parallel} במקביל...", file=sys.stderr)
+
+    with span('generation'):
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = {model: pool.submit(ask, model, messages, options, context) for model in models}
+            results = {model: future.result() for model, future in futures.items()}
+
+    line = comparison_line(results)
+    timestamp_input = asked_at.strftime("%d-%m-%y %H:%M:%S")
+    for model, result in results.items():
+        if result.get('error'):
+            continue
+        timestamp_output = result['finished'].strftime("%d-%m-%y %H:%M:%S")
+        config_str = f"מודל: {model} | טמפרטורה: {model_options.get('temperature', 0.6)} | דגימה: {model_options.get('top_p', 0.9)} | מילים: {model_options.get('top_k', 40)}"
+        log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{result['answer']}\n\nזמן תגובה: {result['seconds']} שניות\nתצורה: {config_str}\n{early_stop_line(result['stats'])}{line}\n\n{'='*50}\n\n"
+        # Handed to the server's writer (or queued here and flushed before exit)
+        write_entry(log_entry)
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[2] not in ('text', 'audio'):
+        print("שימוש: python process_compare.py <model,model,...> text <text> | audio <audio_file_path>", file=sys.stderr)
+        sys.exit(1)
+
+    models = [model.strip() for model in sys.argv[1].split(',') if model.strip()]
+    start_from_env('process_compare')
+
+    try:
+        if sys.argv[2] == 'audio':
+            user_text = transcribe(sys.argv[3])
+            if not user_text:
+                print("⚠️  לא זיהיתי דיבור בקובץ", file=sys.stderr)
+                sys.exit(1)
+            print(f"זיהיתי: {user_text}", file=sys.stderr)
+        else:
+            user_text = sys.argv[3].strip()
+
+        results = compare(models, user_text)
+        # Surface a failed log write as a failed run (nothing queued here under the server)
+        with span('persist'):
+            get_log_writer().flush()
+        sys.exit(0 if any(not result.get('error') for result in results.values()) else 1)
+    except Cancelled as e:
+        # Nothing is logged for a cancelled comparison
+        print(f"🛑 הבקשה בוטלה ({e.reason})", file=sys.stderr)
+        sys.exit(EXIT_CANCELLED)
+    except Exception as e:
+        print(f"שגיאה: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -2,7 +2,6 @@
 """
 Process text input directly for AI response (without audio recording)
 """
-import ollama
 from datetime import datetime
 import sys
 import os
@@ -10,6 +9,12 @@ import re
 import time
 import json
 
+from cancellation import EXIT_CANCELLED, Cancelled
+from conversation_log import get_log_writer, write_entry
+from generation import chat, early_stop_line
+from knowledge_index import knowledge_messages
+from profiling import span, start_from_env
+
 # Load configuration
 def load_config():
     """Load model, options, and context from config_runtime.json"""
@@ -42,9 +47,6 @@ def load_config():
         print(f"⚠️  Failed to load config: {e}", file=sys.stderr)
         sys.exit(1)
 
-# Load configuration once at module level
-model_name, model_options, context = load_config()
-
 def process_text_input(user_text):
     """Process text input and generate AI response (no history maintained)"""
     start_time = time.time()  # Track start time
@@ -56,33 +58,34 @@ def process_text_input(user_text):
     user_text = user_text.strip()
     print(f"קלט טקסט: {user_text}", file=sys.stderr)
     
-    # Create fresh conversation with only system context and current message
-    # No history is maintained between calls
-    conversation_history = [
-        {'role': 'system', 'content': context},
-        {'role': 'user', 'content': user_text}
-    ]
+    with span('prompt_build'):
+        # Config is loaded per request (not at import) so edits apply immediately
+        model_name, model_options, context = load_config()
+        
+        # Create fresh conversation with only system context and current message
+        # No history is maintained between calls
+        conversation_history = [
+            {'role': 'system', 'content': context},
+            *knowledge_messages(user_text),
+            {'role': 'user', 'content': user_text}
+        ]
     
     # Get AI response with configured parameters
     try:
-        model_name, model_options, _ = load_config()
         # Add stop sequences
         model_options['stop'] = ['\n\n\n\n\n']
         
         print(f"⏳ שולח ל-Ollama (מודל: {model_name})...", file=sys.stderr)
-        response = ollama.chat(
-            model=model_name,
-            messages=conversation_history,
-            options=model_options
-        )
-        print(f"✓ קיבלתי תשובה מ-Ollama", file=sys.stderr)
-        
-        ai_response = response['message']['content'].strip()
+        with span('generation'):
+            ai_response, generation_stats = chat(model_name, conversation_history, model_options, context)
+        print(f"✓ קיבלתי תשובה מ-Ollama ({generation_stats['tokens']} טוקנים, {generation_stats['tokens_per_second']} טוקנים/שנייה)", file=sys.stderr)
         
         # Clean up excessive blank lines
         ai_response = re.sub(r'\n{3,}', '\n\n', ai_response)
         
         print(f"תשובת ה-AI: {ai_response}", file=sys.stderr)
+    except Cancelled:
+        raise
     except Exception as e:
         print(f"שגיאה בקבלת תשובה מ-AI: {e}", file=sys.stderr)
         sys.exit(1)
@@ -98,15 +101,14 @@ def process_text_input(user_text):
     timestamp_input = now.strftime("%d-%m-%y %H:%M:%S")
     timestamp_output = now.strftime("%d-%m-%y %H:%M:%S")
     
-    # Include config in log
-    model_name, model_options, _ = load_config()
+    # Include config in log (the same snapshot the answer was generated with)
     config_str = f"מודל: {model_name} | טמפרטורה: {model_options.get('temperature', 0.6)} | דגימה: {model_options.get('top_p', 0.9)} | מילים: {model_options.get('top_k', 40)}"
     
-    log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{ai_response}\n\nזמן תגובה: {response_time} שניות\nתצורה: {config_str}\n\n{'='*50}\n\n"
+    log_entry = f"{timestamp_input} input:\n{user_text}\n\n{timestamp_output} output:\n{ai_response}\n\nזמן תגובה: {response_time} שניות\nתצורה: {config_str}\n{early_stop_line(generation_stats)}\n{'='*50}\n\n"
     
     try:
-        with open("conversation.txt", "a", encoding="utf-8") as f:
-            f.write(log_entry)
+        # Handed to the server's writer (or queued here and flushed before exit)
+        write_entry(log_entry)
         print("✓ נשמר לקובץ conversation.txt", file=sys.stderr)
         print("SUCCESS", file=sys.stdout)
     except Exception as e:
@@ -119,10 +121,18 @@ if __name__ == "__main__":
         sys.exit(1)
     
     text = sys.argv[1]
+    start_from_env('process_text')
     
     try:
         process_text_input(text)
+        # Surface a failed log write as a failed run (nothing queued here under the server)
+        with span('persist'):
+            get_log_writer().flush()
         sys.exit(0)
+    except Cancelled as e:
+        # Nothing is logged for a cancelled question
+        print(f"🛑 הבקשה בוטלה ({e.reason})", file=sys.stderr)
+        sys.exit(EXIT_CANCELLED)
     except Exception as e:
         print(f"שגיאה: {e}", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Opt-in per-request profiling with named spans
+
+A profiled request (X-Profile: 1 header, or "enabled" in the "profiling"
+config section) runs under cProfile in the server and in the pipeline
+subprocess it starts, and records wall-clock spans around the main stages
+(upload, decode, queue, transcribe, prompt build, generation, persist).
+Everything is stored under .profiles/<profile id>/:
+
+    server.prof, process_audio.prof, ...   - cProfile stats (pstats / snakeviz)
+    spans.json                             - spans from every process, JSON lines
+
+The server passes the profile directory to the pipeline through the
+RABIN_PROFILE_DIR environment variable. When no profile is active, span()
+returns a shared no-op context manager, so the hooks cost one attribute
+lookup.
+
+cProfile hooks the OS thread, not the request: under gevent every request of
+a worker runs on the same thread, and a second enabled profiler would either
+mix both requests' calls or (Python 3.12+) fail with "Another profiling tool
+is already active". So only one profile per process runs cProfile; a request
+profiled while another is running records its spans (and its pipeline's
+cProfile) only, without a server.prof.
+"""
+import cProfile
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.path.join(BASE_DIR, '.profiles')
+PROFILE_ENV = 'RABIN_PROFILE_DIR'
+SPANS_FILE = 'spans.json'
+
+DEFAULT_MAX_PROFILES = 50
+TOP_FUNCTIONS = 25
+
+_NO_SPAN = nullcontext()
+_local = threading.local()
+# The Profile whose cProfile is enabled in this process, if any
+_cprofile_lock = threading.Lock()
+_cprofile_owner = None
+# (config version, "profiling" section) - parsed once per saved config
+_settings = (None, {})
+
+
+class Profile:
+    """cProfile run plus spans of one process taking part in a profiled request"""
+
+    def __init__(self, directory, process):
+        self.dir = directory
+        self.id = os.path.basename(directory)
+        self.process = process
+        self.spans = []
+        # None while another profile in this process holds cProfile
+        self.profiler = None
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(self.dir, f"{self.process}.prof"))
+        # One write per process, appended - the server and its pipeline share the file
+        lines = ''.join(json.dumps(span, ensure_ascii=False) + '\n' for span in self.spans)
+        with open(os.path.join(self.dir, SPANS_FILE), 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+class _Span:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.spans.append({
+            'process': self.profile.process,
+            'name': self.name,
+            'start': self.start,
+            'seconds': round(time.time() - self.start, 4),
+        })
+        return False
+
+
+def current():
+    """The profile active in this thread, or None"""
+    return getattr(_local, 'profile', None)
+
+
+def span(name):
+    """Context manager timing one stage of the current profiled request (no-op otherwise)"""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _NO_SPAN
+    return _Span(profile, name)
+
+
+def record_span(name, seconds):
+    """Add a span that just ended after `seconds` (for waits timed elsewhere)"""
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.spans.append({
+            'process': profile.process,
+            'name': name,
+            'start': time.time() - seconds,
+            'seconds': round(seconds, 4),
+        })
+
+
+def profiling_settings():
+    """The "profiling" section of the current (versioned, cached) config"""
+    global _settings
+    from shared_state import get_shared_state
+    state = get_shared_state()
+    version = state.config_version()
+    if _settings[0] != version:
+        _, config = state.get_config()
+        _settings = (version, config.get('profiling') or {})
+    return _settings[1]
+
+
+def requested(header_value=None):
+    """Whether a request should be profiled: X-Profile header or the config flag"""
+    if header_value is not None:
+        return header_value.strip().lower() in ('1', 'true', 'yes')
+    return bool(profiling_settings().get('enabled'))
+
+
+def _enable_cprofile(profile):
+    """Run cProfile for profile unless another profile (or tool) already does"""
+    global _cprofile_owner
+    with _cprofile_lock:
+        if _cprofile_owner is not None:
+            return False
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler or debugger is active (Python 3.12+)
+            return False
+        profile.profiler = profiler
+        _cprofile_owner = profile
+        return True
+
+
+def _disable_cprofile(profile):
+    global _cprofile_owner
+    with _cprofile_lock:
+        if _cprofile_owner is profile:
+            profile.profiler.disable()
+            _cprofile_owner = None
+
+
+def start(process='server', directory=None):
+    """Start profiling this thread (request). A new profile id is created unless
+    directory is given. Only spans are recorded while another profile holds cProfile"""
+    if directory is None:
+        _prune()
+        directory = os.path.join(PROFILE_DIR, uuid.uuid4().hex)
+    profile = Profile(directory, process)
+    _local.profile = profile
+    if not _enable_cprofile(profile):
+        print(f"[PROFILE] cProfile already active - {profile.id} records spans only", file=sys.stderr, flush=True)
+    return profile
+
+
+def stop():
+    """Stop profiling this thread and write its files. Returns the profile (or None)"""
+    profile = current()
+    if profile is None:
+        return None
+    _disable_cprofile(profile)
+    _local.profile = None
+    try:
+        profile.save()
+    except OSError as e:
+        print(f"[PROFILE] Failed to save profile {profile.id}: {e}", file=sys.stderr, flush=True)
+    return profile
+
+
+def start_from_env(process):
+    """In a pipeline subprocess: join the request's profile if the server asked for one"""
+    directory = os.environ.get(PROFILE_ENV)
+    if not directory:
+        return None
+    import atexit
+    profile = start(process, directory)
+    # sys.exit() is used for errors - save on the way out either way
+    atexit.register(stop)
+    return profile
+
+
+def pipeline_env():
+    """Environment for a pipeline subprocess, carrying the active profile (None if not profiling)"""
+    profile = current()
+    if profile is None:
+        return None
+    return {**os.environ, PROFILE_ENV: profile.dir}
+
+
+def _prune():
+    max_profiles = profiling_settings().get('max_profiles', DEFAULT_MAX_PROFILES)
+    profiles = list_profiles()
+    for profile in profiles[max_profiles - 1:] if max_profiles > 0 else profiles:
+        shutil.rmtree(os.path.join(PROFILE_DIR, profile['id']), ignore_errors=True)
+
+
+# --- reading -----------------------------------------------------------------
+
+def _profile_path(profile_id):
+    # Ids are uuid hex - anything else could escape PROFILE_DIR
+    if not profile_id or not all(c in '0123456789abcdef' for c in profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id)
+    return path if os.path.isdir(path) else None
+
+
+def list_profiles():
+    """Stored profiles, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, name)
+        if os.path.isdir(path):
+            profiles.append({
+                'id': name,
+                'created': os.path.getmtime(path),
+                'processes': sorted(f[:-len('.prof')] for f in os.listdir(path) if f.endswith('.prof')),
+            })
+    return sorted(profiles, key=lambda p: p['created'], reverse=True)
+
+
+def load_profile(profile_id, top=TOP_FUNCTIONS):
+    """Spans and the top functions (by cumulative time) of each process, or None"""
+    path = _profile_path(profile_id)
+    if path is None:
+        return None
+
+    spans = []
+    spans_path = os.path.join(path, SPANS_FILE)
+    if os.path.exists(spans_path):
+        with open(spans_path, 'r', encoding='utf-8') as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+    spans.sort(key=lambda s: s['start'])
+    started = spans[0]['start'] if spans else 0
+    for s in spans:
+        s['offset'] = round(s['start'] - started, 4)
+
+    import pstats
+    functions = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.prof'):
+            continue
+        stats = pstats.Stats(os.path.join(path, name))
+        rows = []
+        for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            rows.append({
+                'function': f"{os.path.basename(filename)}:{line}({function})",
+                'calls': calls,
+                'total_seconds': round(total, 4),
+                'cumulative_seconds': round(cumulative, 4),
+            })
+        rows.sort(key=lambda r: r['cumulative_seconds'], reverse=True)
+        functions[name[:-len('.prof')]] = rows[:top]
+
+    return {'id': profile_id, 'spans': spans, 'functions': functions}
+
+
+def profile_file(profile_id, process):
+    """Path of one process's .prof file, or None"""
+    path = _profile_path(profile_id)
+    if path is None or not process.replace('_', '').isalnum():
+        return None
+    file_path = os.path.join(path, f"{process}.prof")
+    return file_path if os.path.exists(file_path) else None
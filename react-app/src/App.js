@@ -15,6 +15,31 @@ function App() {
   const conversationsEndRef = useRef(null);
   const mediaRecorderRef = useRef(null);
   const audioChunksRef = useRef([]);
+  const activeRequestRef = useRef(null); // { id, controller } of the request being processed
+
+  // Start a cancellable request: the id is sent as X-Request-Id and becomes the job id
+  const startRequest = () => {
+    const id = window.crypto && window.crypto.randomUUID
+      ? window.crypto.randomUUID()
+      : `${Date.now().toString(16)}-${Math.random().toString(16).slice(2)}`;
+    const request = { id, controller: new AbortController() };
+    activeRequestRef.current = request;
+    return request;
+  };
+
+  // Cancel the job on the server (stops Whisper/Ollama) and stop waiting for it
+  const handleCancel = async () => {
+    const activeRequest = activeRequestRef.current;
+    if (!activeRequest) {
+      return;
+    }
+    activeRequest.controller.abort();
+    try {
+      await fetch(`http://localhost:5001/api/jobs/${activeRequest.id}/cancel`, { method: 'POST' });
+    } catch (err) {
+      // Aborting the request already closed its connection - the server cancels on disconnect too
+    }
+  };
 
   // Load conversations function
   const loadConversations = useCallback(async () => {
@@ -70,8 +95,14 @@ function App() {
       const data = await response.json();
       
       if (data.success) {
-        setConfig(tempConfig);
+        // The next save is checked against the version just written
+        const saved = { ...tempConfig, version: data.version };
+        setConfig(saved);
+        setTempConfig(saved);
         alert('✅ הגדרות נשמרו בהצלחה!');
+      } else if (response.status === 409) {
+        alert(`❌ ${data.error}`);
+        loadConfig();
       } else {
         alert('❌ שגיאה בשמירת הגדרות');
       }
@@ -210,6 +241,7 @@ function App() {
           // Create audio blob
           const audioBlob = new Blob(audioChunksRef.current, { type: 'audio/webm' });
           
+          const activeRequest = startRequest();
           try {
             // Send audio to backend
             const formData = new FormData();
@@ -217,19 +249,26 @@ function App() {
 
             const response = await fetch('http://localhost:5001/api/record-audio', {
               method: 'POST',
+              headers: {
+                'X-Request-Id': activeRequest.id,
+              },
               body: formData,
+              signal: activeRequest.controller.signal,
             });
 
             const data = await response.json();
 
             if (data.success) {
               await loadConversations();
-            } else {
+            } else if (!data.cancelled) {
               setError(data.error || 'Failed to process recording');
             }
           } catch (err) {
-            setError('Failed to connect to server: ' + err.message);
+            if (err.name !== 'AbortError') {
+              setError('Failed to connect to server: ' + err.message);
+            }
           } finally {
+            activeRequestRef.current = null;
             setIsProcessing(false);
           }
         };
@@ -247,13 +286,16 @@ function App() {
     setIsProcessing(true);
     setError('');
     
+    const activeRequest = startRequest();
     try {
       const response = await fetch('http://localhost:5001/api/text-input', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'X-Request-Id': activeRequest.id,
         },
         body: JSON.stringify({ text: textInput.trim() }),
+        signal: activeRequest.controller.signal,
       });
       
       const data = await response.json();
@@ -261,12 +303,15 @@ function App() {
       if (data.success) {
         setTextInput('');
         await loadConversations();
-      } else {
+      } else if (!data.cancelled) {
         setError(data.error || 'Failed to process text');
       }
     } catch (err) {
-      setError('Failed to connect to server: ' + err.message);
+      if (err.name !== 'AbortError') {
+        setError('Failed to connect to server: ' + err.message);
+      }
     } finally {
+      activeRequestRef.current = null;
       setIsProcessing(false);
     }
   };
@@ -488,6 +533,12 @@ function App() {
               💬
             </button>
 
+            {isProcessing && (
+              <button onClick={handleCancel} className="cancel-button">
+                ✖️ בטל
+              </button>
+            )}
+
             {error && <div className="error-message">{error}</div>}
           </div>
         </div>
@@ -530,6 +581,9 @@ function App() {
                             {conv.response_time && (
                               <div className="config-item time-item">⏱️ {conv.response_time}</div>
                             )}
+                            {conv.early_stop && (
+                              <div className="config-item time-item">✂️ {conv.early_stop}</div>
+                            )}
                           </div>
                         )}
                         <div className="content">{conv.output}</div>
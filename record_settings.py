@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+Model and listening limits of the server-mic recording path (listen2_single.py)
+
+The server sizes the recording timeout from them, so both import them from here.
+"""
+
+RECORD_MODEL = 'gemma2:9b'
+RECORD_NUM_PREDICT = 800
+
+# 1s ambient noise calibration, up to 10s for speech to start, 15s phrase limit
+AMBIENT_NOISE_SECONDS = 1
+SPEECH_START_TIMEOUT = 10
+PHRASE_TIME_LIMIT = 15
+RECORD_LISTEN_SECONDS = AMBIENT_NOISE_SECONDS + SPEECH_START_TIMEOUT + PHRASE_TIME_LIMIT
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+CPU thread budgeting shared by every pipeline process
+
+Whisper (CTranslate2) and a local Ollama both default to all cores, so a
+transcription overlapping a generation oversubscribes the CPU and both slow
+down. Each phase instead runs with a fixed thread count and must first
+reserve those threads from a machine-wide budget; if the budget is used up
+it waits in a FIFO queue rather than running on top of the other work.
+
+State lives in a small JSON file guarded by an flock, so the server, its
+pipeline subprocesses and the listener daemon all share one budget.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from settings import load_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows - no cross-process budget, phases just run
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(BASE_DIR, '.resource_governor.json')
+
+POLL_INTERVAL = 0.05
+
+
+def thread_budget():
+    """(total, transcribe, generate) thread counts from the "resources" config section"""
+    settings = load_settings('resources')
+    total = settings.get('total_threads') or os.cpu_count() or 4
+    transcribe = settings.get('transcribe_threads') or max(1, total // 4)
+    generate = settings.get('generate_threads') or max(1, total - transcribe)
+    return total, min(transcribe, total), min(generate, total)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ResourceGovernor:
+    """Admission control for thread-hungry phases ("transcribe", "generate")"""
+
+    def __init__(self, state_file=STATE_FILE):
+        self.state_file = state_file
+        self.lock_file = state_file + '.lock'
+        self.total, transcribe, generate = thread_budget()
+        self.threads = {'transcribe': transcribe, 'generate': generate}
+
+    @contextmanager
+    def _locked_state(self):
+        lock = open(self.lock_file, 'a')
+        try:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {}
+            if os.path.exists(self.state_file):
+                try:
+                    with open(self.state_file, 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                except Exception:
+                    state = {}
+            state.setdefault('holders', [])
+            state.setdefault('waiting', [])
+            state.setdefault('stats', {})
+            # Drop reservations of processes that died (killed on timeout etc.)
+            state['holders'] = [h for h in state['holders'] if _pid_alive(h['pid'])]
+            state['waiting'] = [w for w in state['waiting'] if _pid_alive(w['pid'])]
+            yield state
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_file)
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    @contextmanager
+    def acquire(self, kind, threads=None):
+        """Reserve the threads for one `kind` phase (or `threads` of them, e.g. a share of
+        it), waiting (FIFO) until they fit the budget"""
+        threads = min(threads or self.threads[kind], self.total)
+        if not fcntl:
+            yield threads
+            return
+
+        ticket = {'pid': os.getpid(), 'kind': kind, 'threads': threads, 'since': time.time(),
+                  'id': f"{os.getpid()}-{time.monotonic_ns()}"}
+        queued_at = time.time()
+        announced = False
+
+        with self._locked_state() as state:
+            state['waiting'].append(ticket)
+
+        try:
+            while True:
+                with self._locked_state() as state:
+                    used = sum(h['threads'] for h in state['holders'])
+                    first = state['waiting'][0]['id'] if state['waiting'] else ticket['id']
+                    # Strict FIFO so a big phase isn't starved by a stream of small ones
+                    if first == ticket['id'] and used + threads <= self.total:
+                        state['waiting'] = [w for w in state['waiting'] if w['id'] != ticket['id']]
+                        ticket['since'] = time.time()
+                        state['holders'].append(ticket)
+                        self._record_admission(state, kind, ticket['since'] - queued_at)
+                        break
+                if not announced:
+                    print(f"⏳ ממתין למשאבי מעבד ({kind}, {threads} תהליכונים)...", file=sys.stderr)
+                    announced = True
+                time.sleep(POLL_INTERVAL)
+
+            yield threads
+        finally:
+            with self._locked_state() as state:
+                state['waiting'] = [w for w in state['waiting'] if w['id'] != ticket['id']]
+                state['holders'] = [h for h in state['holders'] if h['id'] != ticket['id']]
+
+    @staticmethod
+    def _record_admission(state, kind, waited):
+        stats = state['stats'].setdefault(kind, {'admitted': 0, 'queued': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0})
+        stats['admitted'] += 1
+        if waited > POLL_INTERVAL:
+            stats['queued'] += 1
+        stats['wait_seconds'] = round(stats['wait_seconds'] + waited, 3)
+        stats['max_wait_seconds'] = round(max(stats['max_wait_seconds'], waited), 3)
+
+    def snapshot(self):
+        """Current budget, running and queued phases, and admission counters"""
+        if not fcntl:
+            return {'total_threads': self.total, 'threads': self.threads, 'enabled': False}
+        with self._locked_state() as state:
+            now = time.time()
+            return {
+                'enabled': True,
+                'total_threads': self.total,
+                'threads': self.threads,
+                'threads_in_use': sum(h['threads'] for h in state['holders']),
+                'running': [{'kind': h['kind'], 'pid': h['pid'], 'seconds': round(now - h['since'], 1)} for h in state['holders']],
+                'queued': [{'kind': w['kind'], 'pid': w['pid'], 'seconds': round(now - w['since'], 1)} for w in state['waiting']],
+                'stats': state['stats'],
+            }
+
+
+_governor = None
+
+
+def get_governor():
+    """Process-wide ResourceGovernor"""
+    global _governor
+    if _governor is None:
+        _governor = ResourceGovernor()
+    return _governor
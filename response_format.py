@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Streaming validator for the structured answer format required by the system prompt
+
+The default context asks for:
+
+    הגדרה קצרה:
+    [1-2 sentences]
+
+    הסבר:
+    [exactly 3 sentences]
+
+FormatValidator is fed the answer as it streams in and reports when the last
+section has all its sentences, so generation can be stopped there instead of
+running until num_predict.
+"""
+import re
+
+from settings import load_settings
+
+DEFAULT_SECTIONS = [
+    {'title': 'הגדרה קצרה:', 'min_sentences': 1, 'max_sentences': 2},
+    {'title': 'הסבר:', 'min_sentences': 3, 'max_sentences': 3},
+]
+
+# A sentence ends at . ! ? or sof pasuq followed by whitespace - waiting for
+# the whitespace keeps decimals ("3.5") and abbreviations mid-token intact.
+# A number opening a line or the section ("1. שלב ראשון") is a list marker, see sentence_ends()
+SENTENCE_END_RE = re.compile(r'[.!?׃]+(?=\s)')
+# Reasoning models (deepseek-r1) think before answering - ignore that part
+THINK_RE = re.compile(r'<think>.*?(</think>|$)', re.DOTALL)
+
+
+def load_format_settings(context):
+    """Sections to enforce and whether to stop early, or None if the context doesn't use this format"""
+    settings = load_settings('response_format')
+    sections = settings.get('sections', DEFAULT_SECTIONS)
+    if not settings.get('early_stop', True) or not sections:
+        return None
+    # The user may have replaced the system prompt with a different format
+    if not all(section['title'] in (context or '') for section in sections):
+        return None
+    return sections
+
+
+def sentence_ends(text, start=0, end=None):
+    """Sentence-ending punctuation matches in text[start:end], skipping list markers
+
+    A number followed by a period is a list marker only when it opens a line or
+    the section body - "בשנת 1948." still ends a sentence.
+    """
+    for match in SENTENCE_END_RE.finditer(text, start, len(text) if end is None else end):
+        i = match.start()
+        while i > start and text[i - 1].isdigit():
+            i -= 1
+        if i < match.start():
+            while i > start and text[i - 1] in ' \t':
+                i -= 1
+            if i == start or text[i - 1] == '\n':
+                continue
+        yield match
+
+
+def count_sentences(text):
+    return sum(1 for _ in sentence_ends(text))
+
+
+class FormatValidator:
+    """Tracks section headers and sentence counts of a streaming answer"""
+
+    def __init__(self, sections=DEFAULT_SECTIONS):
+        self.sections = sections
+        self.text = ''
+
+    def feed(self, chunk):
+        """Add streamed text, returns True once the answer is complete"""
+        self.text += chunk
+        return self.is_complete()
+
+    def _section_bounds(self, text):
+        """(body start, body end) of each section found so far, in order"""
+        headers = []
+        position = 0
+        for section in self.sections:
+            start = text.find(section['title'], position)
+            if start < 0:
+                break
+            position = start + len(section['title'])
+            headers.append((start, position))
+        return [
+            (body_start, headers[i + 1][0] if i + 1 < len(headers) else len(text))
+            for i, (_, body_start) in enumerate(headers)
+        ]
+
+    def section_texts(self):
+        """Text of each section found so far (None for sections not started yet)"""
+        text = THINK_RE.sub('', self.text)
+        texts = [text[start:end] for start, end in self._section_bounds(text)]
+        return texts + [None] * (len(self.sections) - len(texts))
+
+    def is_complete(self):
+        """Every section started and the last one has its full sentence count"""
+        texts = self.section_texts()
+        if not texts or texts[-1] is None:
+            return False
+        return count_sentences(texts[-1]) >= self.sections[-1]['max_sentences']
+
+    def report(self):
+        """Per-section sentence counts and whether the whole answer matches the format"""
+        sections = []
+        valid = True
+        for section, text in zip(self.sections, self.section_texts()):
+            sentences = count_sentences(text + ' ') if text is not None else 0
+            ok = text is not None and section['min_sentences'] <= sentences <= section['max_sentences']
+            valid = valid and ok
+            sections.append({'title': section['title'], 'sentences': sentences, 'valid': ok})
+        return {'valid': valid, 'sections': sections}
+
+    def final_text(self):
+        """The answer cut right after the last required sentence (unchanged if not complete)"""
+        if not self.is_complete():
+            return self.text
+        # Sentence offsets are relative to the text without <think> blocks, so cut on that
+        text = THINK_RE.sub('', self.text)
+        body_start, body_end = self._section_bounds(text)[-1]
+        ends = list(sentence_ends(text, body_start, body_end))
+        return text[:ends[self.sections[-1]['max_sentences'] - 1].end()]
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Optional config sections ("log", "server", ...) from config_runtime.json
+"""
+import json
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILES = ('config_runtime.json', 'config.json')
+
+
+def load_settings(section):
+    """Return one section of the runtime config (falls back to config.json), {} if missing"""
+    for name in CONFIG_FILES:
+        path = os.path.join(BASE_DIR, name)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f).get(section, {}) or {}
+            except Exception:
+                return {}
+    return {}
@@ -7,6 +7,9 @@ ollama serve
 # 3. הורד מודל gemma2:9b model (5.4 GB)
 ollama pull gemma2:9b
 
+# 3א. מודל הטמעה לאחזור ממאגר הידע (knowledge/)
+ollama pull nomic-embed-text
+
 # 4. בדוק שזה עובד it works
 echo "🧪 Testing model..."
 ollama run gemma2:9b "תגיד שלום"
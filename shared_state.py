@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+State shared by every server worker and pipeline process (SQLite, WAL mode)
+
+With several gunicorn workers, module globals and ad-hoc files stop being a
+consistent view. This keeps the state that has to agree across processes in
+one SQLite database, .shared_state.db, opened in WAL mode so readers never
+block the single writer:
+
+    config  - every saved version of the runtime config. Saves are atomic and
+              can be conditional on the version the client last saw; the
+              current version is also materialized to config_runtime.json
+              (atomic replace) for the pipeline scripts and load_settings.
+    jobs    - status of pipeline runs, so any worker can report on (or wait
+              for) a job another worker started, or cancel it. Every request
+              attached to a shared run is registered as a caller, so one of
+              them can leave (detach) without cancelling the run for the rest.
+    cache   - small LRU-bounded key/value namespaces (e.g. transcripts).
+    models  - models held in memory by each process, and when each Ollama
+              model was last used (see memory_manager).
+    model_stats - rolling latency/throughput per Ollama model (see model_stats).
+
+The conversation history stays in conversation.txt, which ConversationLog
+already guards with an flock and a single writer per process.
+
+Each process opens one connection (and creates the schema) once. All use of
+it goes through a SerialExecutor, so under the gevent workers it stays off
+the event loop and request greenlets never open connections of their own.
+"""
+import json
+import os
+import sqlite3
+import time
+
+from offload import SerialExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.path.join(BASE_DIR, '.shared_state.db')
+CONFIG_DEFAULT_FILE = os.path.join(BASE_DIR, 'config.json')
+CONFIG_RUNTIME_FILE = os.path.join(BASE_DIR, 'config_runtime.json')
+
+BUSY_TIMEOUT_MS = 5000
+POLL_INTERVAL = 0.1
+MAX_JOBS = 500
+# Kept with every config version, never part of the stored config itself
+CONFIG_RESPONSE_KEYS = ('version', 'options_descriptions')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    data TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT,
+    status TEXT NOT NULL,
+    pid INTEGER,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    http_status INTEGER,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+CREATE TABLE IF NOT EXISTS job_callers (
+    caller_id TEXT PRIMARY KEY,
+    job_key TEXT,
+    pid INTEGER NOT NULL,
+    detached INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_callers_key ON job_callers (job_key);
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed);
+CREATE TABLE IF NOT EXISTS resident_models (
+    pid INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mb REAL,
+    loaded_at REAL NOT NULL,
+    PRIMARY KEY (pid, kind, name)
+);
+CREATE TABLE IF NOT EXISTS model_use (
+    name TEXT PRIMARY KEY,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS model_stats (
+    model TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class ConfigConflict(Exception):
+    """The config was saved by someone else since the version the caller edited"""
+
+    def __init__(self, current_version):
+        super().__init__(f"config is at version {current_version}")
+        self.current_version = current_version
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedState:
+    def __init__(self, db_file=DB_FILE, runtime_file=CONFIG_RUNTIME_FILE, default_file=CONFIG_DEFAULT_FILE):
+        self.db_file = db_file
+        self.runtime_file = runtime_file
+        self.default_file = default_file
+        self._conn = None
+        self._conn_pid = None
+        self._executor = SerialExecutor()
+        self._config_cache = (None, None)  # (version, JSON text)
+
+    # --- connection --------------------------------------------------------
+
+    def _connect(self):
+        """This process's connection - only call it inside the executor"""
+        if self._conn_pid != os.getpid():
+            # Autocommit; writes use explicit BEGIN IMMEDIATE transactions. The
+            # executor's thread may differ from the one that opened it
+            conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _read(self, func):
+        """Return func(conn)"""
+        return self._executor.run(lambda: func(self._connect()))
+
+    def _write(self, func):
+        """Run func(conn) in one write transaction"""
+        return self._executor.run(self._transaction, func)
+
+    def _transaction(self, func):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    # --- config ------------------------------------------------------------
+
+    def config_version(self):
+        """Version number of the current config (cheap - no JSON parsing)"""
+        self._import_file_edits()
+        row = self._read(lambda conn: conn.execute('SELECT MAX(version) FROM config').fetchone())
+        if row[0] is None:
+            return self._seed_config()
+        return row[0]
+
+    def get_config(self):
+        """(version, config dict) of the current config"""
+        version = self.config_version()
+        cached_version, data = self._config_cache
+        if cached_version != version:
+            data = self._read(lambda conn: conn.execute('SELECT data FROM config WHERE version = ?', (version,)).fetchone()[0])
+            self._config_cache = (version, data)
+        return version, json.loads(data)
+
+    def save_config(self, config, expected_version=None, source='api'):
+        """Store config as a new version and return it.
+
+        With expected_version, raises ConfigConflict if another save happened
+        since - the caller would otherwise silently overwrite it."""
+        config = {k: v for k, v in config.items() if k not in CONFIG_RESPONSE_KEYS}
+        data = json.dumps(config, indent=2, ensure_ascii=False)
+
+        def save(conn):
+            current = conn.execute('SELECT MAX(version) FROM config').fetchone()[0]
+            if expected_version is not None and current is not None and expected_version != current:
+                raise ConfigConflict(current)
+            cursor = conn.execute('INSERT INTO config (data, saved_at, source) VALUES (?, ?, ?)',
+                                  (data, time.time(), source))
+            # Still inside the write transaction, so the file follows version order
+            self._materialize(conn, data)
+            return cursor.lastrowid
+
+        return self._write(save)
+
+    def reset_config(self):
+        """Save config.json as a new version"""
+        with open(self.default_file, 'r', encoding='utf-8') as f:
+            return self.save_config(json.load(f), source='reset')
+
+    def wait_for_config_change(self, since_version, timeout):
+        """Block until the config version differs from since_version (or timeout). Returns the version"""
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self.config_version()
+            if version != since_version or time.monotonic() >= deadline:
+                return version
+            time.sleep(POLL_INTERVAL)
+
+    def _materialize(self, conn, data):
+        tmp_path = f"{self.runtime_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.runtime_file)
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     ('runtime_file_mtime', str(os.stat(self.runtime_file).st_mtime_ns)))
+
+    def _seed_config(self):
+        """First use: the existing runtime config (or the defaults) becomes version 1"""
+        def seed(conn):
+            current = conn.execute('SELECT MAX(version) FROM config').fetchone()[0]
+            if current is not None:
+                return current
+            path = self.runtime_file if os.path.exists(self.runtime_file) else self.default_file
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.dumps(json.load(f), indent=2, ensure_ascii=False)
+            cursor = conn.execute('INSERT INTO config (data, saved_at, source) VALUES (?, ?, ?)',
+                                  (data, time.time(), os.path.basename(path)))
+            self._materialize(conn, data)
+            return cursor.lastrowid
+        return self._write(seed)
+
+    def _import_file_edits(self):
+        """Pick up hand edits of config_runtime.json as a new version"""
+        try:
+            mtime = os.stat(self.runtime_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        row = self._read(lambda conn: conn.execute("SELECT value FROM meta WHERE key = 'runtime_file_mtime'").fetchone())
+        if row is None or row[0] == str(mtime):
+            return
+
+        def import_edits(conn):
+            row = conn.execute("SELECT value FROM meta WHERE key = 'runtime_file_mtime'").fetchone()
+            if row is None or row[0] == str(os.stat(self.runtime_file).st_mtime_ns):
+                return  # another process imported it first
+            with open(self.runtime_file, 'r', encoding='utf-8') as f:
+                data = json.dumps(json.load(f), indent=2, ensure_ascii=False)
+            conn.execute('INSERT INTO config (data, saved_at, source) VALUES (?, ?, ?)',
+                         (data, time.time(), 'file'))
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         ('runtime_file_mtime', str(os.stat(self.runtime_file).st_mtime_ns)))
+        try:
+            self._write(import_edits)
+        except ValueError:
+            pass  # half-edited or invalid JSON - keep serving the last good version
+
+    # --- jobs --------------------------------------------------------------
+
+    def start_job(self, job_id, kind, key=None):
+        """Register a running job. If a live job with the same key is already
+        running (in any worker), returns (its id, False) instead"""
+        def start(conn):
+            if key is not None:
+                for other_id, pid in conn.execute(
+                        "SELECT id, pid FROM jobs WHERE key = ? AND status = 'running'", (key,)).fetchall():
+                    if _pid_alive(pid):
+                        return other_id, False
+                    self._fail_dead_job(conn, other_id)
+            now = time.time()
+            conn.execute("INSERT INTO jobs (id, kind, key, status, pid, created, updated) VALUES (?, ?, ?, 'running', ?, ?, ?)",
+                         (job_id, kind, key, os.getpid(), now, now))
+            conn.execute('DELETE FROM jobs WHERE id IN (SELECT id FROM jobs ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                         (MAX_JOBS,))
+            return job_id, True
+        return self._write(start)
+
+    def finish_job(self, job_id, http_status, result):
+        status = 'done' if http_status < 400 else 'failed'
+        # A cancelled job keeps its cancellation result
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, http_status = ?, result = ?, updated = ? WHERE id = ? AND status != 'cancelled'",
+            (status, http_status, json.dumps(result, ensure_ascii=False), time.time(), job_id)))
+
+    def cancel_job(self, job_id, http_status, result):
+        """Mark a running job cancelled (its pipeline stops at the next check). False if it isn't running"""
+        cursor = self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'cancelled', http_status = ?, result = ?, updated = ? WHERE id = ? AND status = 'running'",
+            (http_status, json.dumps(result, ensure_ascii=False), time.time(), job_id)))
+        return cursor.rowcount > 0
+
+    def job_cancelled(self, job_id):
+        row = self._read(lambda conn: conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone())
+        return row is not None and row[0] == 'cancelled'
+
+    @staticmethod
+    def _fail_dead_job(conn, job_id):
+        conn.execute("UPDATE jobs SET status = 'failed', http_status = 500, result = ?, updated = ? WHERE id = ?",
+                     (json.dumps({'success': False, 'error': 'התהליך שטיפל בבקשה הופסק'}, ensure_ascii=False),
+                      time.time(), job_id))
+
+    def get_job(self, job_id):
+        row = self._read(lambda conn: conn.execute(
+            'SELECT id, kind, status, pid, created, updated, http_status, result FROM jobs WHERE id = ?',
+            (job_id,)).fetchone())
+        return self._job_dict(row) if row else None
+
+    def recent_jobs(self, limit=50):
+        rows = self._read(lambda conn: conn.execute(
+            'SELECT id, kind, status, pid, created, updated, http_status, result FROM jobs ORDER BY created DESC LIMIT ?',
+            (limit,)).fetchall())
+        return [self._job_dict(row) for row in rows]
+
+    @staticmethod
+    def _job_dict(row):
+        job_id, kind, status, pid, created, updated, http_status, result = row
+        return {
+            'id': job_id, 'kind': kind, 'status': status, 'pid': pid,
+            'created': created, 'updated': updated,
+            'seconds': round((updated if status != 'running' else time.time()) - created, 2),
+            'http_status': http_status,
+            'result': json.loads(result) if result else None,
+        }
+
+    def wait_job(self, job_id, timeout, leave=None):
+        """Wait for a job to finish. Returns (result, http_status); (None, None) on
+        timeout or once leave() is true"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if leave is not None and leave():
+                return None, None
+            job = self.get_job(job_id)
+            if job is None:
+                return None, None
+            if job['status'] != 'running':
+                return job['result'], job['http_status']
+            if not _pid_alive(job['pid']):
+                self._write(lambda conn: self._fail_dead_job(conn, job_id))
+                continue
+            time.sleep(POLL_INTERVAL)
+        return None, None
+
+    # --- job callers -------------------------------------------------------
+
+    def attach_caller(self, caller_id, job_key):
+        """Register a request waiting on the run for job_key (for as long as the request lasts)"""
+        self._write(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO job_callers (caller_id, job_key, pid, detached, created) VALUES (?, ?, ?, 0, ?)',
+            (caller_id, job_key, os.getpid(), time.time())))
+
+    def release_caller(self, caller_id):
+        self._write(lambda conn: conn.execute('DELETE FROM job_callers WHERE caller_id = ?', (caller_id,)))
+
+    def detach_caller(self, caller_id):
+        self._write(lambda conn: conn.execute('UPDATE job_callers SET detached = 1 WHERE caller_id = ?', (caller_id,)))
+
+    def caller_detached(self, caller_id):
+        row = self._read(lambda conn: conn.execute(
+            'SELECT detached FROM job_callers WHERE caller_id = ?', (caller_id,)).fetchone())
+        return bool(row and row[0])
+
+    def caller_job(self, caller_id):
+        """Id of the running job a caller is attached to, or None"""
+        row = self._read(lambda conn: conn.execute(
+            "SELECT jobs.id FROM job_callers JOIN jobs ON jobs.key = job_callers.job_key "
+            "WHERE job_callers.caller_id = ? AND jobs.status = 'running' ORDER BY jobs.created DESC LIMIT 1",
+            (caller_id,)).fetchone())
+        return row[0] if row else None
+
+    def attached_callers(self, job_id, exclude=None):
+        """Number of live, not detached callers of a job, other than `exclude`"""
+        def callers(conn):
+            row = conn.execute('SELECT key FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row[0] is None:
+                return []
+            return conn.execute('SELECT caller_id, pid FROM job_callers WHERE job_key = ? AND detached = 0',
+                                (row[0],)).fetchall()
+        rows = self._read(callers)
+        dead = [caller_id for caller_id, pid in rows if not _pid_alive(pid)]
+        if dead:
+            self._write(lambda c: c.executemany('DELETE FROM job_callers WHERE caller_id = ?', [(d,) for d in dead]))
+        return sum(1 for caller_id, _ in rows if caller_id != exclude and caller_id not in dead)
+
+    # --- cache -------------------------------------------------------------
+
+    def cache_get(self, namespace, key):
+        row = self._read(lambda conn: conn.execute(
+            'SELECT value FROM cache WHERE namespace = ? AND key = ?', (namespace, key)).fetchone())
+        if row is None:
+            return None
+        self._write(lambda c: c.execute('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                                        (time.time(), namespace, key)))
+        return json.loads(row[0])
+
+    def cache_put(self, namespace, key, value, max_entries):
+        """Store a JSON-able value, evicting the least recently used beyond max_entries"""
+        def put(conn):
+            conn.execute('INSERT OR REPLACE INTO cache (namespace, key, value, accessed) VALUES (?, ?, ?, ?)',
+                         (namespace, key, json.dumps(value, ensure_ascii=False), time.time()))
+            conn.execute('DELETE FROM cache WHERE namespace = ? AND key IN '
+                         '(SELECT key FROM cache WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                         (namespace, namespace, max_entries))
+        self._write(put)
+
+    # --- resident models ---------------------------------------------------
+
+    def register_model(self, kind, name, mb):
+        """Record that this process now holds a model in memory"""
+        self._write(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO resident_models (pid, kind, name, mb, loaded_at) VALUES (?, ?, ?, ?, ?)',
+            (os.getpid(), kind, name, mb, time.time())))
+
+    def unregister_model(self, kind, name):
+        self._write(lambda conn: conn.execute(
+            'DELETE FROM resident_models WHERE pid = ? AND kind = ? AND name = ?', (os.getpid(), kind, name)))
+
+    def resident_models(self):
+        """Models held by live processes (entries of exited processes are dropped)"""
+        rows = self._read(lambda conn: conn.execute('SELECT pid, kind, name, mb, loaded_at FROM resident_models').fetchall())
+        dead = [pid for pid in {row[0] for row in rows} if not _pid_alive(pid)]
+        if dead:
+            self._write(lambda conn: conn.executemany('DELETE FROM resident_models WHERE pid = ?', [(pid,) for pid in dead]))
+        return [{'pid': pid, 'kind': kind, 'name': name, 'mb': mb, 'loaded_at': loaded_at}
+                for pid, kind, name, mb, loaded_at in rows if pid not in dead]
+
+    def touch_model(self, name):
+        """Record that an Ollama model is being used now (by any process)"""
+        self._write(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO model_use (name, last_used) VALUES (?, ?)', (name, time.time())))
+
+    def model_last_used(self):
+        """{model name: epoch seconds it was last used}"""
+        return dict(self._read(lambda conn: conn.execute('SELECT name, last_used FROM model_use').fetchall()))
+
+    # --- model stats -------------------------------------------------------
+
+    def get_model_stats(self):
+        """{model: stats dict} for every model with recorded stats"""
+        rows = self._read(lambda conn: conn.execute('SELECT model, data FROM model_stats').fetchall())
+        return {model: json.loads(data) for model, data in rows}
+
+    def update_model_stats(self, model, update):
+        """Replace a model's stats with update(current stats or None), atomically across processes"""
+        def apply(conn):
+            row = conn.execute('SELECT data FROM model_stats WHERE model = ?', (model,)).fetchone()
+            data = update(json.loads(row[0]) if row else None)
+            conn.execute('INSERT OR REPLACE INTO model_stats (model, data, updated) VALUES (?, ?, ?)',
+                         (model, json.dumps(data), time.time()))
+            return data
+        return self._write(apply)
+
+
+_state = None
+
+
+def get_shared_state():
+    """Process-wide SharedState"""
+    global _state
+    if _state is None:
+        _state = SharedState()
+    return _state
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical in-flight work
+
+While a call for some key is running, further calls with the same key don't
+start their own - they wait for the running one and get its result (or its
+exception). Once it finishes the key is forgotten, so this deduplicates
+double-clicks, retries and simultaneous identical questions without caching
+answers. A waiting caller can also leave early (Detached) without affecting
+the others.
+"""
+import threading
+
+LEAVE_POLL_INTERVAL = 0.25
+
+
+class Detached(Exception):
+    """A waiting caller left the shared call before it finished (see SingleFlight.do)"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, leave=None):
+        """Run func() once per key at a time. Returns (result, shared) - shared is
+        True when this caller attached to a call started by someone else.
+        A waiting caller raises Detached as soon as leave() is true."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            while not call.done.wait(LEAVE_POLL_INTERVAL if leave else None):
+                if leave():
+                    with self._lock:
+                        call.waiters -= 1
+                    raise Detached(key)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def waiters(self, key):
+        """Callers attached to the running call for key (besides the one running it)"""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+
+    def in_flight(self):
+        """Number of running calls and callers attached to them"""
+        with self._lock:
+            return {
+                'calls': len(self._calls),
+                'waiters': sum(call.waiters for call in self._calls.values()),
+            }
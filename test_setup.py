@@ -91,6 +91,175 @@ def test_whisper_model():
         print(f"✗ Failed to load Whisper model: {e}")
         return False
 
+# Import-time budgets (ms) for modules the server and pipelines import.
+# Heavy dependencies (faster_whisper, ollama) must load lazily, on first use.
+IMPORT_BUDGETS_MS = {
+    "process_text": 150,
+    "process_audio": 150,
+    "conversation_search": 150,
+}
+FORBIDDEN_AT_IMPORT = {
+    "process_text": ["faster_whisper", "ollama", "numpy"],
+    "process_audio": ["faster_whisper", "ollama", "numpy"],
+    "conversation_search": ["faster_whisper", "ollama"],
+}
+
+def measure_import(module):
+    """Import `module` in a fresh interpreter with -X importtime.
+    Returns (cumulative ms, set of imported top-level packages)"""
+    import os
+    import subprocess
+    
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    
+    cumulative_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        name = parts[2].strip()
+        imported.add(name.split(".")[0])
+        if name == module:
+            cumulative_us = int(parts[1])
+    return cumulative_us / 1000, imported
+
+def test_import_time():
+    """Check that importing the pipelines stays fast and never loads models"""
+    print("\nTesting import time...")
+    
+    all_ok = True
+    for module, budget_ms in IMPORT_BUDGETS_MS.items():
+        try:
+            elapsed_ms, imported = measure_import(module)
+        except Exception as e:
+            print(f"✗ Failed to import {module}: {e}")
+            all_ok = False
+            continue
+        
+        loaded = [name for name in FORBIDDEN_AT_IMPORT.get(module, []) if name in imported]
+        if loaded:
+            print(f"✗ {module} imports {', '.join(loaded)} at import time (should be lazy)")
+            all_ok = False
+        elif elapsed_ms > budget_ms:
+            print(f"✗ {module} took {elapsed_ms:.0f}ms to import (budget {budget_ms}ms)")
+            all_ok = False
+        else:
+            print(f"✓ {module} imported in {elapsed_ms:.0f}ms (budget {budget_ms}ms)")
+    
+    return all_ok
+
+def test_response_format():
+    """Check that the answer format validator counts sentences correctly"""
+    print("\nTesting answer format validation...")
+    
+    from response_format import FormatValidator
+    
+    answer = (
+        "הגדרה קצרה:\nמדינה במזרח התיכון.\n\nהסבר:\n"
+        "המדינה קמה בשנת 1948. היא קטנה. יש בה 9 מיליון תושבים. עוד משפט ארוך שלא צריך."
+    )
+    validator = FormatValidator()
+    stopped = any(validator.feed(word + " ") for word in answer.split(" "))
+    if not stopped:
+        print("✗ A sentence ending in a number did not count, generation would not stop early")
+        return False
+    if "עוד משפט" in validator.final_text() or not validator.report()["valid"]:
+        print("✗ The saved answer was not cut after the third sentence of הסבר")
+        return False
+    print("✓ Sentences ending in a number are counted")
+    
+    validator = FormatValidator()
+    if validator.feed("הגדרה קצרה:\nשלבים.\n\nהסבר:\n1. שלב ראשון\n2. שלב שני\n3. שלב"):
+        print("✗ List markers were counted as sentence ends")
+        return False
+    print("✓ List markers are not counted as sentence ends")
+    
+    return True
+
+def test_conversation_search():
+    """Check that prefix stripping finds real prefixed words without unrelated matches"""
+    print("\nTesting conversation search...")
+    
+    import os
+    import tempfile
+    from conversation_log import ConversationLog
+    from conversation_search import ConversationIndex
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        log = ConversationLog(os.path.join(tmp, "conversation.txt"))
+        for i, answer in enumerate(["אין שום דבר", "היום יפה", "יש לי בית גדול"]):
+            log.append(f"01-01-26 10:00:0{i} input:\nשאלה\n\n01-01-26 10:00:0{i} output:\n{answer}\n\n{'=' * 50}\n\n")
+        index = ConversationIndex(log)
+        
+        all_ok = True
+        for query, expected in [("שלום", []), ("ביום", []), ("והבית", ["יש לי בית גדול"])]:
+            found = [result["output"] for result in index.search(query)["results"]]
+            if found == expected:
+                print(f"✓ '{query}' → {found or 'no matches'}")
+            else:
+                print(f"✗ '{query}' matched {found}, expected {expected or 'nothing'}")
+                all_ok = False
+    
+    return all_ok
+
+def test_knowledge_index():
+    """Check that a knowledge folder is indexed and searched (offline, with the hash embedder)"""
+    print("\nTesting knowledge retrieval...")
+    
+    import os
+    import tempfile
+    try:
+        import numpy
+    except ImportError as e:
+        print(f"✗ Failed to import numpy: {e}")
+        return False
+    from knowledge_index import HashEmbedder, KnowledgeIndex
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        knowledge_dir = os.path.join(tmp, "knowledge")
+        os.makedirs(knowledge_dir)
+        files = {
+            "history.txt": "מדינת ישראל הוקמה בשנת 1948 לאחר מלחמת העצמאות.",
+            "biology.md": "הפוטוסינתזה היא התהליך שבו צמחים הופכים אור לאנרגיה.",
+            "sport.txt": "משחק הכדורגל נמשך תשעים דקות ומשחקים בו שתי קבוצות.",
+        }
+        for name, text in files.items():
+            with open(os.path.join(knowledge_dir, name), "w", encoding="utf-8") as f:
+                f.write(text)
+        
+        index = KnowledgeIndex(knowledge_dir, os.path.join(tmp, "index"), HashEmbedder(), settings={"min_score": 0})
+        counts = index.refresh()
+        if counts["indexed"] != len(files):
+            print(f"✗ Indexed {counts['indexed']} of {len(files)} files")
+            return False
+        if index.is_stale(index.load_meta()):
+            print("✗ The index is stale right after a refresh")
+            return False
+        
+        results = index.search("איך צמחים הופכים אור לאנרגיה")
+        if not results or results[0]["file"] != "biology.md":
+            print(f"✗ Wrong top hit: {results[0]['file'] if results else 'nothing'} (expected biology.md)")
+            return False
+        print(f"✓ Top hit {results[0]['file']} (score {results[0]['score']})")
+        
+        with open(os.path.join(knowledge_dir, "new.txt"), "w", encoding="utf-8") as f:
+            f.write("קובץ חדש")
+        if not index.is_stale(index.load_meta()):
+            print("✗ A new file didn't mark the index stale")
+            return False
+        print("✓ A new file marks the index stale")
+    
+    return True
+
 def test_microphone():
     """Test if microphone is accessible"""
     print("\nTesting microphone access...")
@@ -127,6 +296,10 @@ def main():
     
     # Run all tests
     results.append(("Package Imports", test_imports()))
+    results.append(("Import Time", test_import_time()))
+    results.append(("Answer Format", test_response_format()))
+    results.append(("Conversation Search", test_conversation_search()))
+    results.append(("Knowledge Index", test_knowledge_index()))
     results.append(("Ollama Connection", test_ollama_connection()))
     results.append(("Whisper Model", test_whisper_model()))
     results.append(("Microphone Access", test_microphone()))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Bounded cache of Whisper transcripts keyed by audio content
+
+A retried upload (the client timed out and resent the same blob) decodes to
+the same PCM, so its transcript can be reused and the pipeline goes straight
+to the LLM stage. Keys are a SHA-256 of the decoded samples plus everything
+that changes Whisper's output: model size, compute type and language.
+
+Entries live in a small in-memory LRU for long-running processes and in the
+"transcripts" namespace of the shared state database, so the per-request
+pipeline subprocesses and every server worker share them. Both are bounded
+by the "transcript_cache" config section; least recently used go first.
+"""
+import hashlib
+import wave
+from collections import OrderedDict
+
+from settings import load_settings
+from shared_state import get_shared_state
+
+NAMESPACE = 'transcripts'
+
+DEFAULT_MAX_ENTRIES = 500
+DEFAULT_MEMORY_ENTRIES = 64
+HASH_CHUNK_FRAMES = 64 * 1024
+
+
+def audio_fingerprint(audio_path):
+    """SHA-256 of the decoded PCM samples (of the raw file if it isn't a WAV)"""
+    digest = hashlib.sha256()
+    try:
+        with wave.open(audio_path, 'rb') as wav:
+            # Header fields (e.g. ffmpeg's encoder tag) don't change the transcript, the format does
+            digest.update(f"{wav.getnchannels()}:{wav.getsampwidth()}:{wav.getframerate()}:".encode())
+            while True:
+                frames = wav.readframes(HASH_CHUNK_FRAMES)
+                if not frames:
+                    break
+                digest.update(frames)
+    except (wave.Error, EOFError):
+        digest = hashlib.sha256()
+        with open(audio_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(fingerprint, model_size, compute_type, language):
+    return hashlib.sha256(f"{fingerprint}|{model_size}|{compute_type}|{language}".encode()).hexdigest()
+
+
+class TranscriptCache:
+    """get/put of transcripts by cache_key(), in memory and in the shared state"""
+
+    def __init__(self, state=None, max_entries=None, memory_entries=None):
+        settings = load_settings('transcript_cache')
+        self.enabled = settings.get('enabled', True)
+        self.state = state or get_shared_state()
+        self.max_entries = max_entries or settings.get('max_entries') or DEFAULT_MAX_ENTRIES
+        self.memory_entries = memory_entries or settings.get('memory_entries') or DEFAULT_MEMORY_ENTRIES
+        self._memory = OrderedDict()
+
+    def _remember(self, key, text):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Cached transcript for key, or None"""
+        if not self.enabled:
+            return None
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        text = self.state.cache_get(NAMESPACE, key)
+        if text is not None:
+            self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        if not self.enabled:
+            return
+        self._remember(key, text)
+        self.state.cache_put(NAMESPACE, key, text, self.max_entries)
+
+
+_cache = None
+
+
+def get_transcript_cache():
+    """Process-wide TranscriptCache"""
+    global _cache
+    if _cache is None:
+        _cache = TranscriptCache()
+    return _cache